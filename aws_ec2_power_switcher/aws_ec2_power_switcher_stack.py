@@ -1,7 +1,10 @@
 from aws_cdk import (
-    # Duration,
+    Duration,
     Stack,
     aws_cognito,
+    aws_dynamodb,
+    aws_events,
+    aws_events_targets,
     aws_lambda,
     aws_apigateway,
     # aws_certificatemanager,
@@ -121,6 +124,8 @@ class AwsEc2PowerSwitcherStack(Stack):
                         "ec2:StartInstances",
                         "ec2:StopInstances",
                         "ec2:DescribeInstances",
+                        "ec2:DescribeInstanceStatus",
+                        "ec2:DescribeRegions",
                         "ec2:RevokeSecurityGroupIngress",
                         "ec2:AuthorizeSecurityGroupIngress",
                         "ec2:ModifySecurityGroupRules",
@@ -133,6 +138,17 @@ class AwsEc2PowerSwitcherStack(Stack):
             roles=[ec2_control_lambda_role]
         )
 
+        jobs_table = aws_dynamodb.Table(
+            self,
+            "EC2PowerJobs",
+            partition_key=aws_dynamodb.Attribute(
+                name="job_id",
+                type=aws_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at"
+        )
+
         py37_layer = aws_lambda.LayerVersion(
             self,
             'py37_layer',
@@ -159,9 +175,22 @@ class AwsEc2PowerSwitcherStack(Stack):
                 )
             ),
             role=ec2_control_lambda_role,
-            environment={},
+            environment={
+                "JOB_STORE": "dynamodb:" + jobs_table.table_name,
+                "EMF_METRICS": "true",
+                "RESPONSE_COMPRESSION": "true"
+            },
             layers=[py37_layer]
         )
+        jobs_table.grant_read_write_data(ec2_control)
+
+        # evaluates the POWER_SCHEDULES of the function
+        aws_events.Rule(
+            self,
+            "PowerSchedule",
+            schedule=aws_events.Schedule.rate(Duration.minutes(5)),
+            targets=[aws_events_targets.LambdaFunction(ec2_control)]
+        )
 
         # production stage
         cfn_account = aws_apigateway.CfnAccount(
@@ -174,6 +203,8 @@ class AwsEc2PowerSwitcherStack(Stack):
             self,
             id='AdminApi',
             rest_api_name='AdminApi',
+            # Lets API Gateway decode the base64 bodies of compressed responses
+            binary_media_types=['*/*'],
             deploy_options=aws_apigateway.StageOptions(
                 access_log_destination=aws_apigateway.LogGroupLogDestination(api_log_group),
                 access_log_format=aws_apigateway.AccessLogFormat.json_with_standard_fields(
@@ -257,3 +288,58 @@ class AwsEc2PowerSwitcherStack(Stack):
             'AuthorizerId',
             authorizer.ref
         )
+
+        ec2_batch_resource = ec2_resource.add_resource("batch")
+        ec2_batch_method = ec2_batch_resource.add_method(
+            "POST",
+            integration=aws_apigateway.LambdaIntegration(
+                handler=ec2_control
+            )
+        )
+        ec2_batch_method_resource = ec2_batch_method.node \
+            .find_child('Resource')
+        ec2_batch_method_resource.add_property_override(
+            'AuthorizationType',
+            'COGNITO_USER_POOLS'
+        )
+        ec2_batch_method_resource.add_property_override(
+            'AuthorizerId',
+            authorizer.ref
+        )
+
+        ec2_jobs_resource = ec2_resource.add_resource("jobs") \
+            .add_resource("{job_id}")
+        ec2_jobs_method = ec2_jobs_resource.add_method(
+            "GET",
+            integration=aws_apigateway.LambdaIntegration(
+                handler=ec2_control
+            )
+        )
+        ec2_jobs_method_resource = ec2_jobs_method.node \
+            .find_child('Resource')
+        ec2_jobs_method_resource.add_property_override(
+            'AuthorizationType',
+            'COGNITO_USER_POOLS'
+        )
+        ec2_jobs_method_resource.add_property_override(
+            'AuthorizerId',
+            authorizer.ref
+        )
+
+        ec2_inventory_resource = ec2_resource.add_resource("inventory")
+        ec2_inventory_method = ec2_inventory_resource.add_method(
+            "GET",
+            integration=aws_apigateway.LambdaIntegration(
+                handler=ec2_control
+            )
+        )
+        ec2_inventory_method_resource = ec2_inventory_method.node \
+            .find_child('Resource')
+        ec2_inventory_method_resource.add_property_override(
+            'AuthorizationType',
+            'COGNITO_USER_POOLS'
+        )
+        ec2_inventory_method_resource.add_property_override(
+            'AuthorizerId',
+            authorizer.ref
+        )
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the Lambda cold start of `wsgi_handler`: the module import plus the
+first `/ec2/info` request, each run in a fresh interpreter.
+
+The `eager` mode reproduces the former module-level `boto3.client('ec2')` and
+`boto3.resource('ec2')` construction before the handler is imported, the
+`lazy` mode imports the handler as it is deployed today. EC2 is never called,
+a local fake endpoint (`EC2_ENDPOINT_URL`) answers every call.
+
+Usage: python benchmarks/cold_start.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMBDA_ROOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func"
+)
+
+CHILD = r"""
+import json
+import sys
+import time
+
+started = time.perf_counter()
+
+if sys.argv[1] == "eager":
+    import boto3
+
+    boto3.client("ec2", region_name="us-east-1")
+    boto3.resource("ec2", region_name="us-east-1")
+
+import wsgi_handler
+
+imported = time.perf_counter()
+
+response = wsgi_handler.handler(
+    {
+        "httpMethod": "GET",
+        "path": "/ec2/info",
+        "headers": {"Host": "localhost"},
+        "queryStringParameters": {"instance_id": "i-0123456789abcdef0"},
+        "isBase64Encoded": False,
+        "body": None,
+    },
+    None,
+)
+assert response["statusCode"] == 200, response
+# A failed describe would measure retries instead of the cold start
+assert "region_errors" not in json.loads(response["body"]), response
+
+finished = time.perf_counter()
+print(json.dumps({"import": imported - started, "total": finished - started}))
+"""
+
+RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+  <requestId>00000000-0000-0000-0000-000000000000</requestId>
+  <reservationSet/>
+</DescribeInstancesResponse>"""
+
+
+class FakeEc2Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent apart, avoid the delayed ACK stall on them
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(mode, endpoint_url):
+    env = dict(
+        os.environ,
+        AWS_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        EC2_ENDPOINT_URL=endpoint_url,
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, mode], cwd=LAMBDA_ROOT, env=env
+    )
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEc2Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = "http://127.0.0.1:%d" % server.server_port
+
+    # Warm the bytecode and filesystem caches once, like a deployed layer.
+    run("eager", endpoint_url)
+
+    print("{:<6} {:>12} {:>20}".format("mode", "import (ms)", "import+request (ms)"))
+    for mode in ("eager", "lazy"):
+        samples = [run(mode, endpoint_url) for _ in range(args.runs)]
+        print(
+            "{:<6} {:>12.1f} {:>20.1f}".format(
+                mode,
+                statistics.median(s["import"] for s in samples) * 1000,
+                statistics.median(s["total"] for s in samples) * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
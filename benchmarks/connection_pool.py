@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the shared EC2 client under bursts of concurrent requests, with
+botocore's default connection settings and with the settings of
+`clients.get_config`.
+
+A local fake EC2 endpoint answers DescribeInstances after `--latency` ms, and
+charges every new connection `--handshake` ms to stand for the TCP + TLS setup
+of the real endpoint. Worker threads share one client, like the threads of
+`serve.py`, and make `--threads` concurrent calls per wave. Between waves the
+connections are idle. The ones that do not fit in the pool are closed, and
+the next wave has to open them again.
+
+Usage: python benchmarks/connection_pool.py [--threads 32] [--waves 30]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func")
+)
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import logging  # noqa: E402
+
+from ec2_control import clients  # noqa: E402
+
+# "Connection pool is full, discarding connection" is the expected behaviour
+logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+
+RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+  <requestId>00000000-0000-0000-0000-000000000000</requestId>
+  <reservationSet><item>
+    <reservationId>r-0123456789abcdef0</reservationId>
+    <instancesSet><item>
+      <instanceId>i-0123456789abcdef0</instanceId>
+      <instanceState><code>16</code><name>running</name></instanceState>
+      <groupSet/>
+    </item></instancesSet>
+  </item></reservationSet>
+</DescribeInstancesResponse>"""
+
+
+class FakeEc2Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    handshake = 0.0
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        FakeEc2Handler.connections += 1
+        time.sleep(self.handshake)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(config, threads, waves):
+    os.environ.update(config)
+    clients.reset()
+    client = clients.get_client("us-east-1")
+    client.describe_instances()
+
+    FakeEc2Handler.connections = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(waves):
+            list(executor.map(lambda _: client.describe_instances(), range(threads)))
+    seconds = time.perf_counter() - started
+    return threads * waves / seconds, FakeEc2Handler.connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--waves", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=50)
+    parser.add_argument("--handshake", type=float, default=50)
+    args = parser.parse_args()
+
+    FakeEc2Handler.latency = args.latency / 1000
+    FakeEc2Handler.handshake = args.handshake / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEc2Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["EC2_ENDPOINT_URL"] = "http://127.0.0.1:%d" % server.server_port
+
+    for name, config in (
+        (
+            "botocore defaults",
+            {
+                "EC2_MAX_POOL_CONNECTIONS": "10",
+                "EC2_CONNECT_TIMEOUT": "60",
+                "EC2_TCP_KEEPALIVE": "false",
+            },
+        ),
+        (
+            "tuned",
+            {
+                "EC2_MAX_POOL_CONNECTIONS": str(max(32, args.threads)),
+                "EC2_CONNECT_TIMEOUT": "5",
+                "EC2_TCP_KEEPALIVE": "true",
+            },
+        ),
+    ):
+        throughput, connections = run(config, args.threads, args.waves)
+        print(
+            "%-18s %7.0f calls/s, %5d new connections"
+            % (name, throughput, connections)
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the WSGI environ construction of `serverless_wsgi` with the former
+implementation, which built the full environ dict from scratch for every
+request and re-encoded every value afterwards, on the recorded events in
+`benchmarks/events`.
+
+Usage: python benchmarks/environ.py [--number 20000]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "..", "lambda_func"))
+
+import serverless_wsgi  # noqa: E402
+from werkzeug.datastructures import Headers  # noqa: E402
+from werkzeug.urls import url_encode, url_unquote  # noqa: E402
+
+
+def legacy_setup_environ_items(environ, headers):
+    for key, value in environ.items():
+        if isinstance(value, str):
+            environ[key] = value.encode("utf-8").decode("latin1", "replace")
+
+    for key, value in headers.items():
+        key = "HTTP_" + key.upper().replace("-", "_")
+        if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            environ[key] = value
+    return environ
+
+
+def legacy_environ_v1(event, context):
+    if "multiValueHeaders" in event:
+        headers = Headers(event["multiValueHeaders"])
+    else:
+        headers = Headers(event["headers"])
+
+    script_name = serverless_wsgi.get_script_name(headers, event.get("requestContext", {}))
+    path_info = serverless_wsgi.strip_express_gateway_query_params(event["path"])
+    body = serverless_wsgi.get_body_bytes(event, event.get("body") or "")
+
+    environ = {
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": headers.get("Content-Type", ""),
+        "PATH_INFO": url_unquote(path_info),
+        "QUERY_STRING": serverless_wsgi.encode_query_string(event),
+        "REMOTE_ADDR": event.get("requestContext", {})
+        .get("identity", {})
+        .get("sourceIp", ""),
+        "REMOTE_USER": event.get("requestContext", {})
+        .get("authorizer", {})
+        .get("principalId", ""),
+        "REQUEST_METHOD": event.get("httpMethod", {}),
+        "SCRIPT_NAME": script_name,
+        "SERVER_NAME": headers.get("Host", "lambda"),
+        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.errors": sys.stderr,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.multiprocess": False,
+        "wsgi.multithread": False,
+        "wsgi.run_once": False,
+        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
+        "wsgi.version": (1, 0),
+        "serverless.authorizer": event.get("requestContext", {}).get("authorizer"),
+        "serverless.event": event,
+        "serverless.context": context,
+    }
+    return legacy_setup_environ_items(environ, headers)
+
+
+def legacy_environ_v2(event, context):
+    headers = Headers(event["headers"])
+
+    script_name = serverless_wsgi.get_script_name(headers, event.get("requestContext", {}))
+    path_info = serverless_wsgi.strip_express_gateway_query_params(event["rawPath"])
+    body = serverless_wsgi.get_body_bytes(event, event.get("body", ""))
+
+    headers["Cookie"] = "; ".join(event.get("cookies", []))
+
+    environ = {
+        "CONTENT_LENGTH": str(len(body or "")),
+        "CONTENT_TYPE": headers.get("Content-Type", ""),
+        "PATH_INFO": url_unquote(path_info),
+        "QUERY_STRING": event.get("rawQueryString", ""),
+        "REMOTE_ADDR": event.get("requestContext", {})
+        .get("http", {})
+        .get("sourceIp", ""),
+        "REMOTE_USER": event.get("requestContext", {})
+        .get("authorizer", {})
+        .get("principalId", ""),
+        "REQUEST_METHOD": event.get("requestContext", {})
+        .get("http", {})
+        .get("method", ""),
+        "SCRIPT_NAME": script_name,
+        "SERVER_NAME": headers.get("Host", "lambda"),
+        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.errors": sys.stderr,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.multiprocess": False,
+        "wsgi.multithread": False,
+        "wsgi.run_once": False,
+        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
+        "wsgi.version": (1, 0),
+        "serverless.authorizer": event.get("requestContext", {}).get("authorizer"),
+        "serverless.event": event,
+        "serverless.context": context,
+    }
+    return legacy_setup_environ_items(environ, headers)
+
+
+def legacy_environ_lambda_integration(event, context):
+    headers = Headers(event["headers"])
+
+    script_name = serverless_wsgi.get_script_name(headers, event)
+    path_info = serverless_wsgi.strip_express_gateway_query_params(event["requestPath"])
+    for key, value in event.get("path", {}).items():
+        path_info = path_info.replace("{%s}" % key, value)
+        path_info = path_info.replace("{%s+}" % key, value)
+
+    body = event.get("body", {})
+    body = json.dumps(body) if body else ""
+    body = serverless_wsgi.get_body_bytes(event, body)
+
+    environ = {
+        "CONTENT_LENGTH": str(len(body or "")),
+        "CONTENT_TYPE": headers.get("Content-Type", ""),
+        "PATH_INFO": url_unquote(path_info),
+        "QUERY_STRING": url_encode(event.get("query", {})),
+        "REMOTE_ADDR": event.get("identity", {}).get("sourceIp", ""),
+        "REMOTE_USER": event.get("principalId", ""),
+        "REQUEST_METHOD": event.get("method", ""),
+        "SCRIPT_NAME": script_name,
+        "SERVER_NAME": headers.get("Host", "lambda"),
+        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.errors": sys.stderr,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.multiprocess": False,
+        "wsgi.multithread": False,
+        "wsgi.run_once": False,
+        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
+        "wsgi.version": (1, 0),
+        "serverless.authorizer": event.get("enhancedAuthContext"),
+        "serverless.event": event,
+        "serverless.context": context,
+    }
+    return legacy_setup_environ_items(environ, headers)
+
+
+CASES = [
+    ("payload_v1", legacy_environ_v1, serverless_wsgi.get_environ_v1),
+    ("payload_v2", legacy_environ_v2, serverless_wsgi.get_environ_v2),
+    (
+        "lambda_integration",
+        legacy_environ_lambda_integration,
+        serverless_wsgi.get_environ_lambda_integration,
+    ),
+]
+
+
+def comparable(environ):
+    return {
+        key: value
+        for key, value in environ.items()
+        if key not in ("wsgi.input", "wsgi.errors")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print("{:<20} {:>12} {:>12}".format("event", "legacy (us)", "template (us)"))
+    for name, legacy, current in CASES:
+        with open(os.path.join(ROOT, "events", name + ".json")) as f:
+            event = json.load(f)
+
+        assert comparable(legacy(event, None)) == comparable(current(event, None)), name
+
+        timings = [
+            min(timeit.repeat(lambda: build(event, None), number=args.number, repeat=3))
+            / args.number
+            * 1e6
+            for build in (legacy, current)
+        ]
+        print("{:<20} {:>12.2f} {:>12.2f}".format(name, *timings))
+
+
+if __name__ == "__main__":
+    main()
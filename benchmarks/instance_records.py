@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the dict based instance info previously built by
+`parser_describe_response` with the slotted `InstanceRecord`s, on a synthetic
+DescribeInstances response: parse time, memory retained by the result, and the
+time to select the requested instances the way the power routes do.
+
+Usage: python benchmarks/instance_records.py [--instances 50000]
+"""
+import argparse
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func")
+)
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from ec2_control import api  # noqa: E402
+
+
+def legacy_parser(response):
+    ret = dict()
+    for reservation in response["Reservations"]:
+        for instance in reservation["Instances"]:
+            ret[instance["InstanceId"]] = {
+                "State": instance["State"]["Name"] if "State" in instance else None,
+                "PublicIpAddress": instance.get("PublicIpAddress"),
+                "SecurityGroups": [
+                    security_group["GroupId"]
+                    for security_group in instance["SecurityGroups"]
+                ],
+            }
+    return ret
+
+
+def describe_response(instances):
+    return {
+        "Reservations": [
+            {
+                "Instances": [
+                    {
+                        "InstanceId": "i-%017x" % (n * 16 + m),
+                        "State": {"Code": 16, "Name": "running"},
+                        "PublicIpAddress": "3.%d.%d.%d" % (n % 256, m, n // 256 % 256),
+                        "SecurityGroups": [
+                            {"GroupId": "sg-%017x" % (n % 50)},
+                            {"GroupId": "sg-%017x" % 999},
+                        ],
+                    }
+                    for m in range(min(16, instances - n * 16))
+                ]
+            }
+            for n in range((instances + 15) // 16)
+        ]
+    }
+
+
+def retained_memory(parser, response):
+    gc.collect()
+    tracemalloc.start()
+    parsed = parser(response)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del parsed
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instances", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    response = describe_response(args.instances)
+    # Request bodies are decoded into fresh, non interned strings
+    requested = ["".join(["i-", "%017x" % n]) for n in range(0, args.instances, 2)]
+
+    for name, parse, prepare in (
+        ("dict", legacy_parser, list),
+        ("InstanceRecord", api.parser_describe_response, api.records.intern_ids),
+    ):
+        seconds = min(
+            timeit.repeat(lambda: parse(response), number=1, repeat=args.repeat)
+        )
+        size = retained_memory(parse, response)
+        parsed = parse(response)
+        instance_ids = prepare(requested)
+        select = min(
+            timeit.repeat(
+                lambda: [i for i in instance_ids if i in parsed],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        print(
+            "%-15s parse %6.1f ms, retained %6.1f MiB, select %5.2f ms"
+            % (name, seconds * 1000, size / 2 ** 20, select * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the peak memory of exporting the whole inventory as one JSON document
+(every page parsed into a dict, then serialized at once) and as streamed
+NDJSON (`api.iter_inventory`), for growing account sizes.
+
+EC2 is replaced by a fake client generating 1000 instance pages on demand, so
+only the export itself is measured.
+
+Usage: python benchmarks/inventory.py [--instances 1000 10000 50000]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tracemalloc
+import types
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func")
+)
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from ec2_control import api, query, records  # noqa: E402
+
+PAGE_SIZE = 1000
+
+
+class FakeEc2:
+    # What `throttle.RetryingClient` reads of a botocore client
+    meta = types.SimpleNamespace(
+        method_to_api_mapping={"describe_instances": "DescribeInstances"}
+    )
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def describe_instances(self, **kwargs):
+        start = int(kwargs.get("NextToken", 0))
+        stop = min(start + PAGE_SIZE, self.instances)
+        page = {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": "i-%017x" % n,
+                            "InstanceType": "t3.micro",
+                            "LaunchTime": datetime.datetime(2022, 1, 1),
+                            "PrivateIpAddress": "10.0.%d.%d" % (n // 256 % 256, n % 256),
+                            "State": {"Code": 16, "Name": "running"},
+                            "SecurityGroups": [{"GroupId": "sg-0123456789abcdef0"}],
+                            "Tags": [{"Key": "Name", "Value": "node-%d" % n}],
+                        }
+                        for n in range(start, stop)
+                    ]
+                }
+            ]
+        }
+        if stop < self.instances:
+            page["NextToken"] = str(stop)
+        return page
+
+
+def export_document(client, stream):
+    targets = {}
+    for page in query.iter_describe_pages(client, page_size=PAGE_SIZE):
+        targets.update(api.parser_describe_response(page, tuple(api.INSTANCE_FIELDS)))
+    stream.write(json.dumps({"message": "OK", "targets": records.to_json(targets)}))
+
+
+def export_ndjson(client, stream):
+    for line in api.iter_ndjson(api.iter_inventory([api.region])):
+        stream.write(line)
+
+
+class NullStream:
+    def write(self, data):
+        pass
+
+
+def peak_memory(export, instances):
+    client = FakeEc2(instances)
+    api.clients.get_client = lambda region_name: client
+    tracemalloc.start()
+    export(client, NullStream())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--instances", type=int, nargs="+", default=[1000, 10000, 50000]
+    )
+    args = parser.parse_args()
+
+    for instances in args.instances:
+        with api.app.app_context():
+            document = peak_memory(export_document, instances)
+            ndjson = peak_memory(export_ndjson, instances)
+        print(
+            "%6d instances: document %7.1f MiB, ndjson %5.1f MiB"
+            % (instances, document / 2 ** 20, ndjson / 2 ** 20)
+        )
+
+
+if __name__ == "__main__":
+    main()
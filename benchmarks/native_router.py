@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the per-invocation overhead of serving `/ec2/info` through the WSGI
+translation (`serverless_wsgi.handle_request`) and through the native router
+(`serverless_wsgi.handle_native_request`).
+
+The instance is served from the state cache, so EC2 is never called and the
+difference is the cost of the event translation, Flask and Werkzeug.
+
+Usage: python benchmarks/native_router.py [--invocations 5000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func")
+)
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("EC2_STATE_CACHE_TTL", "3600")
+
+import serverless_wsgi  # noqa: E402
+from ec2_control import api  # noqa: E402
+
+EVENT = {
+    "httpMethod": "GET",
+    "path": "/ec2/info",
+    "headers": {
+        "Accept": "application/json",
+        "Host": "abcdefghij.execute-api.us-east-1.amazonaws.com",
+        "User-Agent": "benchmark",
+        "X-Forwarded-For": "1.2.3.4",
+        "X-Forwarded-Port": "443",
+        "X-Forwarded-Proto": "https",
+    },
+    "queryStringParameters": {"instance_id": "i-0123456789abcdef0"},
+    "requestContext": {"stage": "prod", "identity": {"sourceIp": "1.2.3.4"}},
+    "isBase64Encoded": False,
+    "body": None,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--invocations", type=int, default=5000)
+    args = parser.parse_args()
+
+    api.state_cache.put_many(
+        api.region,
+        {
+            "i-0123456789abcdef0": {
+                "State": "running",
+                "PublicIpAddress": "1.2.3.4",
+                "SecurityGroups": ["sg-0123456789abcdef0"],
+            }
+        },
+    )
+    routes = serverless_wsgi.get_native_routes(api.app)
+
+    paths = {
+        "wsgi": lambda: serverless_wsgi.handle_request(api.app, EVENT, None),
+        "native": lambda: serverless_wsgi.handle_native_request(routes, EVENT, None),
+    }
+
+    print("{:<8} {:>16}".format("path", "per call (us)"))
+    for name, invoke in paths.items():
+        assert invoke()["statusCode"] == 200
+        best = min(timeit.repeat(invoke, number=args.invocations, repeat=3))
+        print("{:<8} {:>16.1f}".format(name, best / args.invocations * 1e6))
+
+
+if __name__ == "__main__":
+    main()
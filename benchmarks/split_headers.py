@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares `serverless_wsgi.split_headers` with the former implementation walking
+`all_casings()` for responses repeating a header (e.g. `Set-Cookie`) many times.
+
+Usage: python benchmarks/split_headers.py [--number 200]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func")
+)
+
+import serverless_wsgi  # noqa: E402
+from werkzeug.datastructures import Headers  # noqa: E402
+
+
+def legacy_split_headers(headers):
+    new_headers = {}
+
+    for key in headers.keys():
+        values = headers.get_all(key)
+        if len(values) > 1:
+            for value, casing in zip(values, serverless_wsgi.all_casings(key)):
+                new_headers[casing] = value
+        elif len(values) == 1:
+            new_headers[key] = values[0]
+
+    return new_headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    print("{:>10} {:>14} {:>14}".format("cookies", "legacy (us)", "cached (us)"))
+    for duplicates in (2, 8, 32, 128, 512):
+        headers = Headers([("Content-Type", "application/json")])
+        for n in range(duplicates):
+            headers.add("Set-Cookie", "cookie{}=value; Path=/; HttpOnly".format(n))
+
+        assert legacy_split_headers(headers) == serverless_wsgi.split_headers(headers)
+
+        timings = [
+            min(timeit.repeat(lambda: split(headers), number=args.number, repeat=3))
+            / args.number
+            * 1e6
+            for split in (legacy_split_headers, serverless_wsgi.split_headers)
+        ]
+        print("{:>10} {:>14.1f} {:>14.1f}".format(duplicates, *timings))
+
+
+if __name__ == "__main__":
+    main()
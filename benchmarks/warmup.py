@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the first `/ec2/info` request of a fresh container, with and without
+a `serverless-plugin-warmup` event handled before it, against the following
+(steady-state) request.
+
+Every run is a fresh interpreter importing `wsgi_handler`. A local fake EC2
+endpoint answers every call and charges each new connection `--handshake` ms
+to stand for the TCP + TLS setup of the real endpoint.
+
+Usage: python benchmarks/warmup.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMBDA_ROOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "lambda_func"
+)
+
+RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+  <requestId>00000000-0000-0000-0000-000000000000</requestId>
+  <reservationSet/>
+</DescribeInstancesResponse>"""
+
+CHILD = r"""
+import json
+import sys
+import time
+
+import wsgi_handler
+
+if sys.argv[1] == "warmed":
+    wsgi_handler.handler({"source": "serverless-plugin-warmup"}, None)
+
+
+def request(instance_id):
+    started = time.perf_counter()
+    response = wsgi_handler.handler(
+        {
+            "httpMethod": "GET",
+            "path": "/ec2/info",
+            "headers": {"Host": "localhost"},
+            "queryStringParameters": {"instance_id": instance_id},
+            "isBase64Encoded": False,
+            "body": None,
+        },
+        None,
+    )
+    assert response["statusCode"] == 200, response
+    return time.perf_counter() - started
+
+
+first = request("i-0123456789abcdef0")
+steady = request("i-0123456789abcdef1")
+print(json.dumps({"first": first, "steady": steady}))
+"""
+
+
+class FakeEc2Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent apart, avoid the delayed ACK stall on them
+    disable_nagle_algorithm = True
+    handshake = 0.0
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.handshake)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(mode, endpoint_url):
+    env = dict(
+        os.environ,
+        AWS_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        EC2_ENDPOINT_URL=endpoint_url,
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, mode], cwd=LAMBDA_ROOT, env=env
+    )
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--handshake", type=float, default=50)
+    args = parser.parse_args()
+
+    FakeEc2Handler.handshake = args.handshake / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEc2Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = "http://127.0.0.1:%d" % server.server_port
+
+    # Warm the bytecode and filesystem caches once, like a deployed layer.
+    run("cold", endpoint_url)
+
+    print("{:<7} {:>19} {:>20}".format("mode", "first request (ms)", "next request (ms)"))
+    for mode in ("cold", "warmed"):
+        samples = [run(mode, endpoint_url) for _ in range(args.runs)]
+        print(
+            "{:<7} {:>19.1f} {:>20.1f}".format(
+                mode,
+                statistics.median(s["first"] for s in samples) * 1000,
+                statistics.median(s["steady"] for s in samples) * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
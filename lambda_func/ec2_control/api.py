@@ -1,19 +1,40 @@
-from flask import Flask, request, json, jsonify, make_response
+from flask import Flask, Response, g, request, json, jsonify, make_response, \
+    stream_with_context
 from functools import reduce
 
-import boto3
+import base64
 import os
+import sys
+import time
 from botocore.exceptions import ClientError
 
+import metrics
+
+from . import cache, clients, concurrency, idempotency, jobs, query, records, \
+    schedule, security_group, throttle
+
 
 app = Flask(__name__)
 
 region = os.environ.get('AWS_REGION') or 'us-east-1'
-ec2 = boto3.client('ec2', region_name=region)
-ec2_resource = boto3.resource('ec2', region_name=region)
+state_cache = cache.from_environ()
+tag_index = cache.tag_index_from_environ()
+job_store = jobs.from_environ()
+idempotency_store = idempotency.from_environ()
+# Coalesces concurrent describes of the same instances, keyed by region.
+describe_flights = concurrency.SingleFlight()
+# Built from `POWER_SCHEDULES` by the first schedule event of the container.
+schedule_index = None
 
 
-def get_ip_permissions(myip):
+# Stands for the caller's address in the IP permission template.
+MYIP_CIDR = '{myip}/32'
+
+# Built once per container by `get_ip_permission_template`.
+_ip_permission_template = None
+
+
+def build_ip_permission_template():
     return [
         {
             "FromPort": 80,
@@ -44,7 +65,7 @@ def get_ip_permissions(myip):
             "FromPort": 22,
             "IpProtocol": "tcp",
             "IpRanges": [
-                {"CidrIp": f"{myip}/32", "Description": "myip"}
+                {"CidrIp": MYIP_CIDR, "Description": "myip"}
             ],
             "Ipv6Ranges": [],
             "PrefixListIds": [],
@@ -54,7 +75,7 @@ def get_ip_permissions(myip):
             "FromPort": 3000,
             "IpProtocol": "tcp",
             "IpRanges": [
-                {"CidrIp": f"{myip}/32", "Description": "myip"}
+                {"CidrIp": MYIP_CIDR, "Description": "myip"}
             ],
             "Ipv6Ranges": [],
             "PrefixListIds": [],
@@ -89,31 +110,369 @@ def get_ip_permissions(myip):
     ]
 
 
-def parser_describe_response(response):
-    reservaitions = response['Reservations']
+def get_ip_permission_template():
+    """
+    :return: The desired ingress rules, with `MYIP_CIDR` standing for the
+             caller's address. Built once per container.
+    """
+    global _ip_permission_template
+    if _ip_permission_template is None:
+        _ip_permission_template = build_ip_permission_template()
+    return _ip_permission_template
+
+
+def get_ip_permissions(myip):
+    """:return: The desired ingress rules of a caller at `myip`."""
+    cidr = MYIP_CIDR.format(myip=myip)
+    return [
+        dict(permission, IpRanges=[
+            dict(ip_range, CidrIp=cidr)
+            if ip_range['CidrIp'] == MYIP_CIDR else ip_range
+            for ip_range in permission['IpRanges']
+        ])
+        for permission in get_ip_permission_template()
+    ]
+
+
+# How every instance field `/ec2/info` can return is extracted from an item
+# of a DescribeInstances response.
+INSTANCE_FIELDS = {
+    'State': lambda instance: instance['State']['Name']
+    if 'State' in instance else None,
+    'PublicIpAddress': lambda instance: instance.get('PublicIpAddress'),
+    'PrivateIpAddress': lambda instance: instance.get('PrivateIpAddress'),
+    'InstanceType': lambda instance: instance.get('InstanceType'),
+    'LaunchTime': lambda instance: instance['LaunchTime'].isoformat()
+    if 'LaunchTime' in instance else None,
+    'SecurityGroups': lambda instance: tuple([
+        sys.intern(security_group['GroupId'])
+        for security_group in instance.get('SecurityGroups', [])
+    ]),
+    'Tags': lambda instance: {
+        tag['Key']: tag['Value'] for tag in instance.get('Tags', [])
+    },
+}
+
+# The fields used by the power operations, and kept in `state_cache`.
+DEFAULT_FIELDS = ('State', 'PublicIpAddress', 'SecurityGroups')
+
+
+def parse_fields(fields):
+    """
+    :param fields: A comma separated list of `INSTANCE_FIELDS` names.
+    :return: The requested field names, `DEFAULT_FIELDS` when none is given.
+    :raises ValueError: When an unknown field is requested.
+    """
+    names = query.unique(
+        name.strip() for name in (fields or '').split(',') if name.strip()
+    )
+    unknown = [name for name in names if name not in INSTANCE_FIELDS]
+    if unknown:
+        raise ValueError('unknown fields: {}'.format(', '.join(unknown)))
+    return tuple(names) or DEFAULT_FIELDS
+
+
+def project(instances, fields):
+    """Keeps only `fields` of every parsed instance info."""
+    layout = records.get_layout(fields)
+    return {
+        instance_id: records.InstanceRecord(
+            layout,
+            tuple([instance_info[field] for field in fields])
+        )
+        for instance_id, instance_info in instances.items()
+    }
+
+
+def parser_describe_response(response, fields=DEFAULT_FIELDS):
+    """
+    :param fields: The `INSTANCE_FIELDS` to extract, the others are skipped.
+    :return: The instance info as `InstanceRecord`s, keyed by interned
+             instance ID.
+    """
+    layout = records.get_layout(fields)
+    extractors = [INSTANCE_FIELDS[field] for field in fields]
+    intern = sys.intern
+    InstanceRecord = records.InstanceRecord
+    inline = tuple(fields) == DEFAULT_FIELDS
 
     ret = dict()
     for reservation in response['Reservations']:
         for instance in reservation['Instances']:
-            instance_info = dict()
-            instance_info.update({
-                'PublicIpAddress': instance['PublicIpAddress']
-                if 'PublicIpAddress' in instance else None
-            })
+            if inline:
+                # Inlined extraction of the fields every power route asks for
+                state = instance.get('State')
+                values = (
+                    state['Name'] if state is not None else None,
+                    instance.get('PublicIpAddress'),
+                    tuple([
+                        intern(security_group['GroupId'])
+                        for security_group in instance.get('SecurityGroups', ())
+                    ])
+                )
+            else:
+                values = tuple([extract(instance) for extract in extractors])
+            ret[intern(instance['InstanceId'])] = InstanceRecord(layout, values)
 
-            sg = []
-            for security_group in instance['SecurityGroups']:
-                sg.append(security_group['GroupId'])
+    return ret
 
-            instance_info.update({
-                'SecurityGroups': sg
-            })
 
-            ret[instance['InstanceId']] = instance_info
+def describe_uncached(instance_ids, region_name):
+    """
+    Describes the instances with `DEFAULT_FIELDS`, following every response
+    page, and caches them in `state_cache`.
+    """
+    described = dict()
+    pages = query.iter_describe_pages(
+        get_ec2_client(region_name),
+        instance_ids=instance_ids
+    )
+    for page in pages:
+        described.update(parser_describe_response(page))
+
+    state_cache.put_many(region_name, described)
+    return described
+
+
+@metrics.timed('App.describe')
+def describe_instance_info(instance_ids, states=None, region_name=None,
+                           fields=DEFAULT_FIELDS):
+    """
+    Describes only the requested instances, following every response page.
+    Instances described recently by this container are served from
+    `state_cache` instead, unless fields outside `DEFAULT_FIELDS` are asked.
+    Instances being described by a concurrent request are waited for
+    instead of described again (see `describe_flights`).
+
+    :param instance_ids: The IDs of the instances to describe.
+    :param states: Only keep instances in one of these states.
+    :param region_name: The region of the instances, defaults to `region`.
+    :param fields: The `INSTANCE_FIELDS` to return.
+    :return: The parsed instance info, keyed by instance ID.
+    """
+    region_name = region_name or region
+    instance_ids = query.unique(instance_ids)
+    if not set(fields) <= set(DEFAULT_FIELDS):
+        ret = dict()
+        pages = query.iter_describe_pages(
+            get_ec2_client(region_name),
+            instance_ids=instance_ids,
+            states=states
+        )
+        for page in pages:
+            ret.update(parser_describe_response(page, fields))
+        return ret
+
+    ret = state_cache.get_many(region_name, instance_ids)
+
+    missing_instance_ids = [i for i in instance_ids if i not in ret]
+    if missing_instance_ids:
+        ret.update(describe_flights.do(
+            region_name,
+            missing_instance_ids,
+            lambda flight_instance_ids: describe_uncached(
+                flight_instance_ids, region_name
+            )
+        ))
+
+    if states:
+        ret = {
+            instance_id: instance_info
+            for instance_id, instance_info in ret.items()
+            if instance_info['State'] in states
+        }
+
+    if tuple(fields) != DEFAULT_FIELDS:
+        ret = project(ret, fields)
 
     return ret
 
 
+def parse_request_targets(body):
+    """
+    Resolves the targets of a power request, see `resolve_targets`.
+
+    :raises ValueError: When the body has neither `instance_ids` nor `tags`,
+                        or when they are invalid.
+    """
+    if not body.get('instance_ids') and not body.get('tags'):
+        raise ValueError('instance_ids or tags is required')
+    try:
+        return resolve_targets(body)
+    except TypeError:
+        raise ValueError('instance_ids must be a list or an object of lists')
+
+
+def get_ec2_client(region_name):
+    """
+    :return: The EC2 client of the region, its calls rate limited and retried
+             by `throttle`.
+    """
+    return throttle.RetryingClient(clients.get_client(region_name), region_name)
+
+
+@metrics.timed('App.parse')
+def parse_event_body(event):
+    """
+    :return: The JSON body of an API Gateway event, which is base64 encoded
+             when the API treats the request as binary.
+    """
+    body = event['body']
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    return json.loads(body)
+
+
+def parse_regions(regions=None):
+    """
+    :param regions: Region names, defaults to `region`.
+    :return: The unique region names.
+    :raises ValueError: When a region is unknown (see
+                        `clients.get_known_regions`).
+    """
+    regions = query.unique(regions or [region])
+    known_regions = clients.get_known_regions()
+    unknown = [region_name for region_name in regions
+               if region_name not in known_regions]
+    if unknown:
+        raise ValueError('unknown regions: ' + ', '.join(map(str, unknown)))
+    return regions
+
+
+def parse_instance_ids(instance_ids):
+    """
+    :return: The unique instance IDs, in their original order.
+    :raises ValueError: When `instance_ids` is not a list of strings.
+    """
+    if not isinstance(instance_ids, list) or \
+            not all(isinstance(i, str) for i in instance_ids):
+        raise ValueError('instance_ids must be a list or an object of lists')
+    return records.intern_ids(query.unique(instance_ids))
+
+
+def parse_region_targets(instance_ids, regions=None):
+    """
+    :param instance_ids: A list of instance IDs, or lists of instance IDs keyed
+                         by region.
+    :param regions: Look the instance ID list up in each of these regions,
+                    defaults to `region`.
+    :return: The instance IDs keyed by region.
+    :raises ValueError: When the instance IDs or the regions are invalid.
+    """
+    if isinstance(instance_ids, dict):
+        parse_regions(list(instance_ids))
+        return {
+            region_name: parse_instance_ids(region_instance_ids)
+            for region_name, region_instance_ids in instance_ids.items()
+            if region_instance_ids
+        }
+
+    if not instance_ids:
+        return dict()
+
+    instance_ids = parse_instance_ids(instance_ids)
+    return {
+        region_name: list(instance_ids)
+        for region_name in parse_regions(regions)
+    }
+
+
+# Regions served at the same time by one request.
+MAX_REGION_WORKERS = int(os.environ.get('EC2_REGION_CONCURRENCY', '8'))
+
+# States of the instances a tag selector can target.
+SELECTABLE_STATES = ('pending', 'running', 'stopping', 'stopped')
+
+
+def resolve_tag_selector(selector, region_name):
+    """
+    Looks up the instances matching a tag selector with server-side `tag:`
+    filters. Results are kept in `tag_index`, and the described instances in
+    `state_cache`, so repeated group operations need no full describe.
+
+    :param selector: A selector returned by `query.parse_tag_selector`.
+    :return: The matching instance IDs.
+    """
+    instance_ids = tag_index.get(region_name, selector)
+    if instance_ids is not None:
+        return instance_ids
+
+    described = dict()
+    pages = query.iter_describe_pages(
+        get_ec2_client(region_name),
+        states=SELECTABLE_STATES,
+        filters=query.build_tag_filters(selector)
+    )
+    for page in pages:
+        described.update(parser_describe_response(page))
+
+    state_cache.put_many(region_name, described)
+    instance_ids = list(described)
+    tag_index.put(region_name, selector, instance_ids)
+    return instance_ids
+
+
+def resolve_targets(body):
+    """
+    Collects the instances targeted by a request body: its `instance_ids`
+    (see `parse_region_targets`) and the instances matching its `tags`
+    selector in every requested region.
+
+    :return: The instance IDs keyed by region, and the errors of the regions
+             in which the selector could not be resolved.
+    """
+    targets = parse_region_targets(body.get('instance_ids'), body.get('regions'))
+    if not body.get('tags'):
+        return targets, dict()
+
+    selector = query.parse_tag_selector(body['tags'])
+    regions = parse_regions(body.get('regions'))
+    resolved, errors = concurrency.map_concurrently(
+        lambda region_name: resolve_tag_selector(selector, region_name),
+        regions,
+        MAX_REGION_WORKERS
+    )
+    for region_name in regions:
+        instance_ids = targets.get(region_name, []) + \
+            resolved.get(region_name, [])
+        if instance_ids:
+            targets[region_name] = query.unique(instance_ids)
+
+    return targets, errors
+
+
+def for_each_region(func, targets):
+    """
+    Runs `func(region_name, instance_ids)` concurrently for every region and
+    merges the results. List values are concatenated and dict values updated,
+    following the order of `targets`.
+    """
+    results, errors = concurrency.map_concurrently(
+        lambda region_name: func(region_name, targets[region_name]),
+        targets.keys(),
+        MAX_REGION_WORKERS
+    )
+
+    ret = dict()
+    for region_name in targets:
+        merge_result(ret, results.get(region_name, {}))
+
+    if errors:
+        ret["region_errors"] = errors
+
+    return ret
+
+
+def merge_result(ret, result):
+    """Concatenates the list values and updates the dict values of `ret`."""
+    for key, value in result.items():
+        if isinstance(value, list):
+            ret.setdefault(key, []).extend(value)
+        else:
+            ret.setdefault(key, {}).update(value)
+    return ret
+
+
 def parser_address_response(response):
     return reduce(
         lambda ret, allocation_id: ret.union(allocation_id),
@@ -137,8 +496,10 @@ def allocate_elastic_ip():
              associated with any instance.
     """
     try:
-        response = ec2.meta.client.allocate_address(Domain='vpc')
-        elastic_ip = ec2.VpcAddress(response['AllocationId'])
+        response = get_ec2_client(region).allocate_address(Domain='vpc')
+        elastic_ip = clients.get_resource(region).VpcAddress(
+            response['AllocationId']
+        )
         # logger.info("Allocated Elastic IP %s.", elastic_ip.public_ip)
     except ClientError:
         # logger.exception("Couldn't allocate Elastic IP.")
@@ -159,7 +520,7 @@ def associate_elastic_ip(allocation_id, instance_id):
     :return: The Elastic IP object.
     """
     try:
-        elastic_ip = ec2.VpcAddress(allocation_id)
+        elastic_ip = clients.get_resource(region).VpcAddress(allocation_id)
         elastic_ip.associate(InstanceId=instance_id)
         # logger.info("Associated Elastic IP %s with instance %s, got association ID %s",
         #             elastic_ip.public_ip, instance_id, elastic_ip.association_id)
@@ -180,7 +541,7 @@ def disassociate_elastic_ip(allocation_id):
                           it was created.
     """
     try:
-        elastic_ip = ec2.VpcAddress(allocation_id)
+        elastic_ip = clients.get_resource(region).VpcAddress(allocation_id)
         elastic_ip.association.delete()
         # logger.info(
         #     "Disassociated Elastic IP %s from its instance.", elastic_ip.public_ip)
@@ -199,7 +560,7 @@ def release_elastic_ip(allocation_id):
                           it was created.
     """
     try:
-        elastic_ip = ec2.VpcAddress(allocation_id)
+        elastic_ip = clients.get_resource(region).VpcAddress(allocation_id)
         elastic_ip.release()
         # logger.info("Released Elastic IP address %s.", allocation_id)
     except ClientError:
@@ -208,137 +569,899 @@ def release_elastic_ip(allocation_id):
         raise
 
 
-@app.route("/ec2/poweron", methods=['POST'])
-def power_on_ec2():
-    context = request.environ.get('serverless.context')
-    event = request.environ.get('serverless.event')
-    body = json.loads(event['body'])
-    instance_ids = body['instance_ids']
-    myip = body['myip'] if 'myip' in body else None
+def power_on_region(region_name, instance_ids, myip=None):
+    response = describe_instance_info(
+        instance_ids,
+        states=['stopped'],
+        region_name=region_name
+    )
+    target_instance_ids = [i for i in instance_ids if i in response]
+    if not target_instance_ids:
+        return {"targets": []}
+
+    client = get_ec2_client(region_name)
+    with metrics.phase('App.power'):
+        state_cache.apply_state_changes(
+            region_name,
+            client.start_instances(
+                InstanceIds=target_instance_ids
+            ).get('StartingInstances', [])
+        )
+
+    started = {region_name: target_instance_ids}
+    if not myip:
+        return {"targets": target_instance_ids, "started": started}
 
     try:
-        if not instance_ids:
-            raise
-
-        response = parser_describe_response(ec2.describe_instances(
-            Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': ['stopped'],
-                }
-            ],
-        ))
+        with metrics.phase('App.security_groups'):
+            security_groups, security_group_errors = security_group.reconcile(
+                client,
+                security_group.collect_group_ids({
+                    instance_id: response[instance_id]
+                    for instance_id in target_instance_ids
+                }),
+                get_ip_permissions(myip)
+            )
+    except Exception as e:
+        # The instances are started anyway, keep reporting them
+        security_groups = dict()
+        security_group_errors = {region_name: concurrency.describe_error(e)}
+
+    return {
+        "targets": target_instance_ids,
+        "started": started,
+        "security_groups": security_groups,
+        "security_group_errors": security_group_errors
+    }
+
 
-        stopped_instance_ids = set(response.keys())
-        target_instance_ids = set(instance_ids)
-        intersection_instance_ids = list(
-            stopped_instance_ids.intersection(target_instance_ids)
+def power_off_region(region_name, instance_ids):
+    response = describe_instance_info(
+        instance_ids,
+        states=['running'],
+        region_name=region_name
+    )
+    target_instance_ids = [i for i in instance_ids if i in response]
+    if not target_instance_ids:
+        return {"targets": []}
+
+    with metrics.phase('App.power'):
+        state_cache.apply_state_changes(
+            region_name,
+            get_ec2_client(region_name).stop_instances(
+                InstanceIds=target_instance_ids
+            ).get('StoppingInstances', [])
         )
 
-        if not intersection_instance_ids:
-            raise
+    return {"targets": target_instance_ids}
 
-        ec2.start_instances(InstanceIds=intersection_instance_ids)
 
-        if not myip:
-            return jsonify({
-                "message": "OK, but doesn't set sg.",
-                "targets": intersection_instance_ids
-            })
+@idempotency_store.idempotent('POST /ec2/poweron')
+@throttle.tracked
+def power_on_event(event, context=None):
+    """
+    Starts the stopped instances listed or selected by `tags` in the API
+    Gateway event body and opens their security groups to `myip`.
 
-        sg_set = set()
-        for instance_id, instance_info in response.items():
-            for sg in instance_info['SecurityGroups']:
-                security_group = ec2_resource.SecurityGroup(sg)
+    :return: The JSON serializable response.
+    """
+    body = parse_event_body(event)
+    myip = body['myip'] if 'myip' in body else None
 
-                if security_group.ip_permissions:
-                    security_group.revoke_ingress(
-                        IpPermissions=security_group.ip_permissions
-                    )
+    try:
+        targets, target_errors = parse_request_targets(body)
+    except ValueError as e:
+        return {
+            "message": str(e),
+            "targets": []
+        }
 
-                security_group.authorize_ingress(
-                    IpPermissions=get_ip_permissions(myip)
-                )
+    response = for_each_region(
+        lambda region_name, instance_ids: power_on_region(
+            region_name, instance_ids, myip
+        ),
+        targets
+    )
+    response.setdefault("targets", [])
+    if target_errors:
+        response.setdefault("region_errors", {}).update(target_errors)
 
-        return jsonify({
-            "message": "OK",
-            "targets": intersection_instance_ids
-        })
-    except Exception:
-        return jsonify({
-            "message": "OK",
+    if response.get("region_errors"):
+        response["message"] = "OK, but failed in some regions."
+    elif not myip:
+        response["message"] = "OK, but doesn't set sg."
+    elif response.get("security_group_errors"):
+        response["message"] = "OK, but failed to set some sg."
+    else:
+        response["message"] = "OK"
+
+    started = response.pop("started", {})
+    if body.get('async') and started:
+        job = jobs.new_job(started, dict(response))
+        job_store.put(job)
+        response["job_id"] = job['job_id']
+
+    return response
+
+
+@idempotency_store.idempotent('POST /ec2/poweroff')
+@throttle.tracked
+def power_off_event(event, context=None):
+    """
+    Stops the running instances listed or selected by `tags` in the API
+    Gateway event body.
+
+    :return: The JSON serializable response.
+    """
+    body = parse_event_body(event)
+
+    try:
+        targets, target_errors = parse_request_targets(body)
+    except ValueError as e:
+        return {
+            "message": str(e),
             "targets": []
-        })
+        }
 
+    response = for_each_region(power_off_region, targets)
+    response.setdefault("targets", [])
+    if target_errors:
+        response.setdefault("region_errors", {}).update(target_errors)
+    response["message"] = "OK, but failed in some regions." \
+        if response.get("region_errors") else "OK"
+
+    return response
 
-@app.route("/ec2/poweroff", methods=['POST'])
-def power_off_ec2():
-    context = request.environ.get('serverless.context')
-    event = request.environ.get('serverless.event')
-    body = json.loads(event['body'])
-    instance_ids = body['instance_ids']
 
+def get_query_params(event):
+    """
+    :return: The query string parameters of an API Gateway event, the values
+             of repeated parameters joined with commas.
+    """
+    params = dict(event.get('queryStringParameters') or {})
+    multi_value_params = event.get('multiValueQueryStringParameters') or {}
+    for name, values in multi_value_params.items():
+        params[name] = ','.join(values)
+    return params
+
+
+def split_param(value):
+    """:return: The non empty items of a comma separated parameter."""
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """:raises ValueError: When the cursor was not made by `encode_cursor`."""
     try:
-        if not instance_ids:
-            raise
-
-        response = ec2.describe_instances(
-            Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': ['running'],
-                }
-            ],
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(position['step']), position.get('token')
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor')
+
+
+def describe_page(regions, instance_ids=None, selector=None,
+                  fields=DEFAULT_FIELDS, limit=None, cursor=None):
+    """
+    Describes one page of the requested instances with a single
+    DescribeInstances call. The pages go through every region, first over the
+    instance ID chunks then over the tag selector, following `NextToken`.
+    Instances matched by both an ID and the selector may appear twice.
+
+    :param limit: The MaxResults of the call (5 - 1000).
+    :param cursor: The `next_cursor` of the previous page.
+    :return: The instance info keyed by instance ID, and the cursor of the next
+             page or None after the last one.
+    """
+    steps = [
+        (region_name, {'instance_ids': id_chunk})
+        for region_name in regions
+        for id_chunk in query.chunked(
+            query.unique(instance_ids or []), query.MAX_FILTER_VALUES
         )
-        running_instance_ids = set(parser_describe_response(response).keys())
-        target_instance_ids = set(instance_ids)
-        intersection_instance_ids = list(
-            running_instance_ids.intersection(target_instance_ids)
+    ]
+    if selector:
+        steps.extend(
+            (region_name, {
+                'states': SELECTABLE_STATES,
+                'filters': query.build_tag_filters(selector)
+            })
+            for region_name in regions
         )
 
-        if not intersection_instance_ids:
-            raise
+    step, next_token = decode_cursor(cursor) if cursor else (0, None)
+    if not 0 <= step < len(steps):
+        raise ValueError('invalid cursor')
+
+    region_name, kwargs = steps[step]
+    page = query.describe_page(
+        get_ec2_client(region_name),
+        page_size=limit,
+        next_token=next_token,
+        **kwargs
+    )
+    ret = parser_describe_response(page, fields)
+    if set(DEFAULT_FIELDS) <= set(fields):
+        state_cache.put_many(region_name, project(ret, DEFAULT_FIELDS))
+
+    if page.get('NextToken'):
+        return ret, encode_cursor({'step': step, 'token': page['NextToken']})
+    if step + 1 < len(steps):
+        return ret, encode_cursor({'step': step + 1})
+    return ret, None
+
 
-        ec2.stop_instances(InstanceIds=intersection_instance_ids)
+# MaxResults accepted by DescribeInstances.
+MIN_PAGE_SIZE = 5
+MAX_PAGE_SIZE = 1000
+
+
+@throttle.tracked
+def describe_event(event, context=None):
+    """
+    Describes the instances given by the API Gateway event query string: comma
+    separated `instance_id`s and / or a `tags` selector, looked up in
+    `regions`. `fields` picks the returned `INSTANCE_FIELDS`. With `limit`
+    or `cursor` the instances are returned a page at a time (see
+    `describe_page`) along with the `next_cursor`.
+
+    :return: The JSON serializable response.
+    """
+    params = get_query_params(event)
+    instance_ids = split_param(params.get('instance_id'))
+    regions = split_param(params.get('regions'))
+
+    try:
+        fields = parse_fields(params.get('fields'))
+        selector = query.parse_tag_selector(params['tags']) \
+            if params.get('tags') else None
+        if not instance_ids and not selector:
+            raise ValueError('instance_id or tags is required')
+
+        if params.get('limit') or params.get('cursor'):
+            limit = min(
+                max(int(params.get('limit') or MAX_PAGE_SIZE), MIN_PAGE_SIZE),
+                MAX_PAGE_SIZE
+            )
+            targets, next_cursor = describe_page(
+                parse_regions(regions),
+                instance_ids,
+                selector,
+                fields,
+                limit,
+                params.get('cursor')
+            )
+            return {
+                "message": "OK",
+                "targets": records.to_json(targets),
+                "next_cursor": next_cursor
+            }
 
-        return jsonify({
-            "message": "OK",
-            "targets": intersection_instance_ids
+        targets, target_errors = resolve_targets({
+            'instance_ids': instance_ids,
+            'regions': regions,
+            'tags': params.get('tags')
         })
-    except Exception:
-        return jsonify({
-            "message": "OK",
-            "targets": []
+    except ValueError as e:
+        return {
+            "message": str(e),
+            "targets": {}
+        }
+
+    response = for_each_region(
+        lambda region_name, region_instance_ids: {
+            "targets": describe_instance_info(
+                region_instance_ids,
+                region_name=region_name,
+                fields=fields
+            )
+        },
+        targets
+    )
+    response["targets"] = records.to_json(response.get("targets", {}))
+    if target_errors:
+        response.setdefault("region_errors", {}).update(target_errors)
+    response["message"] = "OK, but failed in some regions." \
+        if response.get("region_errors") else "OK"
+
+    return response
+
+
+def parse_inventory_params(params):
+    """
+    :param params: The `regions`, `tags`, `fields` and `page_size` query
+                   parameters of an inventory export.
+    :return: The keyword arguments of `iter_inventory`.
+    :raises ValueError: When a parameter is invalid.
+    """
+    page_size = int(params.get('page_size') or MAX_PAGE_SIZE)
+    return {
+        'regions': parse_regions(split_param(params.get('regions'))),
+        'selector': query.parse_tag_selector(params['tags'])
+        if params.get('tags') else None,
+        'fields': parse_fields(params['fields'])
+        if params.get('fields') else tuple(INSTANCE_FIELDS),
+        'page_size': min(max(page_size, MIN_PAGE_SIZE), MAX_PAGE_SIZE),
+    }
+
+
+def iter_inventory(regions, selector=None, fields=tuple(INSTANCE_FIELDS),
+                   page_size=MAX_PAGE_SIZE):
+    """
+    Lazily yields one record per instance of every region, region after
+    region, as the DescribeInstances pages arrive. Only one page is held at a
+    time whatever the size of the account. A region failing midway yields an
+    `error` record and the export goes on with the next region.
+    """
+    extractors = [(field, INSTANCE_FIELDS[field]) for field in fields]
+    filters = query.build_tag_filters(selector) if selector else None
+
+    for region_name in regions:
+        try:
+            instances = query.iter_instances(
+                get_ec2_client(region_name),
+                filters=filters,
+                page_size=page_size
+            )
+            for instance in instances:
+                record = {
+                    'InstanceId': instance['InstanceId'],
+                    'Region': region_name
+                }
+                for field, extract in extractors:
+                    record[field] = extract(instance)
+                yield record
+        except Exception as e:
+            yield {
+                'Region': region_name,
+                'error': concurrency.describe_error(e)
+            }
+
+
+def iter_ndjson(records):
+    """Serializes every record as one line of newline-delimited JSON."""
+    for record in records:
+        yield json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n'
+
+
+BATCH_ACTIONS = ('start', 'stop', 'open_sg')
+
+
+def batch_region(region_name, operations):
+    """
+    Runs the batch operations of one region with a single describe, at most
+    one `start_instances` and one `stop_instances` call.
+
+    :param operations: `(index, operation, instance_ids)` of every operation
+                       targeting the region.
+    :return: The partial result of every operation, keyed by index.
+    """
+    response = describe_instance_info(
+        query.unique(
+            instance_id
+            for _, _, instance_ids in operations
+            for instance_id in instance_ids
+        ),
+        region_name=region_name
+    )
+    client = get_ec2_client(region_name)
+    ret = {index: {"targets": []} for index, _, _ in operations}
+
+    # An instance is only started or stopped by the first operation asking
+    planned = {'start': dict(), 'stop': dict()}
+    required_state = {'start': 'stopped', 'stop': 'running'}
+    for index, operation, instance_ids in operations:
+        action = operation['action']
+        if action not in planned:
+            continue
+        for instance_id in instance_ids:
+            if instance_id in planned['start'] or instance_id in planned['stop']:
+                continue
+            if response.get(instance_id, {}).get('State') == required_state[action]:
+                planned[action][instance_id] = index
+
+    for action, call, state_changes_key in (
+            ('start', client.start_instances, 'StartingInstances'),
+            ('stop', client.stop_instances, 'StoppingInstances')):
+        if not planned[action]:
+            continue
+        try:
+            with metrics.phase('App.power'):
+                state_cache.apply_state_changes(
+                    region_name,
+                    call(
+                        InstanceIds=list(planned[action])
+                    ).get(state_changes_key, [])
+                )
+        except Exception as e:
+            for index in set(planned[action].values()):
+                ret[index]["errors"] = {region_name: concurrency.describe_error(e)}
+            continue
+        for instance_id, index in planned[action].items():
+            ret[index]["targets"].append(instance_id)
+
+    for index, operation, instance_ids in operations:
+        if operation['action'] != 'open_sg':
+            continue
+        targets = {i: response[i] for i in instance_ids if i in response}
+        try:
+            with metrics.phase('App.security_groups'):
+                security_groups, security_group_errors = \
+                    security_group.reconcile(
+                        client,
+                        security_group.collect_group_ids(targets),
+                        get_ip_permissions(operation['myip'])
+                    )
+        except Exception as e:
+            ret[index]["errors"] = {region_name: concurrency.describe_error(e)}
+            continue
+        ret[index].update({
+            "targets": list(targets),
+            "security_groups": security_groups,
+            "security_group_errors": security_group_errors
         })
 
+    return ret
+
+
+@idempotency_store.idempotent('POST /ec2/batch')
+@throttle.tracked
+def batch_event(event, context=None):
+    """
+    Runs a list of start / stop / open_sg operations from the API Gateway event
+    body, grouping the EC2 calls of all operations per region.
+
+    :return: The JSON serializable response, with one result per operation.
+    """
+    body = parse_event_body(event)
+    operations = (body.get('operations') or []) \
+        if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        return {
+            "message": "operations must be a list of objects",
+            "operations": []
+        }
+    results = [
+        {
+            "action": operation.get('action')
+            if isinstance(operation, dict) else None,
+            "targets": []
+        }
+        for operation in operations
+    ]
+
+    plans = dict()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            results[index]["errors"] = {"operation": {
+                "code": "InvalidParameterValue",
+                "message": "operations must be objects"
+            }}
+            continue
+        if operation.get('action') not in BATCH_ACTIONS:
+            results[index]["errors"] = {"operation": {
+                "code": "InvalidAction",
+                "message": "action must be one of {}".format(
+                    ', '.join(BATCH_ACTIONS)
+                )
+            }}
+            continue
+        if operation['action'] == 'open_sg' and not operation.get('myip'):
+            results[index]["errors"] = {"operation": {
+                "code": "MissingParameter",
+                "message": "open_sg requires myip"
+            }}
+            continue
+
+        try:
+            targets, target_errors = resolve_targets(operation)
+        except ValueError as e:
+            results[index]["errors"] = {"operation": {
+                "code": "InvalidParameterValue",
+                "message": str(e)
+            }}
+            continue
+        if target_errors:
+            results[index]["errors"] = target_errors
+        for region_name, instance_ids in targets.items():
+            plans.setdefault(region_name, []).append(
+                (index, operation, instance_ids)
+            )
+
+    region_results, region_errors = concurrency.map_concurrently(
+        lambda region_name: batch_region(region_name, plans[region_name]),
+        plans.keys(),
+        MAX_REGION_WORKERS
+    )
+
+    for region_name, region_operations in plans.items():
+        for index, _, _ in region_operations:
+            if region_name in region_errors:
+                results[index].setdefault("errors", {})[region_name] = \
+                    region_errors[region_name]
+            else:
+                merge_result(results[index], region_results[region_name][index])
+
+    failed = any("errors" in result for result in results)
+    return {
+        "message": "OK, but some operations failed." if failed else "OK",
+        "operations": results
+    }
+
+
+def load_schedule_evaluated_at():
+    """
+    :return: When the schedules were last evaluated by any container, None
+             when unknown.
+    """
+    state = job_store.get(schedule.STATE_ID)
+    return None if state is None else state['evaluated_at']
+
+
+def save_schedule_evaluated_at(now):
+    job_store.put({
+        'job_id': schedule.STATE_ID,
+        'created_at': now,
+        'evaluated_at': now
+    })
+
+
+def get_schedule_index(now):
+    """
+    :return: The schedule index of the container, built again when `now` goes
+             back before its last evaluation, e.g. with synthetic timestamps.
+             Transitions up to the last evaluation of any container are
+             dropped, they were applied already.
+    """
+    global schedule_index
+    if schedule_index is None or now < schedule_index.evaluated_at:
+        schedule_index = schedule.ScheduleIndex(
+            schedule.from_environ(),
+            now - schedule.WINDOW
+        )
+
+    evaluated_at = load_schedule_evaluated_at()
+    if evaluated_at is not None and \
+            schedule_index.evaluated_at < evaluated_at <= now:
+        schedule_index.pop_due(evaluated_at)
+    return schedule_index
+
+
+@throttle.tracked
+def schedule_event(event, context=None):
+    """
+    Applies the power schedule transitions due at the `time` of a periodic
+    EventBridge event, with one describe and at most one `start_instances`
+    and one `stop_instances` call per region (see `batch_region`).
+
+    :return: The JSON serializable response.
+    """
+    now = schedule.parse_timestamp(event['time']) \
+        if event.get('time') else time.time()
+    index = get_schedule_index(now)
+    if not index.schedules:
+        # A plain periodic rule, used to keep the container warm
+        return warm_up(event, context)
+
+    transitions = index.pop_due(now)
+    plan, errors = schedule.plan_transitions(transitions, resolve_targets)
+
+    region_results, region_errors = concurrency.map_concurrently(
+        lambda region_name: batch_region(region_name, [
+            (action, {'action': action}, plan[region_name][action])
+            for action in schedule.ACTIONS
+            if action in plan[region_name]
+        ]),
+        plan.keys(),
+        MAX_REGION_WORKERS
+    )
+
+    response = {
+        "message": "OK",
+        "transitions": [
+            {
+                "schedule": transition_schedule.name,
+                "action": action,
+                "at": schedule.format_timestamp(timestamp)
+            }
+            for timestamp, transition_schedule, action in transitions
+        ],
+        "started": [],
+        "stopped": []
+    }
+    for region_name, results in region_results.items():
+        for action, key in ((schedule.START, "started"),
+                            (schedule.STOP, "stopped")):
+            result = results.get(action, {})
+            response[key].extend(result.get("targets", []))
+            if result.get("errors"):
+                region_errors[region_name] = result["errors"][region_name]
+
+    if region_errors:
+        response["region_errors"] = region_errors
+    if errors:
+        response["schedule_errors"] = errors
+    if region_errors or errors:
+        response["message"] = "OK, but some transitions failed."
+
+    save_schedule_evaluated_at(now)
+    return response
+
+
+@throttle.tracked
+def warm_up(event=None, context=None):
+    """
+    Primes a container on a warm-up event, so that its next request runs at
+    steady-state latency: the EC2 clients of `WARMUP_REGIONS` are built, the
+    credentials resolved, a pooled connection to every region opened with a
+    cheap call, the IP permission template built and the instances of
+    `WARMUP_INSTANCE_IDS` described into `state_cache`. A failing step does
+    not stop the others.
+
+    :return: The duration of every step in milliseconds, and the errors of
+             the steps which failed.
+    """
+    regions = split_param(os.environ.get('WARMUP_REGIONS')) or [region]
+    instance_ids = split_param(os.environ.get('WARMUP_INSTANCE_IDS'))
+    timings = dict()
+    errors = dict()
+
+    def step(name, func):
+        """Times `func`, which returns the errors keyed by region if any."""
+        started = time.perf_counter()
+        try:
+            step_errors = func()
+        except Exception as e:
+            step_errors = concurrency.describe_error(e)
+        timings[name] = round((time.perf_counter() - started) * 1000, 3)
+        if step_errors:
+            errors[name] = step_errors
+
+    def build_clients():
+        for region_name in regions:
+            clients.get_client(region_name)
+
+    def resolve_credentials():
+        if clients.get_credentials() is None:
+            raise ValueError('no AWS credentials found')
+
+    def prebuild_ip_permissions():
+        get_ip_permission_template()
+
+    def open_connections():
+        return concurrency.map_concurrently(
+            lambda region_name: get_ec2_client(region_name).describe_regions(
+                RegionNames=[region_name]
+            ),
+            regions,
+            MAX_REGION_WORKERS
+        )[1]
+
+    def fill_state_cache():
+        return concurrency.map_concurrently(
+            lambda region_name: describe_instance_info(
+                instance_ids,
+                region_name=region_name
+            ),
+            regions if instance_ids else [],
+            MAX_REGION_WORKERS
+        )[1]
+
+    step('clients', build_clients)
+    step('credentials', resolve_credentials)
+    step('connections', open_connections)
+    step('ip_permissions', prebuild_ip_permissions)
+    step('state_cache', fill_state_cache)
+
+    response = {
+        "message": "OK" if not errors else "OK, but some steps failed.",
+        "timings": timings
+    }
+    if errors:
+        response["errors"] = errors
+    print(json.dumps({"warm_up": response}))
+    return response
+
+
+def refresh_job(job, now=None):
+    """
+    Checks the readiness of a pending job once its backoff delay has passed,
+    with one batched `DescribeInstanceStatus` per region. When every instance
+    is running their public IPs are described once more.
+
+    :return: The job, stored again when it was checked.
+    """
+    now = time.time() if now is None else now
+    if job['status'] != jobs.PENDING or now < job['next_check_at']:
+        return job
+
+    statuses = for_each_region(
+        lambda region_name, instance_ids: {
+            "instances": query.describe_instance_status(
+                get_ec2_client(region_name),
+                instance_ids
+            )
+        },
+        job['targets']
+    )
+    job['instances'].update(statuses.get("instances", {}))
+    if statuses.get("region_errors"):
+        job['errors'] = statuses["region_errors"]
+
+    states = [
+        job['instances'].get(instance_id, {}).get('State')
+        for instance_ids in job['targets'].values()
+        for instance_id in instance_ids
+    ]
+    if all(state == 'running' for state in states):
+        # The statuses are fresher than anything cached, drop the latter so
+        # the public IPs are described from EC2.
+        for region_name, instance_ids in job['targets'].items():
+            state_cache.invalidate(region_name, instance_ids)
+        described = for_each_region(
+            lambda region_name, instance_ids: {
+                "instances": describe_instance_info(
+                    instance_ids,
+                    region_name=region_name
+                )
+            },
+            job['targets']
+        )
+        for instance_id, instance_info in described.get("instances", {}).items():
+            job['instances'][instance_id]['PublicIpAddress'] = \
+                instance_info['PublicIpAddress']
+        job['status'] = jobs.DONE
+    elif any(state in ('stopping', 'stopped', 'shutting-down', 'terminated')
+             for state in states):
+        job['status'] = jobs.FAILED
+
+    job_store.put(jobs.schedule_next_check(job, now))
+    return job
+
+
+def describe_job(job_id, now=None):
+    """
+    :return: The JSON serializable progress of a job, or None when there is
+             no such job.
+    """
+    if not jobs.is_job_id(job_id):
+        return None
+
+    now = time.time() if now is None else now
+    job = job_store.get(job_id)
+    if job is None:
+        return None
+
+    job = refresh_job(job, now)
+    return {
+        "message": "OK",
+        "job_id": job['job_id'],
+        "status": job['status'],
+        "targets": job['targets'],
+        "instances": job['instances'],
+        "errors": job.get('errors', {}),
+        "result": job['result'],
+        "next_check_in": max(0, round(job['next_check_at'] - now, 1))
+        if job['status'] == jobs.PENDING else None
+    }
+
+
+@app.before_request
+def start_route_timer():
+    g.route_started = time.perf_counter()
+    # Outside Lambda (`serve.py`), `Server-Timing` has to start recording
+    g.metrics_token = metrics.begin()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Lists the phases of the request so far, when `SERVER_TIMING` is set."""
+    server_timing = metrics.server_timing()
+    if server_timing:
+        response.headers.add('Server-Timing', server_timing)
+    return response
+
+
+@app.teardown_request
+def record_route_latency(exception=None):
+    """Records the route latency for the EMF metrics of the invocation."""
+    if request.url_rule is not None and 'route_started' in g:
+        metrics.record_route(
+            '{} {}'.format(request.method, request.url_rule.rule),
+            time.perf_counter() - g.route_started
+        )
+    metrics.end(g.pop('metrics_token', None))
+
+
+def get_request_event():
+    """
+    :return: The API Gateway event of the request, or one built from its body
+             and headers when served outside Lambda, e.g. by `serve.py`.
+    """
+    event = request.environ.get('serverless.event')
+    if event is not None:
+        return event
+    return {
+        'body': request.get_data(as_text=True),
+        'headers': dict(request.headers),
+        'isBase64Encoded': False
+    }
+
+
+@app.route("/ec2/poweron", methods=['POST'])
+def power_on_ec2():
+    context = request.environ.get('serverless.context')
+    event = get_request_event()
+    return jsonify(power_on_event(event, context))
+
+
+@app.route("/ec2/poweroff", methods=['POST'])
+def power_off_ec2():
+    context = request.environ.get('serverless.context')
+    event = get_request_event()
+    return jsonify(power_off_event(event, context))
+
 
 @app.route("/ec2/info", methods=['GET'])
 def describe_ec2():
     context = request.environ.get('serverless.context')
-    event = request.environ.get('serverless.event')
-    instance_id = event['queryStringParameters']['instance_id'] \
-        if 'instance_id' in event['queryStringParameters'] else ""
+    event = {
+        'queryStringParameters': {
+            name: ','.join(request.args.getlist(name)) for name in request.args
+        }
+    }
+    return jsonify(describe_event(event, context))
+
 
+@app.route("/ec2/inventory", methods=['GET'])
+def inventory_ec2():
     try:
-        if not instance_id:
-            raise
+        options = parse_inventory_params(request.args)
+    except ValueError as e:
+        return make_response(jsonify({"message": str(e)}), 400)
 
-        response = ec2.describe_instances(
-            InstanceIds=[instance_id]
-        )
-        describe_list = parser_describe_response(response)
+    return Response(
+        stream_with_context(iter_ndjson(iter_inventory(**options))),
+        mimetype='application/x-ndjson'
+    )
 
-        return jsonify({
-            "message": "OK",
-            "targets": describe_list,
-            # "detail": response
-        })
-    except Exception:
-        return jsonify({
-            "message": "OK"
-        })
+
+@app.route("/ec2/batch", methods=['POST'])
+def batch_ec2():
+    context = request.environ.get('serverless.context')
+    event = get_request_event()
+    return jsonify(batch_event(event, context))
+
+
+@app.route("/ec2/jobs/<job_id>", methods=['GET'])
+def describe_job_ec2(job_id):
+    response = describe_job(job_id)
+    if response is None:
+        return make_response(jsonify(error='Not found!'), 404)
+    return jsonify(response)
 
 
 @app.errorhandler(404)
 def resource_not_found(e):
     return make_response(jsonify(error='Not found!'), 404)
+
+
+# Routes served straight from the Lambda event by `wsgi_handler`, without the
+# WSGI translation, when `WSGI_NATIVE_ROUTER` is enabled.
+app.extensions['serverless_wsgi'] = {
+    'native_routes': {
+        ('POST', '/ec2/poweron'): power_on_event,
+        ('POST', '/ec2/poweroff'): power_off_event,
+        ('GET', '/ec2/info'): describe_event,
+        ('POST', '/ec2/batch'): batch_event,
+    },
+    'event_sources': {
+        'aws.events': schedule_event,
+    },
+    'warmup': warm_up,
+}
@@ -0,0 +1,177 @@
+"""
+In-memory caches that survive between invocations of a warm Lambda container.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Instance states which will not change without another API call. Transitional
+# states (pending, stopping, ...) are never cached.
+STABLE_STATES = ('running', 'stopped', 'terminated')
+
+
+class TTLCache(object):
+    """
+    A thread-safe mapping whose entries expire after `ttl` seconds. Once more
+    than `maxsize` entries are stored, the least recently used one is evicted.
+    """
+
+    def __init__(self, ttl, maxsize, timer=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            expires_at, value = item
+            if expires_at <= self.timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (self.timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value):
+        """
+        Sets `key` unless it holds a live entry already.
+
+        :return: True when `value` was set.
+        """
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return False
+
+        with self._lock:
+            now = self.timer()
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                return False
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class InstanceStateCache(object):
+    """
+    Caches parsed instance info (see `parser_describe_response`) keyed by
+    region and instance ID.
+    """
+
+    def __init__(self, ttl, maxsize, timer=time.monotonic):
+        self._cache = TTLCache(ttl, maxsize, timer=timer)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get_many(self, region, instance_ids):
+        ret = dict()
+        for instance_id in instance_ids:
+            instance_info = self._cache.get((region, instance_id))
+            if instance_info is not None:
+                ret[instance_id] = instance_info
+        return ret
+
+    def put_many(self, region, instances):
+        for instance_id, instance_info in instances.items():
+            if instance_info.get('State') in STABLE_STATES:
+                self._cache.set((region, instance_id), instance_info)
+            else:
+                self._cache.pop((region, instance_id))
+
+    def invalidate(self, region, instance_ids):
+        for instance_id in instance_ids:
+            self._cache.pop((region, instance_id))
+
+    def apply_state_changes(self, region, state_changes):
+        """
+        Writes through the `StartingInstances` / `StoppingInstances` items
+        returned by `start_instances` and `stop_instances`.
+        """
+        for state_change in state_changes:
+            key = (region, state_change['InstanceId'])
+            state = state_change['CurrentState']['Name']
+            instance_info = self._cache.pop(key)
+            if instance_info is not None and state in STABLE_STATES:
+                instance_info = instance_info.replace(State=state) \
+                    if hasattr(instance_info, 'replace') \
+                    else dict(instance_info, State=state)
+                self._cache.set(key, instance_info)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class TagIndex(object):
+    """
+    Caches the IDs of the instances matching a tag selector (see
+    `query.parse_tag_selector`) keyed by region and selector, so repeated
+    group operations skip the tag-filtered describe.
+    """
+
+    def __init__(self, ttl, maxsize, timer=time.monotonic):
+        self._cache = TTLCache(ttl, maxsize, timer=timer)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, region, selector):
+        instance_ids = self._cache.get((region, selector))
+        return None if instance_ids is None else list(instance_ids)
+
+    def put(self, region, selector, instance_ids):
+        self._cache.set((region, selector), tuple(instance_ids))
+
+    def clear(self):
+        self._cache.clear()
+
+
+def from_environ(environ=os.environ):
+    """
+    Builds the instance state cache configured by `EC2_STATE_CACHE_TTL`
+    (seconds, 0 disables the cache) and `EC2_STATE_CACHE_SIZE`.
+    """
+    return InstanceStateCache(
+        ttl=float(environ.get('EC2_STATE_CACHE_TTL', '5')),
+        maxsize=int(environ.get('EC2_STATE_CACHE_SIZE', '1024'))
+    )
+
+
+def tag_index_from_environ(environ=os.environ):
+    """
+    Builds the tag index configured by `EC2_TAG_INDEX_TTL` (seconds, 0
+    disables the index) and `EC2_TAG_INDEX_SIZE`.
+    """
+    return TagIndex(
+        ttl=float(environ.get('EC2_TAG_INDEX_TTL', '60')),
+        maxsize=int(environ.get('EC2_TAG_INDEX_SIZE', '256'))
+    )
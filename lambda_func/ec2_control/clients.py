@@ -0,0 +1,167 @@
+"""
+Lazy per-region EC2 client registry.
+
+Nothing is built at import time: boto3 itself is imported, and each client is
+created, on first use and then cached for the lifetime of the container. Every
+client comes from one boto3 session, created under the registry lock because
+sessions are not thread-safe. Clients are, so one client per region is shared
+by every worker thread, e.g. of the threaded `serve.py` server. Resources are
+only built for the few helpers which still need them, because loading the
+resource model is a noticeable part of a cold start. They are not
+thread-safe and are kept per thread.
+
+The connection pool, timeouts, TCP keep-alive and botocore retries of the
+clients are read from the environment (see `get_config`) when the first
+client is created. botocore does not retry calls by default,
+`throttle.RetryingClient` does. Every call is timed for the EMF metrics of the
+invocation (see the top-level `metrics` module).
+"""
+import os
+import threading
+
+import flags
+import metrics
+
+_clients = dict()
+_resources = threading.local()
+_lock = threading.Lock()
+_session = None
+_known_regions = None
+
+
+def get_config_options(environ=os.environ):
+    """
+    :return: The botocore `Config` options set by `EC2_MAX_POOL_CONNECTIONS`,
+             `EC2_CONNECT_TIMEOUT`, `EC2_READ_TIMEOUT`, `EC2_TCP_KEEPALIVE`,
+             `EC2_RETRY_MODE` and `EC2_BOTOCORE_MAX_ATTEMPTS`.
+    """
+    return {
+        'max_pool_connections': int(
+            environ.get('EC2_MAX_POOL_CONNECTIONS', '32')
+        ),
+        'connect_timeout': float(environ.get('EC2_CONNECT_TIMEOUT', '5')),
+        'read_timeout': float(environ.get('EC2_READ_TIMEOUT', '60')),
+        'tcp_keepalive': flags.is_set('EC2_TCP_KEEPALIVE', 'true', environ),
+        'retries': {
+            'mode': environ.get('EC2_RETRY_MODE', 'standard'),
+            'total_max_attempts': int(
+                environ.get('EC2_BOTOCORE_MAX_ATTEMPTS', '1')
+            ),
+        },
+    }
+
+
+def get_config(environ=os.environ):
+    """:return: The botocore `Config` of the clients, see `get_config_options`."""
+    from botocore.config import Config
+
+    options = get_config_options(environ)
+    if 'tcp_keepalive' not in Config.OPTION_DEFAULTS:
+        # Older botocore releases, as bundled with some Lambda runtimes
+        del options['tcp_keepalive']
+    return Config(**options)
+
+
+def _get_session():
+    """Must be called with `_lock` held."""
+    global _session
+    if _session is None:
+        import boto3
+
+        _session = boto3.session.Session()
+    return _session
+
+
+def _create_client(region_name):
+    return metrics.instrument_client(_get_session().client(
+        'ec2',
+        region_name=region_name,
+        endpoint_url=os.environ.get('EC2_ENDPOINT_URL') or None,
+        config=get_config()
+    ))
+
+
+def _create_resource(region_name):
+    return _get_session().resource(
+        'ec2',
+        region_name=region_name,
+        endpoint_url=os.environ.get('EC2_ENDPOINT_URL') or None
+    )
+
+
+def _get_or_create(registry, region_name, factory):
+    instance = registry.get(region_name)
+    if instance is None:
+        with _lock:
+            instance = registry.get(region_name)
+            if instance is None:
+                instance = factory(region_name)
+                registry[region_name] = instance
+    return instance
+
+
+def get_client(region_name):
+    """
+    :param region_name: The AWS region, e.g. `us-east-1`.
+    :return: The cached EC2 client of the region.
+    """
+    return _get_or_create(_clients, region_name, _create_client)
+
+
+def get_resource(region_name):
+    """
+    :param region_name: The AWS region, e.g. `us-east-1`.
+    :return: The EC2 service resource of the region, cached per thread.
+    """
+    if not hasattr(_resources, 'registry'):
+        _resources.registry = dict()
+    return _get_or_create(_resources.registry, region_name, _create_resource)
+
+
+def get_known_regions(environ=os.environ):
+    """
+    :return: The regions clients may be created for: `EC2_ALLOWED_REGIONS` when
+             set, else every EC2 region of botocore's endpoint data.
+    """
+    global _known_regions
+    allowed = [
+        region_name.strip()
+        for region_name in environ.get('EC2_ALLOWED_REGIONS', '').split(',')
+        if region_name.strip()
+    ]
+    if allowed:
+        return frozenset(allowed)
+
+    if _known_regions is None:
+        with _lock:
+            session = _get_session()
+            _known_regions = frozenset(
+                region_name
+                for partition in session.get_available_partitions()
+                for region_name in session.get_available_regions(
+                    'ec2', partition_name=partition
+                )
+            )
+    return _known_regions
+
+
+def get_credentials():
+    """
+    Resolves the credentials of the session, e.g. when a container is warmed
+    up, so the first signed request does not wait for them.
+
+    :return: Frozen credentials, None when none could be found.
+    """
+    with _lock:
+        credentials = _get_session().get_credentials()
+    return None if credentials is None else credentials.get_frozen_credentials()
+
+
+def reset():
+    """Drops the session and the clients, e.g. after the configuration changed."""
+    global _session, _known_regions
+    with _lock:
+        _clients.clear()
+        _resources.__dict__.clear()
+        _session = None
+        _known_regions = None
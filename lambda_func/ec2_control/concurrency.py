@@ -0,0 +1,112 @@
+"""
+Helpers to run independent EC2 calls on a bounded thread pool.
+"""
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+
+def describe_error(error):
+    """Converts an exception into a JSON serializable error description."""
+    if isinstance(error, ClientError):
+        return {
+            'code': error.response.get('Error', {}).get('Code', ''),
+            'message': error.response.get('Error', {}).get('Message', str(error)),
+        }
+    return {
+        'code': type(error).__name__,
+        'message': str(error),
+    }
+
+
+def map_concurrently(func, items, max_workers):
+    """
+    Calls `func(item)` for every item with at most `max_workers` calls in flight.
+    Every call runs in a copy of the caller's context variables.
+
+    :return: The results keyed by item and the errors (see `describe_error`)
+             keyed by item. A failing item never cancels the others.
+    """
+    items = list(items)
+    results = dict()
+    errors = dict()
+
+    def call(item):
+        try:
+            results[item] = func(item)
+        except Exception as e:
+            errors[item] = describe_error(e)
+
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            call(item)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, call, item)
+                for item in items
+            ]
+            for future in futures:
+                future.result()
+
+    return results, errors
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for overlapping keys: a caller only calls for
+    the keys no other call is fetching yet, and waits for the calls in flight
+    for the rest. Every caller gets the results of its own keys.
+    """
+
+    def __init__(self):
+        self._flights = dict()
+        self._lock = threading.Lock()
+        # Number of calls which waited for another call, for all or part of
+        # their keys.
+        self.coalesced = 0
+
+    def do(self, scope, keys, func):
+        """
+        :param scope: Keys only match keys of the same scope, e.g. a region.
+        :param keys: The hashable keys the caller needs.
+        :param func: `func(keys)` fetches the given keys, and returns the
+                     results keyed by key. Keys without a result are left out.
+        :return: The results of `keys`, keyed by key.
+        :raises: The exception of any call the keys depend on.
+        """
+        flight = Future()
+        own_keys = []
+        joined = dict()
+        with self._lock:
+            for key in keys:
+                other = self._flights.get((scope, key))
+                if other is None:
+                    self._flights[(scope, key)] = flight
+                    own_keys.append(key)
+                else:
+                    joined.setdefault(other, []).append(key)
+            if joined:
+                self.coalesced += 1
+
+        ret = dict()
+        if own_keys:
+            try:
+                result = func(own_keys)
+            except BaseException as e:
+                flight.set_exception(e)
+                raise
+            else:
+                flight.set_result(result)
+            finally:
+                with self._lock:
+                    for key in own_keys:
+                        del self._flights[(scope, key)]
+            ret.update(result)
+
+        for other, other_keys in joined.items():
+            result = other.result()
+            ret.update((key, result[key]) for key in other_keys if key in result)
+        return ret
@@ -0,0 +1,294 @@
+"""
+Idempotent power requests.
+
+Clients retry `/ec2/poweron` and friends on timeouts, and every copy used to
+describe, start and reconcile security groups again. A request carrying an
+`Idempotency-Key` header is now answered with the stored response of the
+first request with the same key, route, caller and body, for `IDEMPOTENCY_TTL`
+seconds, without any EC2 call. Requests without the header are only matched
+by their body when `IDEMPOTENCY_BODY_HASH` is set, since the same body may
+well be sent again on purpose, e.g. poweroff, poweron, poweroff.
+
+Responses are kept in a bounded in-memory LRU, in front of an optional shared
+backend selected with `IDEMPOTENCY_STORE`, so that a retry landing on another
+container is matched too:
+
+- `memory` keeps responses in the container only (default),
+- `sqlite:<path>` shares them through a SQLite file (default for `serve.py`).
+
+The key is reserved before the first request is handled, so duplicates
+arriving meanwhile wait up to `IDEMPOTENCY_WAIT` seconds for its response
+instead of calling EC2 again, and are answered with a 409 Conflict past that.
+A reservation is dropped when the request fails, or after
+`IDEMPOTENCY_LOCK_TTL` seconds should its container die.
+"""
+import base64
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from werkzeug.exceptions import Conflict
+
+import flags
+
+from .cache import TTLCache
+
+HEADER = 'idempotency-key'
+
+# Stored for a key while its first request is being handled.
+IN_PROGRESS = 'in-progress'
+
+
+def get_header(event, name):
+    """:return: The value of header `name` of an API Gateway event, or None."""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    for key, values in (event.get('multiValueHeaders') or {}).items():
+        if key.lower() == name and values:
+            return values[0]
+    return None
+
+
+def get_principal(event):
+    """:return: The Cognito user of the request, if the API has an authorizer."""
+    claims = ((event.get('requestContext') or {}).get('authorizer') or {}) \
+        .get('claims') or {}
+    return claims.get('sub') or claims.get('cognito:username')
+
+
+def canonical_body(event):
+    """:return: The request body, with JSON bodies in a canonical form."""
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8', 'replace')
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        return body
+
+
+def is_final(response):
+    """
+    :return: False for responses reporting failed EC2 calls or regions, which
+             a retry may well get past.
+    """
+    return not response.get('region_errors') and \
+        not response.get('ec2_calls', {}).get('failed')
+
+
+class SQLiteBackend(object):
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                'expires_at REAL NOT NULL)'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        with self._lock, self._connect() as connection:
+            row = connection.execute(
+                'SELECT response FROM responses WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key, response):
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'DELETE FROM responses WHERE expires_at <= ?', (now,)
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, response, expires_at) '
+                'VALUES (?, ?, ?)',
+                (key, response, now + self.ttl)
+            )
+
+    def reserve(self, key, ttl):
+        """:return: True when `key` was free and is now reserved for `ttl`."""
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'DELETE FROM responses WHERE expires_at <= ?', (now,)
+            )
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO responses (key, response, expires_at) '
+                'VALUES (?, ?, ?)',
+                (key, IN_PROGRESS, now + ttl)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'DELETE FROM responses WHERE key = ? AND response = ?',
+                (key, IN_PROGRESS)
+            )
+
+
+class IdempotencyStore(object):
+    """
+    Stored responses keyed by request, in a `TTLCache` in front of an optional
+    shared `backend` with the same `get` / `set` / `reserve` / `release`
+    interface.
+    """
+
+    def __init__(self, ttl, maxsize, backend=None, hash_bodies=False,
+                 lock_ttl=30, wait=5, poll_interval=0.05):
+        """
+        :param lock_ttl: Seconds a reservation is kept in `backend`.
+        :param wait: Seconds a duplicate waits for the response of the request
+                     being handled.
+        """
+        self.ttl = ttl
+        self.hash_bodies = hash_bodies
+        self.backend = backend
+        self.lock_ttl = lock_ttl
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self._cache = TTLCache(ttl, maxsize)
+
+    def request_key(self, route, event):
+        """
+        :return: The key identifying `event` on `route`, None when the request
+                 is not idempotent.
+        """
+        idempotency_key = get_header(event, HEADER)
+        if not idempotency_key and not self.hash_bodies:
+            return None
+        return hashlib.sha256(json.dumps([
+            route,
+            get_principal(event),
+            idempotency_key,
+            canonical_body(event),
+        ]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: The stored response, `IN_PROGRESS` while the first request is
+                 being handled, or None.
+        """
+        response = self._cache.get(key)
+        if response in (None, IN_PROGRESS) and self.backend is not None:
+            stored = self.backend.get(key)
+            if stored not in (None, IN_PROGRESS):
+                self._cache.set(key, stored)
+            response = stored or response
+        if response in (None, IN_PROGRESS):
+            return response
+        return json.loads(response)
+
+    def reserve(self, key):
+        """:return: True when the caller is to handle the request of `key`."""
+        if self._cache.maxsize > 0 and not self._cache.add(key, IN_PROGRESS):
+            return False
+        if self.backend is not None and \
+                not self.backend.reserve(key, self.lock_ttl):
+            self._cache.pop(key)
+            return False
+        return True
+
+    def release(self, key):
+        """Drops the reservation of `key`, so that a retry handles it again."""
+        if self._cache.get(key) == IN_PROGRESS:
+            self._cache.pop(key)
+        if self.backend is not None:
+            self.backend.release(key)
+
+    def put(self, key, response):
+        if self.ttl <= 0:
+            return
+        response = json.dumps(response)
+        self._cache.set(key, response)
+        if self.backend is not None:
+            self.backend.set(key, response)
+
+    def clear(self):
+        self._cache.clear()
+
+    def idempotent(self, route):
+        """
+        Answers duplicates of the requests handled by an event handler
+        `func(event, context)` with the response stored for the first one,
+        waiting for it while the first one is being handled.
+
+        :param route: The route of the handler, e.g. `POST /ec2/poweron`.
+        :raises Conflict: When the first request is still being handled after
+                          `wait` seconds.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(event, context=None):
+                key = self.request_key(route, event or {})
+                if key is None or self.ttl <= 0:
+                    return func(event, context)
+
+                deadline = time.monotonic() + self.wait
+                while True:
+                    response = self.get(key)
+                    if response is None:
+                        if self.reserve(key):
+                            break
+                    elif response != IN_PROGRESS:
+                        return response
+                    elif time.monotonic() >= deadline:
+                        raise Conflict(
+                            'A request with the same Idempotency-Key is '
+                            'still in progress.'
+                        )
+                    else:
+                        time.sleep(self.poll_interval)
+
+                try:
+                    response = func(event, context)
+                except Exception:
+                    self.release(key)
+                    raise
+                if is_final(response):
+                    self.put(key, response)
+                else:
+                    self.release(key)
+                return response
+
+            return wrapper
+
+        return decorator
+
+
+def from_environ(environ=os.environ):
+    """
+    Builds the store configured by `IDEMPOTENCY_TTL` (seconds, 0 disables it),
+    `IDEMPOTENCY_CACHE_SIZE`, `IDEMPOTENCY_STORE`, `IDEMPOTENCY_BODY_HASH`,
+    `IDEMPOTENCY_LOCK_TTL` and `IDEMPOTENCY_WAIT`.
+    """
+    ttl = float(environ.get('IDEMPOTENCY_TTL', '300'))
+    default = 'memory'
+    if environ.get('IS_OFFLINE'):
+        default = 'sqlite:' + os.path.join(
+            tempfile.gettempdir(), 'ec2_power_switcher_idempotency.sqlite3'
+        )
+
+    kind, _, location = environ.get('IDEMPOTENCY_STORE', default).partition(':')
+    backend = SQLiteBackend(location, ttl) if kind == 'sqlite' else None
+    return IdempotencyStore(
+        ttl=ttl,
+        maxsize=int(environ.get('IDEMPOTENCY_CACHE_SIZE', '1024')),
+        backend=backend,
+        hash_bodies=flags.is_set('IDEMPOTENCY_BODY_HASH', '', environ),
+        lock_ttl=float(environ.get('IDEMPOTENCY_LOCK_TTL', '30')),
+        wait=float(environ.get('IDEMPOTENCY_WAIT', '5'))
+    )
@@ -0,0 +1,45 @@
+"""
+Exports the instance inventory as newline-delimited JSON, one instance per
+line, with the same options as `GET /ec2/inventory`:
+
+    python -m ec2_control.inventory --regions us-east-1,eu-west-1 \
+        --tags env=staging --fields State,InstanceType > inventory.ndjson
+"""
+import argparse
+import sys
+
+from . import api
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="EC2 inventory export")
+    parser.add_argument(
+        "--regions", help="Comma separated regions, defaults to AWS_REGION"
+    )
+    parser.add_argument("--tags", help="Tag selector, e.g. env=staging,team=data")
+    parser.add_argument("--fields", help="Comma separated fields, defaults to all")
+    parser.add_argument(
+        "--page-size", type=int, help="Instances per DescribeInstances call"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None, stream=None):
+    stream = stream or sys.stdout
+    args = parse_args(argv)
+    try:
+        options = api.parse_inventory_params({
+            'regions': args.regions,
+            'tags': args.tags,
+            'fields': args.fields,
+            'page_size': args.page_size,
+        })
+    except ValueError as e:
+        sys.exit("inventory: {}".format(e))
+
+    for line in api.iter_ndjson(api.iter_inventory(**options)):
+        stream.write(line)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
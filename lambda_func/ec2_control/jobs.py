@@ -0,0 +1,169 @@
+"""
+Asynchronous power-on jobs.
+
+A job remembers the instances started by one `/ec2/poweron` request so their
+readiness can be polled with one batched call per job instead of one
+`/ec2/info` call per instance. Jobs are kept in a pluggable store, selected
+with `JOB_STORE`:
+
+- `memory` keeps jobs in the container (default),
+- `sqlite:<path>` keeps them in a SQLite file (default for `serve.py`),
+- `dynamodb:<table>` keeps them in the DynamoDB table of the stack.
+"""
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import metrics
+
+from .cache import TTLCache
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds between two readiness checks of a job, doubling up to the maximum.
+MIN_POLL_INTERVAL = float(os.environ.get('JOB_MIN_POLL_INTERVAL', '2'))
+MAX_POLL_INTERVAL = float(os.environ.get('JOB_MAX_POLL_INTERVAL', '30'))
+
+# Seconds a job is kept after its creation.
+JOB_TTL = int(os.environ.get('JOB_TTL', '86400'))
+
+# IDs given by `new_job`. Other records of the store, e.g. the schedule state,
+# are not jobs.
+JOB_ID_PATTERN = re.compile('[0-9a-f]{32}')
+
+
+def is_job_id(job_id):
+    return JOB_ID_PATTERN.fullmatch(job_id) is not None
+
+
+def new_job(targets, result, now=None):
+    """
+    :param targets: The started instance IDs keyed by region.
+    :param result: The response of the power-on request.
+    """
+    now = time.time() if now is None else now
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': PENDING,
+        'created_at': now,
+        'updated_at': now,
+        'next_check_at': now + MIN_POLL_INTERVAL,
+        'poll_interval': MIN_POLL_INTERVAL,
+        'targets': targets,
+        'instances': dict(),
+        'result': result,
+    }
+
+
+def schedule_next_check(job, now):
+    """Backs the next readiness check of `job` off exponentially."""
+    job['updated_at'] = now
+    job['poll_interval'] = min(job['poll_interval'] * 2, MAX_POLL_INTERVAL)
+    job['next_check_at'] = now + job['poll_interval']
+    return job
+
+
+class MemoryJobStore(object):
+    def __init__(self, ttl=JOB_TTL, maxsize=1024):
+        self._jobs = TTLCache(ttl, maxsize)
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        return None if job is None else json.loads(job)
+
+    def put(self, job):
+        self._jobs.set(job['job_id'], json.dumps(job))
+
+
+class SQLiteJobStore(object):
+    def __init__(self, path, ttl=JOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, job TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, job_id):
+        with self._lock, self._connect() as connection:
+            row = connection.execute(
+                'SELECT job FROM jobs WHERE job_id = ? AND expires_at > ?',
+                (job_id, time.time())
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, job):
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'DELETE FROM jobs WHERE expires_at <= ?', (time.time(),)
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, job, expires_at) '
+                'VALUES (?, ?, ?)',
+                (job['job_id'], json.dumps(job), job['created_at'] + self.ttl)
+            )
+
+
+class DynamoDBJobStore(object):
+    """Expects a table keyed by `job_id` with TTL on the `expires_at` attribute."""
+
+    def __init__(self, table_name, ttl=JOB_TTL):
+        self.table_name = table_name
+        self.ttl = ttl
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+
+            self._client = metrics.instrument_client(boto3.client('dynamodb'))
+        return self._client
+
+    def get(self, job_id):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'job_id': {'S': job_id}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None or float(item['expires_at']['N']) <= time.time():
+            return None
+        return json.loads(item['job']['S'])
+
+    def put(self, job):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'job_id': {'S': job['job_id']},
+                'job': {'S': json.dumps(job)},
+                'expires_at': {'N': str(int(job['created_at'] + self.ttl))},
+            }
+        )
+
+
+def from_environ(environ=os.environ):
+    """Builds the job store configured by `JOB_STORE`."""
+    default = 'memory'
+    if environ.get('IS_OFFLINE'):
+        default = 'sqlite:' + os.path.join(
+            tempfile.gettempdir(), 'ec2_power_switcher_jobs.sqlite3'
+        )
+
+    kind, _, location = environ.get('JOB_STORE', default).partition(':')
+    if kind == 'sqlite':
+        return SQLiteJobStore(location)
+    if kind == 'dynamodb':
+        return DynamoDBJobStore(location)
+    return MemoryJobStore()
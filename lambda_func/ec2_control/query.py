@@ -0,0 +1,175 @@
+"""
+Targeted DescribeInstances queries.
+
+The requested instance IDs and states are pushed to EC2 as server-side filters,
+so the cost of a lookup depends on the size of the request instead of the size
+of the account. Responses are followed page by page through `NextToken`.
+"""
+
+# DescribeInstances accepts at most 200 values per filter.
+MAX_FILTER_VALUES = 200
+
+
+def unique(values):
+    """Drop duplicated values while keeping the original order."""
+    return list(dict.fromkeys(values))
+
+
+def chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def build_filters(instance_ids=None, states=None, filters=None):
+    ret = []
+    if instance_ids:
+        ret.append({'Name': 'instance-id', 'Values': list(instance_ids)})
+    if states:
+        ret.append({'Name': 'instance-state-name', 'Values': list(states)})
+    if filters:
+        ret.extend(filters)
+    return ret
+
+
+def parse_tag_selector(selector):
+    """
+    Normalizes a tag selector into a hashable, ordered tuple of
+    `(key, values)` pairs. An instance matches when, for every key, its tag
+    has one of the values.
+
+    :param selector: Either a `key=value,key=value` string, where repeating a
+                     key adds an alternative value, or a dict mapping keys to a
+                     value or a list of values.
+    :raises ValueError: When the selector is empty or malformed.
+    """
+    values = dict()
+    if isinstance(selector, dict):
+        for key, value in selector.items():
+            if isinstance(value, (list, tuple)):
+                values.setdefault(key, set()).update(value)
+            else:
+                values.setdefault(key, set()).add(value)
+    else:
+        for term in str(selector).split(','):
+            if not term.strip():
+                continue
+            key, sep, value = term.partition('=')
+            if not sep:
+                raise ValueError('tag selector terms must be key=value')
+            values.setdefault(key.strip(), set()).add(value.strip())
+
+    if not values or not all(key and values[key] for key in values):
+        raise ValueError('tag selector is empty')
+
+    return tuple(
+        (key, tuple(sorted(str(value) for value in values[key])))
+        for key in sorted(values)
+    )
+
+
+def build_tag_filters(selector):
+    """:param selector: A selector returned by `parse_tag_selector`."""
+    return [
+        {'Name': 'tag:' + key, 'Values': list(values)}
+        for key, values in selector
+    ]
+
+
+def describe_page(client, instance_ids=None, states=None, filters=None,
+                  page_size=None, next_token=None):
+    """
+    Makes a single DescribeInstances call, for callers following `NextToken`
+    themselves.
+
+    :param instance_ids: At most `MAX_FILTER_VALUES` instance IDs.
+    :param next_token: The `NextToken` of the previous page.
+    """
+    kwargs = {'Filters': build_filters(instance_ids, states, filters)}
+    if page_size:
+        kwargs['MaxResults'] = page_size
+    if next_token:
+        kwargs['NextToken'] = next_token
+    return client.describe_instances(**kwargs)
+
+
+def iter_describe_pages(client, instance_ids=None, states=None, filters=None,
+                        page_size=None):
+    """
+    Lazily yields the DescribeInstances response pages matching the request.
+
+    :param client: The EC2 client.
+    :param instance_ids: Only describe these instances. `None` means every
+                         instance matching the other filters, an empty list
+                         means nothing at all.
+    :param states: Only describe instances in one of these states.
+    :param filters: Additional raw DescribeInstances filters.
+    :param page_size: MaxResults sent with every call (5 - 1000).
+    """
+    if instance_ids is None:
+        id_chunks = [None]
+    else:
+        id_chunks = chunked(unique(instance_ids), MAX_FILTER_VALUES)
+
+    for id_chunk in id_chunks:
+        next_token = None
+        while True:
+            page = describe_page(
+                client,
+                instance_ids=id_chunk,
+                states=states,
+                filters=filters,
+                page_size=page_size,
+                next_token=next_token
+            )
+            yield page
+
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+
+
+def iter_instances(client, instance_ids=None, states=None, filters=None,
+                   page_size=None):
+    """Lazily yields every instance described by `iter_describe_pages`."""
+    pages = iter_describe_pages(
+        client,
+        instance_ids=instance_ids,
+        states=states,
+        filters=filters,
+        page_size=page_size
+    )
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance
+
+
+# DescribeInstanceStatus accepts at most 100 instance IDs per call.
+MAX_STATUS_INSTANCE_IDS = 100
+
+
+def describe_instance_status(client, instance_ids):
+    """
+    Describes the state and status checks of the instances, including the
+    ones which are not running.
+
+    :return: `State`, `InstanceStatus` and `SystemStatus` keyed by instance ID.
+    """
+    ret = dict()
+    for id_chunk in chunked(unique(instance_ids), MAX_STATUS_INSTANCE_IDS):
+        kwargs = {'InstanceIds': id_chunk, 'IncludeAllInstances': True}
+        while True:
+            page = client.describe_instance_status(**kwargs)
+            for status in page['InstanceStatuses']:
+                ret[status['InstanceId']] = {
+                    'State': status['InstanceState']['Name'],
+                    'InstanceStatus': status.get('InstanceStatus', {}).get('Status'),
+                    'SystemStatus': status.get('SystemStatus', {}).get('Status'),
+                }
+
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+            kwargs['NextToken'] = next_token
+
+    return ret
@@ -0,0 +1,75 @@
+"""
+Compact instance records.
+
+A described instance used to be a dict plus a list of security group IDs. An
+`InstanceRecord` only holds a tuple of values; the field names and their
+positions (the layout) are shared by every record with the same fields. Records
+are read-only mappings, and are converted to dicts only when they are
+serialized to JSON.
+"""
+import sys
+from collections.abc import Mapping
+
+# Layouts keyed by their field names, shared by every record.
+_layouts = dict()
+
+
+def get_layout(fields):
+    """:return: The shared `{field: position}` layout of `fields`."""
+    layout = _layouts.get(fields)
+    if layout is None:
+        fields = tuple(fields)
+        layout = _layouts.setdefault(
+            fields, {field: position for position, field in enumerate(fields)}
+        )
+    return layout
+
+
+def intern_ids(values):
+    """
+    Interns IDs so that they are shared with the described records, and dict
+    and set lookups between both compare by identity.
+    """
+    return [sys.intern(value) for value in values]
+
+
+class InstanceRecord(Mapping):
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, layout, values):
+        """
+        :param layout: A layout returned by `get_layout`.
+        :param values: The values, in the order of the layout.
+        """
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, field):
+        return self._values[self._layout[field]]
+
+    def __iter__(self):
+        return iter(self._layout)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'InstanceRecord({!r})'.format(self.to_dict())
+
+    def replace(self, **changes):
+        values = list(self._values)
+        for field, value in changes.items():
+            values[self._layout[field]] = value
+        return InstanceRecord(self._layout, tuple(values))
+
+    def to_dict(self):
+        return dict(zip(self._layout, self._values))
+
+
+def to_json(instances):
+    """Converts instance info keyed by instance ID for JSON serialization."""
+    return {
+        instance_id: instance_info.to_dict()
+        if isinstance(instance_info, InstanceRecord) else dict(instance_info)
+        for instance_id, instance_info in instances.items()
+    }
@@ -0,0 +1,313 @@
+"""
+Power schedules evaluated by one periodic EventBridge rule.
+
+A schedule starts and / or stops a group of instances on cron expressions:
+
+    [{"name": "office-hours", "tags": "env=staging", "regions": ["us-east-1"],
+      "start": "0 9 * * 1-5", "stop": "0 19 * * 1-5", "utc_offset": "+08:00"}]
+
+The group is given like the body of `/ec2/poweron`: `instance_ids` and / or a
+`tags` selector, looked up in `regions`. Cron expressions have the five usual
+fields (minute, hour, day of month, month, day of week with 0 or 7 for
+Sunday) and accept `*`, lists, ranges and steps. They are evaluated at the
+fixed `utc_offset` of the schedule.
+
+`ScheduleIndex` keeps the next transition of every schedule in a heap, so an
+evaluation only pops the transitions that are due instead of going through
+every schedule. The time of the last evaluation is kept in the job store
+(see `STATE_ID`), so that a new container does not apply again the
+transitions another one already applied. Transitions are evaluated at the
+event time, so they can be checked locally by feeding synthetic timestamps:
+
+    python -m ec2_control.schedule schedules.json 2022-05-02T09:00:00Z
+"""
+import argparse
+import datetime
+import heapq
+import json
+import os
+import sys
+
+START = 'start'
+STOP = 'stop'
+ACTIONS = (START, STOP)
+
+# Transitions older than this many seconds are not applied anymore, e.g.
+# when the rule was disabled or a container was evicted for a while. It
+# should be longer than the period of the rule.
+WINDOW = float(os.environ.get('POWER_SCHEDULE_WINDOW', '600'))
+
+# Job store record of the last evaluation time of the schedules, shared by
+# every container. It is not a job ID (see `jobs.is_job_id`), so it can not
+# be read through `/ec2/jobs/<job_id>`.
+STATE_ID = 'schedule#evaluated_at'
+
+# (name, lowest value, highest value) of the cron fields.
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day of month', 1, 31),
+    ('month', 1, 12),
+    ('day of week', 0, 7),
+)
+
+# Days a cron expression may go without a match, e.g. Feb 29 on a Monday.
+MAX_SEARCH_DAYS = 366 * 28
+
+
+def parse_cron_field(field, name, low, high):
+    """:return: The sorted values matched by one field of a cron expression."""
+    values = set()
+    for part in field.split(','):
+        term, _, step = part.partition('/')
+        if term == '*':
+            first, last = low, high
+        elif '-' in term:
+            first, last = (int(value) for value in term.split('-', 1))
+        else:
+            first = last = int(term)
+            if step:
+                # Like cron, `5/10` steps from 5 up to the highest value
+                last = high
+        step = int(step) if step else 1
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError('invalid {} field: {}'.format(name, field))
+        values.update(range(first, last + 1, step))
+    return tuple(sorted(values))
+
+
+class CronExpression(object):
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError('cron expressions have 5 fields: ' + expression)
+
+        self.expression = expression
+        (self.minutes, self.hours, self.days, self.months, weekdays) = (
+            parse_cron_field(field, name, low, high)
+            for field, (name, low, high) in zip(fields, CRON_FIELDS)
+        )
+        # Sunday is both 0 and 7, datetime counts Monday as 0
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+        # Like cron, a restricted day of month or of week is enough to match
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def matches_date(self, date):
+        if date.month not in self.months:
+            return False
+        day = date.day in self.days
+        weekday = date.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        """
+        :param moment: An aware datetime.
+        :return: The first matching minute strictly after `moment`, in the same
+                 time zone.
+        """
+        moment = moment.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+        date = moment.date()
+        for _ in range(MAX_SEARCH_DAYS):
+            if self.matches_date(date):
+                for hour in self.hours:
+                    if date == moment.date() and hour < moment.hour:
+                        continue
+                    for minute in self.minutes:
+                        if date == moment.date() and hour == moment.hour and \
+                                minute < moment.minute:
+                            continue
+                        return datetime.datetime.combine(
+                            date,
+                            datetime.time(hour, minute),
+                            tzinfo=moment.tzinfo
+                        )
+            date += datetime.timedelta(days=1)
+        raise ValueError('cron expression never matches: ' + self.expression)
+
+
+def parse_utc_offset(value):
+    """:param value: A fixed offset like `+08:00` or `-0530`."""
+    value = (value or '+00:00').replace(':', '')
+    if len(value) != 5 or value[0] not in '+-':
+        raise ValueError('invalid utc_offset: ' + value)
+    offset = datetime.timedelta(hours=int(value[1:3]), minutes=int(value[3:5]))
+    return datetime.timezone(-offset if value[0] == '-' else offset)
+
+
+class Schedule(object):
+    def __init__(self, definition):
+        """:param definition: A schedule definition, see the module doc."""
+        self.name = definition.get('name') or 'schedule'
+        self.targets = {
+            key: definition[key]
+            for key in ('instance_ids', 'tags', 'regions')
+            if definition.get(key)
+        }
+        if not self.targets.get('instance_ids') and not self.targets.get('tags'):
+            raise ValueError('schedule {} has no instance_ids or tags'.format(
+                self.name
+            ))
+        self.timezone = parse_utc_offset(definition.get('utc_offset'))
+        self.crons = {
+            action: CronExpression(definition[action])
+            for action in ACTIONS
+            if definition.get(action)
+        }
+
+    def next_transition(self, action, timestamp):
+        """:return: The timestamp of the next `action` after `timestamp`."""
+        moment = datetime.datetime.fromtimestamp(timestamp, self.timezone)
+        return self.crons[action].next_after(moment).timestamp()
+
+
+class ScheduleIndex(object):
+    """
+    The next transition of every schedule, in a heap ordered by time. Popping
+    due transitions costs O(log n) each, whatever the number of schedules.
+    """
+
+    def __init__(self, schedules, since):
+        """
+        :param since: Only transitions after this timestamp are indexed.
+        """
+        self.schedules = list(schedules)
+        self.since = since
+        self.evaluated_at = since
+        self._heap = [
+            (schedule.next_transition(action, since), position, action)
+            for position, schedule in enumerate(self.schedules)
+            for action in schedule.crons
+        ]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_at(self):
+        """:return: The timestamp of the next transition, None without any."""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now, window=WINDOW):
+        """
+        Pops the transitions due at `now`, and indexes the next transition of
+        their schedules.
+
+        :return: `(timestamp, schedule, action)` of the due transitions not
+                 older than `window`, in time order. Only the last transition
+                 of a schedule is kept.
+        """
+        self.evaluated_at = max(self.evaluated_at, now)
+        latest = dict()
+        while self._heap and self._heap[0][0] <= now:
+            timestamp, position, action = heapq.heappop(self._heap)
+            schedule = self.schedules[position]
+            if timestamp > now - window:
+                if position not in latest or latest[position][0] < timestamp:
+                    latest[position] = (timestamp, schedule, action)
+            heapq.heappush(self._heap, (
+                schedule.next_transition(action, max(timestamp, now - window)),
+                position,
+                action
+            ))
+        return sorted(latest.values(), key=lambda transition: transition[0])
+
+
+def plan_transitions(transitions, resolve_targets):
+    """
+    Merges due transitions into one set of instances to start and one to stop
+    per region. An instance targeted by several transitions follows the
+    latest one.
+
+    :param transitions: `(timestamp, schedule, action)` from `pop_due`.
+    :param resolve_targets: Resolves the targets of a schedule into instance
+                            IDs keyed by region, and errors keyed by region.
+    :return: `{region: {action: [instance_id]}}` and the errors of every
+             schedule which could not be resolved, keyed by schedule name.
+    """
+    latest = dict()
+    errors = dict()
+    for timestamp, schedule, action in transitions:
+        try:
+            targets, target_errors = resolve_targets(schedule.targets)
+        except ValueError as e:
+            errors[schedule.name] = {'schedule': {
+                'code': 'InvalidParameterValue',
+                'message': str(e)
+            }}
+            continue
+        if target_errors:
+            errors[schedule.name] = target_errors
+        for region_name, instance_ids in targets.items():
+            for instance_id in instance_ids:
+                latest[(region_name, instance_id)] = action
+
+    plan = dict()
+    for (region_name, instance_id), action in latest.items():
+        plan.setdefault(region_name, {}).setdefault(action, []).append(
+            instance_id
+        )
+    return plan, errors
+
+
+def load_definitions(environ=os.environ):
+    """
+    :return: The schedule definitions of `POWER_SCHEDULES`, either JSON or the
+             path of a JSON file.
+    """
+    value = (environ.get('POWER_SCHEDULES') or '').strip()
+    if not value:
+        return []
+    if not value.startswith('['):
+        with open(value) as f:
+            value = f.read()
+    return json.loads(value)
+
+
+def from_environ(environ=os.environ):
+    """:return: The schedules configured by `POWER_SCHEDULES`."""
+    return [Schedule(definition) for definition in load_definitions(environ)]
+
+
+def parse_timestamp(value):
+    """:param value: An ISO 8601 time, e.g. the `time` of an EventBridge event."""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc
+    ).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def main(argv=None, stream=None):
+    """Prints the transitions due at every synthetic time, without AWS calls."""
+    stream = stream or sys.stdout
+    parser = argparse.ArgumentParser(description="Power schedule dry run")
+    parser.add_argument("schedules", help="JSON file of schedule definitions")
+    parser.add_argument("times", nargs="+", help="ISO 8601 evaluation times")
+    args = parser.parse_args(argv)
+
+    schedules = from_environ({'POWER_SCHEDULES': args.schedules})
+    times = [parse_timestamp(value) for value in args.times]
+    index = ScheduleIndex(schedules, times[0] - WINDOW)
+    for now in times:
+        for timestamp, schedule, action in index.pop_due(now):
+            stream.write('{} {} {} {}\n'.format(
+                format_timestamp(now),
+                format_timestamp(timestamp),
+                action,
+                schedule.name
+            ))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
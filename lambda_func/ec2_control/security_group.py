@@ -0,0 +1,160 @@
+"""
+Security group ingress reconciliation.
+
+Instead of revoking every ingress rule and authorizing the desired ones again,
+the current rules of the affected security groups are fetched in one batch and
+only the difference is applied. Rules to add are authorized before stale rules
+are revoked, so ports that stay open are never closed in between.
+"""
+import os
+from collections import OrderedDict
+
+from . import concurrency, query
+
+# (list key in an IpPermission, key of the value identifying one rule)
+PEER_KEYS = (
+    ('IpRanges', 'CidrIp'),
+    ('Ipv6Ranges', 'CidrIpv6'),
+    ('PrefixListIds', 'PrefixListId'),
+    ('UserIdGroupPairs', 'GroupId'),
+)
+
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+
+# Number of security groups updated at the same time.
+MAX_WORKERS = int(os.environ.get('SG_UPDATE_CONCURRENCY', '8'))
+
+
+def collect_group_ids(instances):
+    """
+    :param instances: Parsed instance info, see `parser_describe_response`.
+    :return: The unique security group IDs used by the instances.
+    """
+    return query.unique(
+        group_id
+        for instance_info in instances.values()
+        for group_id in instance_info['SecurityGroups']
+    )
+
+
+def describe_ip_permissions(client, group_ids):
+    """
+    :return: The current ingress permissions of every security group, keyed
+             by security group ID.
+    """
+    ret = dict()
+    group_id_chunks = query.chunked(
+        query.unique(group_ids),
+        query.MAX_FILTER_VALUES
+    )
+    for group_id_chunk in group_id_chunks:
+        kwargs = {'GroupIds': group_id_chunk}
+        while True:
+            page = client.describe_security_groups(**kwargs)
+            for security_group in page['SecurityGroups']:
+                ret[security_group['GroupId']] = security_group['IpPermissions']
+
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+            kwargs['NextToken'] = next_token
+
+    return ret
+
+
+def iter_rules(ip_permissions):
+    """
+    Flattens IpPermissions into single rules.
+
+    :return: Pairs of a hashable rule key and the peer item describing it.
+    """
+    for permission in ip_permissions:
+        port_range = (
+            permission['IpProtocol'],
+            permission.get('FromPort'),
+            permission.get('ToPort'),
+        )
+        for list_key, value_key in PEER_KEYS:
+            for peer in permission.get(list_key, []):
+                yield (port_range, list_key, peer[value_key]), peer
+
+
+def build_ip_permissions(rules):
+    """Groups single rules from `iter_rules` back into IpPermissions."""
+    ret = OrderedDict()
+    for (port_range, list_key, _), peer in rules:
+        permission = ret.get(port_range)
+        if permission is None:
+            ip_protocol, from_port, to_port = port_range
+            permission = {'IpProtocol': ip_protocol}
+            if from_port is not None:
+                permission['FromPort'] = from_port
+            if to_port is not None:
+                permission['ToPort'] = to_port
+            ret[port_range] = permission
+
+        permission.setdefault(list_key, []).append(peer)
+
+    return list(ret.values())
+
+
+def diff_ip_permissions(current, desired):
+    """
+    :return: The IpPermissions to authorize and the IpPermissions to revoke,
+             so that `current` becomes `desired`.
+    """
+    current_rules = OrderedDict(iter_rules(current))
+    desired_rules = OrderedDict(iter_rules(desired))
+
+    to_authorize = build_ip_permissions(
+        (key, peer) for key, peer in desired_rules.items()
+        if key not in current_rules
+    )
+    to_revoke = build_ip_permissions(
+        (key, peer) for key, peer in current_rules.items()
+        if key not in desired_rules
+    )
+    return to_authorize, to_revoke
+
+
+def apply_ip_permissions(client, group_id, current, desired):
+    """
+    Applies the minimal ingress change to one security group.
+
+    :return: `UPDATED` or `UNCHANGED`.
+    """
+    to_authorize, to_revoke = diff_ip_permissions(current, desired)
+    if not to_authorize and not to_revoke:
+        return UNCHANGED
+
+    if to_authorize:
+        client.authorize_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=to_authorize
+        )
+    if to_revoke:
+        client.revoke_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=to_revoke
+        )
+    return UPDATED
+
+
+def reconcile(client, group_ids, desired, max_workers=None):
+    """
+    Makes the ingress rules of every security group equal to `desired`. The
+    groups are updated concurrently, see `SG_UPDATE_CONCURRENCY`.
+
+    :return: `UPDATED` or `UNCHANGED` keyed by security group ID, and the
+             errors of the groups which could not be updated.
+    """
+    current = describe_ip_permissions(client, group_ids)
+
+    return concurrency.map_concurrently(
+        lambda group_id: apply_ip_permissions(
+            client, group_id, current[group_id], desired
+        ),
+        current.keys(),
+        MAX_WORKERS if max_workers is None else max_workers
+    )
@@ -0,0 +1,297 @@
+"""
+Throttling-aware EC2 calls.
+
+Every EC2 call made by `api` goes through a `RetryingClient`:
+
+- a client-side token bucket per region, shared by every request of the
+  container, spaces the calls out. Its rate is halved whenever EC2 throttles
+  and grows back with every successful call;
+- throttled calls are retried with jittered exponential backoff, as long as
+  the request-wide deadline, taken from the Lambda context, is not reached;
+- calls which had to wait or failed are recorded by the `CallTracker` of the
+  request and reported with its response.
+
+botocore's own retries are turned off (see `clients`) so that a call is never
+retried twice over.
+"""
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError
+
+from .concurrency import describe_error
+
+THROTTLING_CODES = frozenset((
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+))
+
+# Server-side errors worth another try. EC2 does not tell whether the call was
+# carried out before they happened, so only read-only calls are retried on
+# them (see `is_retryable`).
+TRANSIENT_CODES = frozenset((
+    'InternalError',
+    'ServiceUnavailable',
+    'Unavailable',
+))
+
+# Operations without side effects, e.g. `DescribeInstances`.
+READ_ONLY_PREFIXES = ('Describe', 'Get', 'List')
+
+# Highest call rate per region and container, reached again after throttles.
+MAX_RATE = float(os.environ.get('EC2_MAX_REQUEST_RATE', '20'))
+MIN_RATE = 0.5
+
+MAX_ATTEMPTS = int(os.environ.get('EC2_RETRY_MAX_ATTEMPTS', '5'))
+# Backoff before the n-th retry is random between 0 and BASE_DELAY * 2 ** n.
+BASE_DELAY = float(os.environ.get('EC2_RETRY_BASE_DELAY', '0.1'))
+MAX_DELAY = float(os.environ.get('EC2_RETRY_MAX_DELAY', '5'))
+
+# Seconds kept before the Lambda timeout to build and send the response.
+DEADLINE_MARGIN = float(os.environ.get('EC2_DEADLINE_MARGIN', '1'))
+
+
+class DeadlineExceeded(Exception):
+    """A call could not be made before the deadline of the request."""
+
+
+class TokenBucket(object):
+    """
+    Spaces calls out at `rate` per second with bursts of `capacity` calls.
+    The rate is halved on every throttle and increased additively on every
+    success, up to `max_rate`.
+    """
+
+    def __init__(self, max_rate=MAX_RATE, capacity=None, timer=time.monotonic,
+                 sleep=time.sleep):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.capacity = capacity or max(max_rate, 1)
+        self.tokens = self.capacity
+        self.timer = timer
+        self.sleep = sleep
+        self._updated_at = timer()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self, deadline=None):
+        """
+        Takes a token, waiting for it when the bucket is empty.
+
+        :param deadline: `timer()` value the wait must end before.
+        :return: The seconds waited.
+        :raises DeadlineExceeded: When the token would come after the deadline.
+        """
+        with self._lock:
+            now = self.timer()
+            self._refill(now)
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineExceeded('no EC2 call budget left before the deadline')
+            self.tokens -= 1
+
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self._refill(self.timer())
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(region_name):
+    """:return: The token bucket shared by every call to the region."""
+    bucket = _buckets.get(region_name)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.setdefault(region_name, TokenBucket())
+    return bucket
+
+
+class CallTracker(object):
+    """Records the delayed and failed EC2 calls of one request."""
+
+    def __init__(self, deadline=None, timer=time.monotonic):
+        """:param deadline: `timer()` value the calls must end before."""
+        self.deadline = deadline
+        self.timer = timer
+        self.delayed = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_context(cls, context, timer=time.monotonic):
+        """Ends the calls `DEADLINE_MARGIN` seconds before the Lambda timeout."""
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time is None:
+            return cls(timer=timer)
+        return cls(
+            deadline=timer() + get_remaining_time() / 1000.0 - DEADLINE_MARGIN,
+            timer=timer
+        )
+
+    def remaining(self):
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - self.timer()
+
+    def record_delayed(self, operation, region_name, attempts, delay):
+        with self._lock:
+            self.delayed.append({
+                'operation': operation,
+                'region': region_name,
+                'attempts': attempts,
+                'delay': round(delay, 3),
+            })
+
+    def record_failed(self, operation, region_name, attempts, error):
+        with self._lock:
+            self.failed.append({
+                'operation': operation,
+                'region': region_name,
+                'attempts': attempts,
+                'error': describe_error(error),
+            })
+
+    def report(self):
+        """:return: The delayed and failed calls, empty when there were none."""
+        ret = dict()
+        if self.delayed:
+            ret['delayed'] = list(self.delayed)
+        if self.failed:
+            ret['failed'] = list(self.failed)
+        return ret
+
+
+_current_tracker = contextvars.ContextVar('ec2_call_tracker', default=None)
+
+
+def current_tracker():
+    """:return: The tracker of the running request, or a throwaway one."""
+    return _current_tracker.get() or CallTracker()
+
+
+def tracked(func):
+    """
+    Tracks the EC2 calls made by an event handler `func(event, context)` and
+    reports them under `ec2_calls` in its response.
+    """
+    @functools.wraps(func)
+    def wrapper(event, context=None):
+        tracker = CallTracker.from_context(context)
+        token = _current_tracker.set(tracker)
+        try:
+            response = func(event, context)
+        finally:
+            _current_tracker.reset(token)
+
+        report = tracker.report()
+        if report:
+            response['ec2_calls'] = report
+        return response
+
+    return wrapper
+
+
+def is_retryable(error, operation=None):
+    """
+    :param operation: The failed API operation, e.g. `StartInstances`.
+    :return: True when `error` is a throttle or a failure to connect, which the
+             call never got past, or a transient error of a read-only call.
+             Mutating calls are not sent again after a transient error, since
+             they may well have been carried out.
+    """
+    if isinstance(error, ConnectionError):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        if code in THROTTLING_CODES:
+            return True
+        return code in TRANSIENT_CODES and operation is not None and \
+            operation.startswith(READ_ONLY_PREFIXES)
+    return False
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and \
+        error.response.get('Error', {}).get('Code') in THROTTLING_CODES
+
+
+class RetryingClient(object):
+    """
+    Wraps an EC2 client so that its API operations go through the token bucket
+    of the region and are retried. Anything else is the wrapped client's.
+    """
+
+    def __init__(self, client, region_name, bucket=None):
+        self._client = client
+        self._region_name = region_name
+        self._bucket = bucket or get_bucket(region_name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        operation = self._client.meta.method_to_api_mapping.get(name)
+        if operation is None:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self._call(operation, attr, args, kwargs)
+
+        return call
+
+    def _call(self, operation, method, args, kwargs):
+        tracker = current_tracker()
+        delay = 0.0
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                delay += self._bucket.acquire(tracker.deadline)
+                result = method(*args, **kwargs)
+            except Exception as e:
+                if is_throttle(e):
+                    self._bucket.throttled()
+                backoff = random.uniform(
+                    0, min(MAX_DELAY, BASE_DELAY * 2 ** attempts)
+                )
+                if not is_retryable(e, operation) or attempts >= MAX_ATTEMPTS or \
+                        backoff >= tracker.remaining():
+                    tracker.record_failed(
+                        operation, self._region_name, attempts, e
+                    )
+                    raise
+                time.sleep(backoff)
+                delay += backoff
+                continue
+
+            self._bucket.succeeded()
+            if attempts > 1 or delay:
+                tracker.record_delayed(
+                    operation, self._region_name, attempts, delay
+                )
+            return result
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module reads the boolean settings of the environment, e.g.
+`WSGI_NATIVE_ROUTER=true`, the same way for every module.
+"""
+import os
+
+TRUE_VALUES = ("yes", "y", "true", "t", "1")
+
+
+def parse_bool(value):
+    return value.lower().strip() in TRUE_VALUES
+
+
+def is_set(name, default="", environ=os.environ):
+    """:return: True when the environment variable `name` holds a true value."""
+    return parse_bool(environ.get(name, default))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module records where the Lambda init time goes: how long every module
+import takes and how long each init phase of `wsgi_handler` runs. It is enabled
+with the `WSGI_PROFILE_INIT` environment variable and prints its findings once,
+after the first request, as a single JSON log line ranked by cost.
+"""
+import builtins
+import contextlib
+import importlib.util
+import json
+import sys
+import threading
+import time
+
+import flags
+
+# Number of modules listed in the report.
+TOP_MODULES = 30
+
+
+def is_enabled():
+    return flags.is_set("WSGI_PROFILE_INIT")
+
+
+class InitProfiler(object):
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        self.started = timer()
+        self.reported = False
+        self.modules = {}
+        self.phases = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._original_import = None
+        self._client_creation_patched = False
+
+    def install(self):
+        """Starts timing every import statement."""
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as init phase `name`."""
+        started = self.timer()
+        try:
+            yield
+        finally:
+            self.record_phase(name, self.timer() - started)
+
+    def record_phase(self, name, duration):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        missing = [
+            module_name
+            for module_name in self._candidate_names(name, globals, fromlist, level)
+            if module_name not in sys.modules
+        ]
+        if not missing:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        # Children's time is collected in the frame to compute self time.
+        stack.append(0.0)
+        started = self.timer()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            inclusive = self.timer() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += inclusive
+
+            loaded = [module_name for module_name in missing if module_name in sys.modules]
+            if loaded:
+                with self._lock:
+                    self.modules[",".join(loaded)] = (inclusive - children, inclusive)
+                self._patch_client_creation()
+
+    @staticmethod
+    def _candidate_names(name, globals, fromlist, level):
+        """:return: The modules an import statement may load."""
+        if level:
+            try:
+                name = importlib.util.resolve_name(
+                    "." * level + name, (globals or {}).get("__package__")
+                )
+            except (ImportError, ValueError):
+                return []
+
+        candidates = [name] if name else []
+        for from_name in fromlist or ():
+            if from_name != "*":
+                candidates.append("{}.{}".format(name, from_name))
+        return candidates
+
+    def _patch_client_creation(self):
+        """Times botocore client creation once botocore has been imported."""
+        if self._client_creation_patched:
+            return
+        # The module may still be partially initialized.
+        session_class = getattr(sys.modules.get("botocore.session"), "Session", None)
+        if session_class is None:
+            return
+        self._client_creation_patched = True
+
+        create_client = session_class.create_client
+        profiler = self
+
+        def timed_create_client(session, service_name, *args, **kwargs):
+            if profiler.reported:
+                return create_client(session, service_name, *args, **kwargs)
+            with profiler.phase("create_client:{}".format(service_name)):
+                return create_client(session, service_name, *args, **kwargs)
+
+        session_class.create_client = timed_create_client
+
+    def summary(self):
+        ranked = sorted(self.modules.items(), key=lambda item: item[1][0], reverse=True)
+
+        packages = {}
+        for module_name, (self_time, _) in ranked:
+            package = module_name.split(".", 1)[0]
+            packages[package] = packages.get(package, 0.0) + self_time
+
+        return {
+            "total_ms": round((self.timer() - self.started) * 1000, 2),
+            "phases_ms": {
+                name: round(duration * 1000, 2)
+                for name, duration in sorted(
+                    self.phases.items(), key=lambda item: item[1], reverse=True
+                )
+            },
+            "packages_ms": [
+                [package, round(duration * 1000, 2)]
+                for package, duration in sorted(
+                    packages.items(), key=lambda item: item[1], reverse=True
+                )
+            ],
+            "modules_ms": [
+                [module_name, round(self_time * 1000, 2), round(inclusive * 1000, 2)]
+                for module_name, (self_time, inclusive) in ranked[:TOP_MODULES]
+            ],
+        }
+
+    def report(self, stream=None):
+        """Stops profiling and prints the summary once."""
+        if self.reported:
+            return
+        self.uninstall()
+        self.reported = True
+        print(json.dumps({"init_profile": self.summary()}), file=stream or sys.stdout)
+
+
+def from_environ():
+    """:return: An installed profiler when `WSGI_PROFILE_INIT` is set, else None"""
+    if not is_enabled():
+        return None
+    profiler = InitProfiler()
+    profiler.install()
+    return profiler
+
+
+def phase(profiler, name):
+    """Times the enclosed block when profiling is enabled."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
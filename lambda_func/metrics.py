@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module records where the time of one Lambda invocation goes: the
+`serverless_wsgi` translation phases, the route which served the request and
+every AWS call, and prints it as a single CloudWatch Embedded Metric Format
+(EMF) log line when the invocation ends. It is enabled with the `EMF_METRICS`
+environment variable. With `SERVER_TIMING`, the same latencies are returned in
+the `Server-Timing` header of the response (see `server_timing`).
+
+Recordings go to the invocation of the current context, so they are collected
+from the worker threads of `ec2_control.concurrency` too. Without an
+invocation every recording is a no-op.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+import flags
+
+NAMESPACE = os.environ.get("EMF_NAMESPACE", "EC2PowerSwitcher")
+
+# Route dimension of invocations not served by a route, e.g. warm-up events.
+NO_ROUTE = "none"
+
+
+def is_enabled():
+    return flags.is_set("EMF_METRICS")
+
+
+def is_server_timing_enabled():
+    return flags.is_set("SERVER_TIMING")
+
+
+class Invocation(object):
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        self.started = timer()
+        self.route = None
+        self.latencies = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration):
+        """Adds a `duration` in seconds to the latency metric `name`."""
+        with self._lock:
+            self.latencies.setdefault(name, []).append(round(duration * 1000, 3))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as latency metric `name`."""
+        started = self.timer()
+        try:
+            yield
+        finally:
+            self.record(name, self.timer() - started)
+
+    def server_timing(self, names=None):
+        """
+        :param names: Only list these latency metrics, defaults to all.
+        :return: A `Server-Timing` header value, with the total duration of
+                 every latency metric in the order they were first recorded.
+        """
+        with self._lock:
+            latencies = [
+                (name, sum(values))
+                for name, values in self.latencies.items()
+                if names is None or name in names
+            ]
+        return ", ".join(
+            "{};dur={:.3f}".format(name, duration) for name, duration in latencies
+        )
+
+    def to_emf(self, namespace=None, timestamp=None):
+        """:return: The EMF document of the invocation."""
+        with self._lock:
+            latencies = {name: list(values) for name, values in self.latencies.items()}
+            counts = dict(self.counts)
+
+        document = {
+            "_aws": {
+                "Timestamp": int((time.time() if timestamp is None else timestamp) * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": namespace or NAMESPACE,
+                        "Dimensions": [["Route"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": "Milliseconds"} for name in latencies
+                        ]
+                        + [{"Name": name, "Unit": "Count"} for name in counts],
+                    }
+                ],
+            },
+            "Route": self.route or NO_ROUTE,
+        }
+        for name, values in latencies.items():
+            document[name] = values[0] if len(values) == 1 else values
+        document.update(counts)
+        return document
+
+
+_current_invocation = contextvars.ContextVar("metrics_invocation", default=None)
+
+
+def current():
+    """:return: The invocation being recorded, None without any."""
+    return _current_invocation.get()
+
+
+@contextlib.contextmanager
+def invocation(stream=None):
+    """
+    Records the enclosed invocation and prints its EMF line once it ends.
+    Does nothing unless `EMF_METRICS` or `SERVER_TIMING` is set.
+    """
+    emf = is_enabled()
+    if not emf and not is_server_timing_enabled():
+        yield None
+        return
+
+    recorded = Invocation()
+    token = _current_invocation.set(recorded)
+    try:
+        yield recorded
+    finally:
+        _current_invocation.reset(token)
+        if emf:
+            recorded.record("InvocationLatency", recorded.timer() - recorded.started)
+            print(json.dumps(recorded.to_emf()), file=stream or sys.stdout)
+
+
+def begin():
+    """
+    Starts recording for `Server-Timing` when no invocation is being recorded,
+    e.g. under `serve.py`.
+
+    :return: The token to pass to `end`, None when nothing was started.
+    """
+    if current() is not None or not is_server_timing_enabled():
+        return None
+    return _current_invocation.set(Invocation())
+
+
+def end(token):
+    if token is not None:
+        _current_invocation.reset(token)
+
+
+def server_timing(names=None):
+    """:return: The `Server-Timing` header value, None when it is disabled."""
+    recorded = current()
+    if recorded is None or not is_server_timing_enabled():
+        return None
+    return recorded.server_timing(names) or None
+
+
+def phase(name):
+    """Times the enclosed block when an invocation is being recorded."""
+    recorded = current()
+    if recorded is None:
+        return contextlib.nullcontext()
+    return recorded.phase(name)
+
+
+def timed(name):
+    """Times every call of the decorated function as latency metric `name`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorded = current()
+            if recorded is None:
+                return func(*args, **kwargs)
+            with recorded.phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_route(route, duration):
+    """Records the latency of the route which served the invocation."""
+    recorded = current()
+    if recorded is not None:
+        recorded.route = route
+        recorded.record("RouteLatency", duration)
+
+
+def _start_call(model, context, **kwargs):
+    if current() is not None:
+        context["metrics_call"] = (
+            "{}.{}".format(model.service_model.service_name, model.name),
+            time.perf_counter(),
+        )
+
+
+def _end_call(context, parsed=None, exception=None, **kwargs):
+    recorded = current()
+    call = context.pop("metrics_call", None)
+    if recorded is None or call is None:
+        return
+
+    name, started = call
+    recorded.record(name, time.perf_counter() - started)
+    if exception is not None or "Error" in (parsed or {}):
+        recorded.count("AWSCallErrors")
+
+
+def instrument_client(client):
+    """Times every call of a botocore client, see `_end_call`."""
+    events = client.meta.events
+    # Also emitted for stubbed calls, unlike `before-call`
+    events.register_first(
+        "before-parameter-build", _start_call, unique_id="metrics-start-call"
+    )
+    events.register("after-call", _end_call, unique_id="metrics-end-call")
+    events.register("after-call-error", _end_call, unique_id="metrics-end-call-error")
+    return client
@@ -8,14 +8,24 @@ Inspired by: https://github.com/miserlou/zappa
 Author: Logan Raarup <logan@logan.dk>
 """
 import base64
+import functools
 import io
+import itertools
 import json
 import os
 import sys
-from werkzeug.datastructures import Headers, iter_multi_items, MultiDict
+import threading
+import time
+import traceback
+import zlib
+from werkzeug.datastructures import iter_multi_items, MultiDict
 from werkzeug.wrappers import Response
 from werkzeug.urls import url_encode, url_unquote, url_unquote_plus
 from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.exceptions import HTTPException, InternalServerError
+
+import flags
+import metrics
 
 
 # List of MIME types that should not be base64 encoded. MIME types within `text/*`
@@ -48,6 +58,59 @@ def all_casings(input_string):
                 yield first.upper() + sub_casing
 
 
+def iter_casings(input_string):
+    """
+    Iterates the casings of a string in the same order as `all_casings`, without
+    recursion: the n-th casing upper-cases the letters whose bit is set in n.
+    """
+    chars = list(input_string.lower())
+    letters = [i for i, char in enumerate(chars) if char.lower() != char.upper()]
+
+    for n in range(2 ** len(letters)):
+        casing = list(chars)
+        for bit, i in enumerate(letters):
+            if n >> bit & 1:
+                casing[i] = casing[i].upper()
+        yield "".join(casing)
+
+
+# Casings already generated per header name, with the iterator producing the
+# next ones. See `header_casings`.
+_header_casings = {}
+_header_casings_lock = threading.Lock()
+
+
+def header_casings(input_string, count):
+    """
+    Returns the first `count` casings of a header name (fewer when the name has
+    fewer casings). They are generated on demand and memoised per header name.
+    """
+    with _header_casings_lock:
+        entry = _header_casings.get(input_string)
+        if entry is None:
+            entry = _header_casings[input_string] = ([], iter_casings(input_string))
+
+        casings, remaining = entry
+        if len(casings) < count:
+            casings.extend(itertools.islice(remaining, count - len(casings)))
+        return casings[:count]
+
+
+def iter_header_values(headers):
+    """
+    Yields every header name (as first seen) with all of its values, walking the
+    headers once instead of calling `get_all` for every occurrence of a name.
+    """
+    grouped = {}
+    for key, value in headers.items():
+        entry = grouped.get(key.lower())
+        if entry is None:
+            grouped[key.lower()] = (key, [value])
+        else:
+            entry[1].append(value)
+    return grouped.values()
+
+
 def split_headers(headers):
     """
     If there are multiple occurrences of headers, create case-mutated variations
@@ -57,10 +120,9 @@ def split_headers(headers):
     """
     new_headers = {}
 
-    for key in headers.keys():
-        values = headers.get_all(key)
+    for key, values in iter_header_values(headers):
         if len(values) > 1:
-            for value, casing in zip(values, all_casings(key)):
+            for value, casing in zip(values, header_casings(key, len(values))):
                 new_headers[casing] = value
         elif len(values) == 1:
             new_headers[key] = values[0]
@@ -71,8 +133,8 @@ def split_headers(headers):
 def group_headers(headers):
     new_headers = {}
 
-    for key in headers.keys():
-        new_headers[key] = headers.get_all(key)
+    for key, values in iter_header_values(headers):
+        new_headers[key] = values
 
     return new_headers
 
@@ -98,13 +160,7 @@ def encode_query_string(event):
 
 
 def get_script_name(headers, request_context):
-    strip_stage_path = os.environ.get("STRIP_STAGE_PATH", "").lower().strip() in [
-        "yes",
-        "y",
-        "true",
-        "t",
-        "1",
-    ]
+    strip_stage_path = flags.is_set("STRIP_STAGE_PATH")
 
     if "amazonaws.com" in headers.get("Host", "") and not strip_stage_path:
         script_name = "/{}".format(request_context.get("stage", ""))
@@ -121,21 +177,172 @@ def get_body_bytes(event, body):
     return body
 
 
-def setup_environ_items(environ, headers):
-    for key, value in environ.items():
-        if isinstance(value, str):
-            environ[key] = value.encode("utf-8").decode("latin1", "replace")
+class EventHeaders(object):
+    """
+    A lightweight stand-in for werkzeug `Headers`, built in one pass over the
+    single or multi value headers of an event. `get` is case-insensitive and
+    returns the first value, `items` yields every (name, value) pair.
+    """
+
+    __slots__ = ("_items", "_first")
+
+    def __init__(self, headers=None):
+        self._items = []
+        self._first = {}
+        for key, values in (headers or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                if not isinstance(value, str):
+                    value = str(value)
+                self._items.append((key, value))
+                self._first.setdefault(key.lower(), value)
+
+    def get(self, key, default=None):
+        return self._first.get(key.lower(), default)
+
+    def items(self):
+        return iter(self._items)
+
+    def __setitem__(self, key, value):
+        lower = key.lower()
+        self._items = [item for item in self._items if item[0].lower() != lower]
+        self._items.append((key, value))
+        self._first[lower] = value
+
+
+# WSGI environ keys which never change. The constants are the same for every
+# payload version, so all of them start from this template.
+ENVIRON_TEMPLATE = {
+    "SERVER_PROTOCOL": "HTTP/1.1",
+    "wsgi.multiprocess": False,
+    "wsgi.multithread": False,
+    "wsgi.run_once": False,
+    "wsgi.version": (1, 0),
+}
+
+
+@functools.lru_cache(maxsize=512)
+def get_environ_header_key(name):
+    """The `HTTP_*` environ key of a header, None for Content-Type/Length"""
+    key = "HTTP_" + name.upper().replace("-", "_")
+    if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+        return None
+    return key
+
+
+def to_environ_str(value):
+    """WSGI environ strings hold the UTF-8 bytes decoded as latin1"""
+    if value.isascii():
+        return value
+    return value.encode("utf-8").decode("latin1", "replace")
+
+
+def build_environ(event, context, headers, body, items):
+    """
+    Builds a WSGI environ from `ENVIRON_TEMPLATE`, the request headers and body
+    and the string `items` read from the event by the payload version handler.
+    """
+    environ = ENVIRON_TEMPLATE.copy()
+
+    for key, value in items.items():
+        environ[key] = to_environ_str(value) if isinstance(value, str) else value
+
+    environ["CONTENT_LENGTH"] = str(len(body or ""))
+    environ["CONTENT_TYPE"] = to_environ_str(headers.get("Content-Type", ""))
+    environ["SERVER_NAME"] = to_environ_str(headers.get("Host", "lambda"))
+    environ["SERVER_PORT"] = to_environ_str(headers.get("X-Forwarded-Port", "443"))
+    environ["wsgi.url_scheme"] = to_environ_str(
+        headers.get("X-Forwarded-Proto", "https")
+    )
+    environ["wsgi.errors"] = sys.stderr
+    environ["wsgi.input"] = io.BytesIO(body)
+    environ["serverless.event"] = event
+    environ["serverless.context"] = context
 
     for key, value in headers.items():
-        key = "HTTP_" + key.upper().replace("-", "_")
-        if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+        key = get_environ_header_key(key)
+        if key:
             environ[key] = value
+
     return environ
 
 
+def get_event_header(event, name):
+    """Case-insensitive lookup of a request header in a v1, v2 or ALB event"""
+    headers = event.get("multiValueHeaders") or event.get("headers") or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return ", ".join(value) if isinstance(value, list) else value
+    return ""
+
+
+def negotiate_content_encoding(accept_encoding):
+    """
+    Picks `gzip` or `deflate` from an Accept-Encoding header value, or returns
+    None when the client accepts neither.
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    for coding in ("gzip", "deflate"):
+        if qualities.get(coding, qualities.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(data, content_encoding):
+    if content_encoding == "gzip":
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    else:
+        compressor = zlib.compressobj()
+    return compressor.compress(data) + compressor.flush()
+
+
+def get_compression_min_size():
+    """
+    Minimum body size in bytes for responses to be compressed, or None when
+    compression is disabled. See `RESPONSE_COMPRESSION` and
+    `RESPONSE_COMPRESSION_MIN_SIZE`.
+    """
+    if not flags.is_set("RESPONSE_COMPRESSION"):
+        return None
+    return int(os.environ.get("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+
+
 def generate_response(response, event):
     returndict = {"statusCode": response.status_code}
 
+    # Materialize the body once, it is needed both as bytes and as text
+    data = response.get_data()
+    mimetype = response.mimetype or "text/plain"
+    is_text = (
+        mimetype.startswith("text/") or mimetype in TEXT_MIME_TYPES
+    ) and not response.headers.get("Content-Encoding", "")
+
+    min_size = get_compression_min_size()
+    if is_text and min_size is not None and len(data) >= min_size:
+        response.headers.add("Vary", "Accept-Encoding")
+        content_encoding = negotiate_content_encoding(
+            get_event_header(event, "Accept-Encoding")
+        )
+        if content_encoding:
+            data = compress(data, content_encoding)
+            response.headers["Content-Encoding"] = content_encoding
+            response.headers["Content-Length"] = str(len(data))
+            is_text = False
+
     if "multiValueHeaders" in event:
         returndict["multiValueHeaders"] = group_headers(response.headers)
     else:
@@ -148,15 +355,14 @@ def generate_response(response, event):
             HTTP_STATUS_CODES[response.status_code],
         )
 
-    if response.data:
-        mimetype = response.mimetype or "text/plain"
-        if (
-            mimetype.startswith("text/") or mimetype in TEXT_MIME_TYPES
-        ) and not response.headers.get("Content-Encoding", ""):
-            returndict["body"] = response.get_data(as_text=True)
+    if data:
+        if is_text:
+            returndict["body"] = data.decode(
+                response.mimetype_params.get("charset", "utf-8")
+            )
             returndict["isBase64Encoded"] = False
         else:
-            returndict["body"] = base64.b64encode(response.data).decode("utf-8")
+            returndict["body"] = base64.b64encode(data).decode("utf-8")
             returndict["isBase64Encoded"] = True
 
     return returndict
@@ -172,8 +378,125 @@ def strip_express_gateway_query_params(path):
     return path
 
 
+def get_native_routes(app):
+    """
+    Routes an app registers to be served straight from the Lambda event, as
+    `app.extensions["serverless_wsgi"]["native_routes"]`, a dict mapping
+    `(method, path)` to `handler(event, context)` returning a JSON serializable
+    response body.
+    """
+    return (
+        getattr(app, "extensions", {}).get("serverless_wsgi", {}).get("native_routes")
+        or {}
+    )
+
+
+def get_native_route(routes, event):
+    if event.get("version") == "2.0" or "httpMethod" not in event:
+        return None
+
+    path_info = strip_express_gateway_query_params(event.get("path") or "")
+    _, path_info = strip_base_path("", path_info)
+
+    return routes.get((event["httpMethod"], path_info))
+
+
+def handle_native_request(routes, event, context):
+    """
+    Serves a REST API (payload v1) or ALB event from a native route, without
+    building a WSGI environ. Returns None when no native route matches, so the
+    caller can fall back to `handle_request`.
+    """
+    route = get_native_route(routes, event)
+    if route is None:
+        return None
+
+    started = time.perf_counter()
+    try:
+        result = route(event, context)
+    except HTTPException as e:
+        return generate_response(e.get_response(), event)
+    except Exception:
+        # Same response as an unhandled error of the WSGI app
+        traceback.print_exc()
+        return generate_response(InternalServerError().get_response(), event)
+    metrics.record_route(
+        "{} {}".format(event.get("httpMethod"), event.get("path")),
+        time.perf_counter() - started,
+    )
+
+    with metrics.phase("Native.serialize"):
+        body = json.dumps(result, sort_keys=True, separators=(",", ":"))
+        body += "\n"
+    data = body.encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    is_base64 = False
+
+    # Same compression as `generate_response`
+    min_size = get_compression_min_size()
+    if min_size is not None and len(data) >= min_size:
+        headers["Vary"] = "Accept-Encoding"
+        content_encoding = negotiate_content_encoding(
+            get_event_header(event, "Accept-Encoding")
+        )
+        if content_encoding:
+            data = compress(data, content_encoding)
+            headers["Content-Encoding"] = content_encoding
+            body = base64.b64encode(data).decode("utf-8")
+            is_base64 = True
+
+    headers["Content-Length"] = str(len(data))
+    server_timing = metrics.server_timing()
+    if server_timing:
+        headers["Server-Timing"] = server_timing
+
+    returndict = {"statusCode": 200}
+
+    if "multiValueHeaders" in event:
+        returndict["multiValueHeaders"] = {k: [v] for k, v in headers.items()}
+    else:
+        returndict["headers"] = headers
+
+    if is_alb_event(event):
+        returndict["statusDescription"] = "200 OK"
+
+    returndict["body"] = body
+    returndict["isBase64Encoded"] = is_base64
+
+    return returndict
+
+
+def get_event_sources(app):
+    """
+    Handlers an app registers for non HTTP events, as
+    `app.extensions["serverless_wsgi"]["event_sources"]`, a dict mapping the
+    event `source` (e.g. `aws.events`) to `handler(event, context)`.
+    """
+    return (
+        getattr(app, "extensions", {}).get("serverless_wsgi", {}).get("event_sources")
+        or {}
+    )
+
+
+def get_warmup(app):
+    """
+    Priming routine an app registers as
+    `app.extensions["serverless_wsgi"]["warmup"]`, a `warmup(event, context)`
+    run on warm-up events instead of skipping them.
+    """
+    return getattr(app, "extensions", {}).get("serverless_wsgi", {}).get("warmup")
+
+
 def handle_request(app, event, context):
     if event.get("source") in ["aws.events", "serverless-plugin-warmup"]:
+        event_source = get_event_sources(app).get(event["source"])
+        if event_source is not None:
+            return event_source(event, context)
+
+        warmup = get_warmup(app)
+        if warmup is not None:
+            return warmup(event, context)
+
         print("Lambda warming event received, skipping handler")
         return {}
 
@@ -190,18 +513,10 @@ def handle_request(app, event, context):
     return handle_payload_v1(app, event, context)
 
 
-def handle_payload_v1(app, event, context):
-    if "multiValueHeaders" in event:
-        headers = Headers(event["multiValueHeaders"])
-    else:
-        headers = Headers(event["headers"])
-
-    script_name = get_script_name(headers, event.get("requestContext", {}))
-
+def strip_base_path(script_name, path_info):
     # If a user is using a custom domain on API Gateway, they may have a base
     # path in their URL. This allows us to strip it out via an optional
     # environment variable.
-    path_info = strip_express_gateway_query_params(event["path"])
     base_path = os.environ.get("API_GATEWAY_BASE_PATH")
     if base_path:
         script_name = "/" + base_path
@@ -209,104 +524,79 @@ def handle_payload_v1(app, event, context):
         if path_info.startswith(script_name):
             path_info = path_info[len(script_name) :]
 
-    body = event.get("body") or ""
-    body = get_body_bytes(event, body)
-
-    environ = {
-        "CONTENT_LENGTH": str(len(body)),
-        "CONTENT_TYPE": headers.get("Content-Type", ""),
-        "PATH_INFO": url_unquote(path_info),
-        "QUERY_STRING": encode_query_string(event),
-        "REMOTE_ADDR": event.get("requestContext", {})
-        .get("identity", {})
-        .get("sourceIp", ""),
-        "REMOTE_USER": event.get("requestContext", {})
-        .get("authorizer", {})
-        .get("principalId", ""),
-        "REQUEST_METHOD": event.get("httpMethod", {}),
-        "SCRIPT_NAME": script_name,
-        "SERVER_NAME": headers.get("Host", "lambda"),
-        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
-        "SERVER_PROTOCOL": "HTTP/1.1",
-        "wsgi.errors": sys.stderr,
-        "wsgi.input": io.BytesIO(body),
-        "wsgi.multiprocess": False,
-        "wsgi.multithread": False,
-        "wsgi.run_once": False,
-        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
-        "wsgi.version": (1, 0),
-        "serverless.authorizer": event.get("requestContext", {}).get("authorizer"),
-        "serverless.event": event,
-        "serverless.context": context,
-    }
-
-    environ = setup_environ_items(environ, headers)
-
-    response = Response.from_app(app, environ)
-    returndict = generate_response(response, event)
+    return script_name, path_info
 
-    return returndict
 
+def get_environ_v1(event, context):
+    if "multiValueHeaders" in event:
+        headers = EventHeaders(event["multiValueHeaders"])
+    else:
+        headers = EventHeaders(event["headers"])
 
-def handle_payload_v2(app, event, context):
-    headers = Headers(event["headers"])
+    request_context = event.get("requestContext") or {}
+    authorizer = request_context.get("authorizer")
 
-    script_name = get_script_name(headers, event.get("requestContext", {}))
+    script_name, path_info = strip_base_path(
+        get_script_name(headers, request_context),
+        strip_express_gateway_query_params(event["path"]),
+    )
 
-    path_info = strip_express_gateway_query_params(event["rawPath"])
-    base_path = os.environ.get("API_GATEWAY_BASE_PATH")
-    if base_path:
-        script_name = "/" + base_path
+    body = event.get("body") or ""
+    body = get_body_bytes(event, body)
 
-        if path_info.startswith(script_name):
-            path_info = path_info[len(script_name) :]
+    return build_environ(
+        event,
+        context,
+        headers,
+        body,
+        {
+            "PATH_INFO": url_unquote(path_info),
+            "QUERY_STRING": encode_query_string(event),
+            "REMOTE_ADDR": (request_context.get("identity") or {}).get("sourceIp", ""),
+            "REMOTE_USER": (authorizer or {}).get("principalId", ""),
+            "REQUEST_METHOD": event.get("httpMethod") or "",
+            "SCRIPT_NAME": script_name,
+            "serverless.authorizer": authorizer,
+        },
+    )
+
+
+def get_environ_v2(event, context):
+    headers = EventHeaders(event["headers"])
+
+    request_context = event.get("requestContext") or {}
+    http = request_context.get("http") or {}
+    authorizer = request_context.get("authorizer")
+
+    script_name, path_info = strip_base_path(
+        get_script_name(headers, request_context),
+        strip_express_gateway_query_params(event["rawPath"]),
+    )
 
     body = event.get("body", "")
     body = get_body_bytes(event, body)
 
     headers["Cookie"] = "; ".join(event.get("cookies", []))
 
-    environ = {
-        "CONTENT_LENGTH": str(len(body or "")),
-        "CONTENT_TYPE": headers.get("Content-Type", ""),
-        "PATH_INFO": url_unquote(path_info),
-        "QUERY_STRING": event.get("rawQueryString", ""),
-        "REMOTE_ADDR": event.get("requestContext", {})
-        .get("http", {})
-        .get("sourceIp", ""),
-        "REMOTE_USER": event.get("requestContext", {})
-        .get("authorizer", {})
-        .get("principalId", ""),
-        "REQUEST_METHOD": event.get("requestContext", {})
-        .get("http", {})
-        .get("method", ""),
-        "SCRIPT_NAME": script_name,
-        "SERVER_NAME": headers.get("Host", "lambda"),
-        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
-        "SERVER_PROTOCOL": "HTTP/1.1",
-        "wsgi.errors": sys.stderr,
-        "wsgi.input": io.BytesIO(body),
-        "wsgi.multiprocess": False,
-        "wsgi.multithread": False,
-        "wsgi.run_once": False,
-        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
-        "wsgi.version": (1, 0),
-        "serverless.authorizer": event.get("requestContext", {}).get("authorizer"),
-        "serverless.event": event,
-        "serverless.context": context,
-    }
-
-    environ = setup_environ_items(environ, headers)
-
-    response = Response.from_app(app, environ)
-
-    returndict = generate_response(response, event)
-
-    return returndict
-
-
-def handle_lambda_integration(app, event, context):
-    headers = Headers(event["headers"])
+    return build_environ(
+        event,
+        context,
+        headers,
+        body,
+        {
+            "PATH_INFO": url_unquote(path_info),
+            "QUERY_STRING": event.get("rawQueryString", ""),
+            "REMOTE_ADDR": http.get("sourceIp", ""),
+            "REMOTE_USER": (authorizer or {}).get("principalId", ""),
+            "REQUEST_METHOD": http.get("method", ""),
+            "SCRIPT_NAME": script_name,
+            "serverless.authorizer": authorizer,
+        },
+    )
+
+
+def get_environ_lambda_integration(event, context):
+    headers = EventHeaders(event["headers"])
 
     script_name = get_script_name(headers, event)
 
@@ -320,37 +610,69 @@ def handle_lambda_integration(app, event, context):
     body = json.dumps(body) if body else ""
     body = get_body_bytes(event, body)
 
-    environ = {
-        "CONTENT_LENGTH": str(len(body or "")),
-        "CONTENT_TYPE": headers.get("Content-Type", ""),
-        "PATH_INFO": url_unquote(path_info),
-        "QUERY_STRING": url_encode(event.get("query", {})),
-        "REMOTE_ADDR": event.get("identity", {}).get("sourceIp", ""),
-        "REMOTE_USER": event.get("principalId", ""),
-        "REQUEST_METHOD": event.get("method", ""),
-        "SCRIPT_NAME": script_name,
-        "SERVER_NAME": headers.get("Host", "lambda"),
-        "SERVER_PORT": headers.get("X-Forwarded-Port", "443"),
-        "SERVER_PROTOCOL": "HTTP/1.1",
-        "wsgi.errors": sys.stderr,
-        "wsgi.input": io.BytesIO(body),
-        "wsgi.multiprocess": False,
-        "wsgi.multithread": False,
-        "wsgi.run_once": False,
-        "wsgi.url_scheme": headers.get("X-Forwarded-Proto", "https"),
-        "wsgi.version": (1, 0),
-        "serverless.authorizer": event.get("enhancedAuthContext"),
-        "serverless.event": event,
-        "serverless.context": context,
-    }
-
-    environ = setup_environ_items(environ, headers)
-
-    response = Response.from_app(app, environ)
-
-    returndict = generate_response(response, event)
-
-    if response.status_code >= 300:
+    return build_environ(
+        event,
+        context,
+        headers,
+        body,
+        {
+            "PATH_INFO": url_unquote(path_info),
+            "QUERY_STRING": url_encode(event.get("query", {})),
+            "REMOTE_ADDR": event.get("identity", {}).get("sourceIp", ""),
+            "REMOTE_USER": event.get("principalId", ""),
+            "REQUEST_METHOD": event.get("method", ""),
+            "SCRIPT_NAME": script_name,
+            "serverless.authorizer": event.get("enhancedAuthContext"),
+        },
+    )
+
+
+def add_server_timing(returndict, names):
+    """Appends the `names` latencies to the `Server-Timing` header, if enabled"""
+    value = metrics.server_timing(names)
+    if not value:
+        return
+
+    if "multiValueHeaders" in returndict:
+        returndict["multiValueHeaders"].setdefault("Server-Timing", []).append(value)
+    else:
+        headers = returndict.setdefault("headers", {})
+        if headers.get("Server-Timing"):
+            value = headers["Server-Timing"] + ", " + value
+        headers["Server-Timing"] = value
+
+
+def serve_wsgi(app, event, context, get_environ):
+    """
+    Serves the event through the WSGI app, timing each translation phase for
+    the metrics of the invocation.
+    """
+    with metrics.phase("WSGI.environ"):
+        environ = get_environ(event, context)
+
+    with metrics.phase("WSGI.app"):
+        response = Response.from_app(app, environ)
+
+    with metrics.phase("WSGI.response"):
+        returndict = generate_response(response, event)
+    # The app's own Server-Timing header was set before the response phase
+    add_server_timing(returndict, ["WSGI.response"])
+
+    return returndict
+
+
+def handle_payload_v1(app, event, context):
+    return serve_wsgi(app, event, context, get_environ_v1)
+
+
+def handle_payload_v2(app, event, context):
+    return serve_wsgi(app, event, context, get_environ_v2)
+
+
+def handle_lambda_integration(app, event, context):
+    returndict = serve_wsgi(app, event, context, get_environ_lambda_integration)
+
+    if returndict["statusCode"] >= 300:
         raise RuntimeError(json.dumps(returndict))
 
     return returndict
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The Lambda package imports its modules relative to `lambda_func`, just like
+# `wsgi_handler.py` and `serve.py` do.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
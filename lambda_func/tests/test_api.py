@@ -0,0 +1,497 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from botocore.stub import Stubber
+
+import serverless_wsgi
+from ec2_control import api, clients
+
+
+@pytest.fixture(autouse=True)
+def empty_state_cache():
+    api.state_cache.clear()
+    api.tag_index.clear()
+    yield
+    api.state_cache.clear()
+    api.tag_index.clear()
+
+
+def post(client, path, body):
+    return client.post(
+        path,
+        environ_overrides={"serverless.event": {"body": json.dumps(body)}},
+    )
+
+
+def describe_response(*instances):
+    return {
+        "Reservations": [
+            {
+                "Instances": [
+                    {
+                        "InstanceId": instance_id,
+                        "State": {"Name": state},
+                        "SecurityGroups": [],
+                    }
+                    for instance_id, state in instances
+                ]
+            }
+        ]
+    }
+
+
+def test_poweroff_only_describes_requested_instances():
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "running"), ("i-2", "stopped")),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}]},
+        )
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+
+        response = post(
+            api.app.test_client(), "/ec2/poweroff", {"instance_ids": ["i-1", "i-2"]}
+        )
+
+    assert response.get_json() == {"message": "OK", "targets": ["i-1"]}
+
+
+def test_post_routes_without_lambda_event():
+    # Like `serve.py`, the event is built from the request itself
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response("describe_instances", describe_response(("i-1", "running")))
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+
+        response = api.app.test_client().post(
+            "/ec2/poweroff", json={"instance_ids": ["i-1"]}
+        )
+
+    assert response.status_code == 200
+    assert response.get_json() == {"message": "OK", "targets": ["i-1"]}
+
+
+def test_tag_selector_is_resolved_once_per_ttl():
+    client = api.app.test_client()
+    body = {"tags": "env=staging,team=data"}
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "running")),
+            {
+                "Filters": [
+                    {
+                        "Name": "instance-state-name",
+                        "Values": ["pending", "running", "stopping", "stopped"],
+                    },
+                    {"Name": "tag:env", "Values": ["staging"]},
+                    {"Name": "tag:team", "Values": ["data"]},
+                ]
+            },
+        )
+        stubber.add_response(
+            "stop_instances",
+            {
+                "StoppingInstances": [
+                    {
+                        "InstanceId": "i-1",
+                        "CurrentState": {"Code": 64, "Name": "stopping"},
+                    }
+                ]
+            },
+            {"InstanceIds": ["i-1"]},
+        )
+        first = post(client, "/ec2/poweroff", body)
+
+        # The index still knows i-1, only its state is described again
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "stopped")),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}]},
+        )
+        second = post(client, "/ec2/poweroff", body)
+        stubber.assert_no_pending_responses()
+
+    assert first.get_json() == {"message": "OK", "targets": ["i-1"]}
+    assert second.get_json() == {"message": "OK", "targets": []}
+
+
+def test_info_is_served_from_cache_until_invalidated():
+    client = api.app.test_client()
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances", describe_response(("i-1", "running"))
+        )
+        first = client.get("/ec2/info", query_string={"instance_id": "i-1"})
+        second = client.get("/ec2/info", query_string={"instance_id": "i-1"})
+        stubber.assert_no_pending_responses()
+
+    assert first.get_json() == second.get_json()
+    assert first.get_json()["targets"]["i-1"]["State"] == "running"
+
+    api.state_cache.apply_state_changes(
+        api.region,
+        [{"InstanceId": "i-1", "CurrentState": {"Name": "stopping"}}],
+    )
+    assert api.state_cache.get_many(api.region, ["i-1"]) == {}
+
+
+def test_info_requires_instance_ids_or_tags():
+    response = api.app.test_client().get("/ec2/info")
+
+    assert response.get_json() == {
+        "message": "instance_id or tags is required",
+        "targets": {},
+    }
+
+
+def test_info_projects_fields_of_many_instances():
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": "i-1",
+                                "InstanceType": "t3.micro",
+                                "Tags": [{"Key": "Name", "Value": "web"}],
+                            },
+                            {"InstanceId": "i-2", "InstanceType": "t3.large"},
+                        ]
+                    }
+                ]
+            },
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}]},
+        )
+        response = api.app.test_client().get(
+            "/ec2/info?instance_id=i-1,i-2&fields=InstanceType,Tags"
+        )
+
+    assert response.get_json() == {
+        "message": "OK",
+        "targets": {
+            "i-1": {"InstanceType": "t3.micro", "Tags": {"Name": "web"}},
+            "i-2": {"InstanceType": "t3.large", "Tags": {}},
+        },
+    }
+
+
+def test_info_pages_follow_next_token_then_regions():
+    client = api.app.test_client()
+    query_string = {"tags": "env=staging", "regions": "us-east-1,eu-west-1"}
+    tag_filters = [
+        {
+            "Name": "instance-state-name",
+            "Values": ["pending", "running", "stopping", "stopped"],
+        },
+        {"Name": "tag:env", "Values": ["staging"]},
+    ]
+
+    us_east_client = clients.get_client("us-east-1")
+    eu_west_client = clients.get_client("eu-west-1")
+    with Stubber(us_east_client) as us_east, Stubber(eu_west_client) as eu_west:
+        us_east.add_response(
+            "describe_instances",
+            dict(describe_response(("i-1", "running")), NextToken="t1"),
+            {"Filters": tag_filters, "MaxResults": 5},
+        )
+        us_east.add_response(
+            "describe_instances",
+            describe_response(("i-2", "stopped")),
+            {"Filters": tag_filters, "MaxResults": 5, "NextToken": "t1"},
+        )
+        eu_west.add_response(
+            "describe_instances",
+            describe_response(("i-3", "running")),
+            {"Filters": tag_filters, "MaxResults": 5},
+        )
+
+        pages = []
+        cursor = None
+        while True:
+            params = dict(query_string, limit="5", fields="State")
+            if cursor:
+                params["cursor"] = cursor
+            page = client.get("/ec2/info", query_string=params).get_json()
+            pages.append(page["targets"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+
+    assert pages == [
+        {"i-1": {"State": "running"}},
+        {"i-2": {"State": "stopped"}},
+        {"i-3": {"State": "running"}},
+    ]
+
+
+def test_inventory_streams_one_record_per_instance():
+    us_east_client = clients.get_client("us-east-1")
+    eu_west_client = clients.get_client("eu-west-1")
+    with Stubber(us_east_client) as us_east, Stubber(eu_west_client) as eu_west:
+        us_east.add_response(
+            "describe_instances",
+            dict(describe_response(("i-1", "running")), NextToken="t1"),
+            {"Filters": [], "MaxResults": 1000},
+        )
+        us_east.add_response(
+            "describe_instances",
+            describe_response(("i-2", "stopped")),
+            {"Filters": [], "MaxResults": 1000, "NextToken": "t1"},
+        )
+        eu_west.add_client_error("describe_instances", "UnauthorizedOperation")
+
+        response = api.app.test_client().get(
+            "/ec2/inventory?regions=us-east-1,eu-west-1&fields=State"
+        )
+        assert response.is_streamed
+        lines = response.get_data(as_text=True).splitlines()
+
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in lines] == [
+        {"InstanceId": "i-1", "Region": "us-east-1", "State": "running"},
+        {"InstanceId": "i-2", "Region": "us-east-1", "State": "stopped"},
+        {
+            "Region": "eu-west-1",
+            "error": {"code": "UnauthorizedOperation", "message": ""},
+        },
+    ]
+
+
+def test_poweroff_fans_out_over_regions():
+    body = {"instance_ids": {"us-east-1": ["i-1"], "eu-west-1": ["i-2"]}}
+
+    us_east_client = clients.get_client("us-east-1")
+    eu_west_client = clients.get_client("eu-west-1")
+
+    with Stubber(us_east_client) as us_east, Stubber(eu_west_client) as eu_west:
+        us_east.add_response(
+            "describe_instances", describe_response(("i-1", "running"))
+        )
+        us_east.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+        eu_west.add_client_error("describe_instances", "UnauthorizedOperation")
+
+        response = post(api.app.test_client(), "/ec2/poweroff", body)
+
+    assert response.get_json() == {
+        "message": "OK, but failed in some regions.",
+        "targets": ["i-1"],
+        "region_errors": {
+            "eu-west-1": {"code": "UnauthorizedOperation", "message": ""}
+        },
+        "ec2_calls": {
+            "failed": [
+                {
+                    "operation": "DescribeInstances",
+                    "region": "eu-west-1",
+                    "attempts": 1,
+                    "error": {"code": "UnauthorizedOperation", "message": ""},
+                }
+            ]
+        },
+    }
+
+
+def test_batch_groups_calls_per_region():
+    body = {
+        "operations": [
+            {"action": "start", "instance_ids": ["i-1", "i-3"]},
+            {"action": "stop", "instance_ids": ["i-2"]},
+            {"action": "start", "instance_ids": ["i-2", "i-4"]},
+            {"action": "reboot", "instance_ids": ["i-1"]},
+        ]
+    }
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            describe_response(
+                ("i-1", "stopped"), ("i-3", "running"), ("i-2", "running"), ("i-4", "stopped")
+            ),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-3", "i-2", "i-4"]}]},
+        )
+        stubber.add_response("start_instances", {}, {"InstanceIds": ["i-1", "i-4"]})
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-2"]})
+
+        response = post(api.app.test_client(), "/ec2/batch", body)
+        stubber.assert_no_pending_responses()
+
+    operations = response.get_json()["operations"]
+    assert [o["targets"] for o in operations] == [["i-1"], ["i-2"], ["i-4"], []]
+    assert operations[3]["errors"]["operation"]["code"] == "InvalidAction"
+    assert response.get_json()["message"] == "OK, but some operations failed."
+
+
+def test_batch_rejects_operations_which_are_not_objects():
+    client = api.app.test_client()
+
+    for body in ({"operations": "x"}, ["start"]):
+        response = post(client, "/ec2/batch", body)
+        assert response.status_code == 200
+        assert response.get_json() == {
+            "message": "operations must be a list of objects",
+            "operations": [],
+        }
+
+    response = post(client, "/ec2/batch", {"operations": ["start", 1]})
+    operations = response.get_json()["operations"]
+    assert [o["errors"]["operation"]["code"] for o in operations] == ["InvalidParameterValue"] * 2
+    assert response.get_json()["message"] == "OK, but some operations failed."
+
+
+def test_ip_permissions_fill_the_template():
+    permissions = api.get_ip_permissions("1.2.3.4")
+
+    ssh = [p for p in permissions if p["FromPort"] == 22][0]
+    assert ssh["IpRanges"] == [{"CidrIp": "1.2.3.4/32", "Description": "myip"}]
+    assert api.get_ip_permission_template()[1]["IpRanges"][0]["CidrIp"] == api.MYIP_CIDR
+
+
+def test_warmup_event_primes_the_container(monkeypatch):
+    monkeypatch.setenv("WARMUP_INSTANCE_IDS", "i-1,i-2")
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_regions", {"Regions": []}, {"RegionNames": [api.region]}
+        )
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "running"), ("i-2", "stopped")),
+        )
+        response = serverless_wsgi.handle_request(
+            api.app, {"source": "serverless-plugin-warmup"}, None
+        )
+        stubber.assert_no_pending_responses()
+
+    assert response["message"] == "OK"
+    assert list(response["timings"]) == [
+        "clients",
+        "credentials",
+        "connections",
+        "ip_permissions",
+        "state_cache",
+    ]
+    assert len(api.state_cache) == 2
+
+
+def test_parallel_info_requests_share_one_describe():
+    parallel = 8
+    client = clients.get_client(api.region)
+    entered = threading.Event()
+    coalesced = api.describe_flights.coalesced
+
+    def wait_for_other_requests(**kwargs):
+        entered.set()
+        deadline = time.monotonic() + 5
+        while api.describe_flights.coalesced < coalesced + parallel - 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+
+    def get_info(instance_ids):
+        response = api.app.test_client().get("/ec2/info?instance_id=" + instance_ids)
+        return response.get_json()["targets"]
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_instances", describe_response(("i-1", "running"), ("i-2", "stopped"))
+        )
+        client.meta.events.register_first(
+            "before-parameter-build.ec2.DescribeInstances", wait_for_other_requests
+        )
+        try:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                first = executor.submit(get_info, "i-1,i-2")
+                assert entered.wait(5)
+                others = [
+                    executor.submit(get_info, "i-2" if n % 2 else "i-1")
+                    for n in range(parallel - 1)
+                ]
+                responses = [first.result()] + [f.result() for f in others]
+        finally:
+            client.meta.events.unregister(
+                "before-parameter-build.ec2.DescribeInstances", wait_for_other_requests
+            )
+        stubber.assert_no_pending_responses()
+
+    assert set(responses[0]) == {"i-1", "i-2"}
+    assert [set(r) for r in responses[1:]] == [{"i-1"}, {"i-2"}] * 3 + [{"i-1"}]
+    assert responses[2]["i-2"]["State"] == "stopped"
+
+
+def test_poweron_keeps_started_instances_when_sg_describe_fails():
+    instance = {"InstanceId": "i-1", "State": {"Name": "stopped"}, "SecurityGroups": [{"GroupId": "sg-1"}]}
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [instance]}]})
+        stubber.add_response("start_instances", {}, {"InstanceIds": ["i-1"]})
+        stubber.add_client_error("describe_security_groups", "UnauthorizedOperation")
+
+        response = post(
+            api.app.test_client(),
+            "/ec2/poweron",
+            {"instance_ids": ["i-1"], "myip": "1.2.3.4", "async": True},
+        ).get_json()
+
+    assert response["targets"] == ["i-1"]
+    assert "region_errors" not in response
+    assert response["security_group_errors"][api.region]["code"] == "UnauthorizedOperation"
+    assert response["message"] == "OK, but failed to set some sg."
+    assert "job_id" in response
+
+
+def test_targets_must_be_lists_in_known_regions():
+    with pytest.raises(ValueError):
+        api.parse_region_targets({"us-east-1": "i-abc"})
+    with pytest.raises(ValueError):
+        api.parse_region_targets("i-abc")
+    with pytest.raises(ValueError, match="unknown regions: mars-1"):
+        api.parse_region_targets(["i-1"], ["us-east-1", "mars-1"])
+    with pytest.raises(ValueError):
+        api.parse_region_targets({"mars-1": ["i-1"]})
+
+    response = post(
+        api.app.test_client(), "/ec2/poweroff", {"instance_ids": {"mars-1": ["i-1"]}}
+    ).get_json()
+    assert response == {"message": "unknown regions: mars-1", "targets": []}
+    assert "mars-1" not in clients._clients
+
+
+def test_allowed_regions_restrict_the_known_regions(monkeypatch):
+    monkeypatch.setenv("EC2_ALLOWED_REGIONS", "us-east-1, eu-west-1")
+
+    assert api.parse_regions(["eu-west-1"]) == ["eu-west-1"]
+    with pytest.raises(ValueError):
+        api.parse_regions(["us-west-2"])
+
+
+def test_duplicated_instance_ids_are_called_once():
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "running")),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}]},
+        )
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+        stubber.add_response(
+            "describe_instances",
+            describe_response(("i-1", "stopped"), ("i-2", "stopped")),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}]},
+        )
+        stubber.add_response("start_instances", {}, {"InstanceIds": ["i-1", "i-2"]})
+
+        client = api.app.test_client()
+        poweroff = post(client, "/ec2/poweroff", {"instance_ids": ["i-1", "i-1"]})
+        api.state_cache.clear()
+        poweron = post(
+            client, "/ec2/poweron", {"instance_ids": {api.region: ["i-1", "i-2", "i-1"]}}
+        )
+        stubber.assert_no_pending_responses()
+
+    assert poweroff.get_json()["targets"] == ["i-1"]
+    assert poweron.get_json()["targets"] == ["i-1", "i-2"]
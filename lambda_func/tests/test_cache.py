@@ -0,0 +1,59 @@
+from ec2_control import cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    ttl_cache = cache.TTLCache(ttl=5, maxsize=10, timer=clock)
+    ttl_cache.set("a", 1)
+
+    clock.now = 4.9
+    assert ttl_cache.get("a") == 1
+    clock.now = 5
+    assert ttl_cache.get("a") is None
+    assert len(ttl_cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    ttl_cache = cache.TTLCache(ttl=5, maxsize=2)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("c") == 3
+
+
+def test_state_changes_write_through():
+    state_cache = cache.InstanceStateCache(ttl=5, maxsize=10)
+    state_cache.put_many(
+        "us-east-1",
+        {
+            "i-1": {"State": "running", "PublicIpAddress": "1.2.3.4"},
+            "i-2": {"State": "stopped", "PublicIpAddress": None},
+            "i-3": {"State": "pending", "PublicIpAddress": None},
+        },
+    )
+    assert set(state_cache.get_many("us-east-1", ["i-1", "i-2", "i-3"])) == {"i-1", "i-2"}
+    assert state_cache.get_many("eu-west-1", ["i-1"]) == {}
+
+    state_cache.apply_state_changes(
+        "us-east-1",
+        [
+            {"InstanceId": "i-1", "CurrentState": {"Name": "stopping"}},
+            {"InstanceId": "i-2", "CurrentState": {"Name": "running"}},
+        ],
+    )
+
+    assert state_cache.get_many("us-east-1", ["i-1", "i-2"]) == {
+        "i-2": {"State": "running", "PublicIpAddress": None}
+    }
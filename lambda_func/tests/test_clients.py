@@ -0,0 +1,43 @@
+import threading
+
+from ec2_control import clients
+
+
+def test_config_is_read_from_the_environment():
+    options = clients.get_config_options(
+        {
+            "EC2_MAX_POOL_CONNECTIONS": "64",
+            "EC2_CONNECT_TIMEOUT": "2",
+            "EC2_TCP_KEEPALIVE": "no",
+            "EC2_RETRY_MODE": "adaptive",
+            "EC2_BOTOCORE_MAX_ATTEMPTS": "3",
+        }
+    )
+
+    assert options["max_pool_connections"] == 64
+    assert options["connect_timeout"] == 2
+    assert options["read_timeout"] == 60
+    assert options["tcp_keepalive"] is False
+    assert options["retries"] == {"mode": "adaptive", "total_max_attempts": 3}
+
+
+def test_one_client_is_shared_by_every_thread(monkeypatch):
+    monkeypatch.setenv("EC2_MAX_POOL_CONNECTIONS", "48")
+    clients.reset()
+    created = []
+    barrier = threading.Barrier(8)
+
+    def get_client():
+        barrier.wait()
+        created.append(clients.get_client("ap-northeast-1"))
+
+    threads = [threading.Thread(target=get_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(client) for client in created}) == 1
+    assert created[0].meta.config.max_pool_connections == 48
+    assert created[0].meta.config.tcp_keepalive is True
+    clients.reset()
@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from ec2_control import concurrency
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_single_flight_shares_overlapping_keys():
+    flights = concurrency.SingleFlight()
+    entered = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch(keys):
+        calls.append(list(keys))
+        entered.set()
+        assert release.wait(5)
+        return {key: key.upper() for key in keys if key != "c"}
+
+    results = {}
+    leader = threading.Thread(
+        target=lambda: results.update(leader=flights.do("r", ["a", "b", "c"], slow_fetch))
+    )
+    leader.start()
+    assert entered.wait(5)
+
+    follower = threading.Thread(
+        target=lambda: results.update(
+            follower=flights.do("r", ["b", "c", "d"], lambda keys: calls.append(keys) or {"d": "D"})
+        )
+    )
+    follower.start()
+    # The follower fetched "d" on its own, and now waits for the leader
+    wait_until(lambda: flights.coalesced == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert calls == [["a", "b", "c"], ["d"]]
+    assert results["leader"] == {"a": "A", "b": "B"}
+    assert results["follower"] == {"b": "B", "d": "D"}
+    # Other scopes never match
+    assert flights.do("other", ["a"], lambda keys: {"a": 1}) == {"a": 1}
+
+
+def test_single_flight_shares_errors():
+    flights = concurrency.SingleFlight()
+
+    def fail(keys):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flights.do("r", ["a"], fail)
+    # Nothing stays in flight after an error
+    assert flights.do("r", ["a"], lambda keys: {"a": 1}) == {"a": 1}
@@ -0,0 +1,166 @@
+import base64
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from botocore.stub import Stubber
+from werkzeug.exceptions import Conflict
+
+from ec2_control import api, clients, idempotency
+
+
+def event(body, key=None, user="alice"):
+    return {
+        "body": json.dumps(body),
+        "headers": {"Idempotency-Key": key} if key else {},
+        "requestContext": {"authorizer": {"claims": {"sub": user}}},
+    }
+
+
+def test_request_keys():
+    store = idempotency.IdempotencyStore(ttl=60, maxsize=8)
+    route = "POST /ec2/poweron"
+
+    assert store.request_key(route, event({"instance_ids": ["i-1"]})) is None
+
+    key = store.request_key(route, event({"instance_ids": ["i-1"], "myip": "1.2.3.4"}, "k"))
+    # Same body, other key order and spacing
+    same = dict(event({}, "k"), body='{"myip": "1.2.3.4", "instance_ids": ["i-1"]}')
+    assert store.request_key(route, same) == key
+    # Bodies API Gateway passes as binary
+    encoded = dict(same, body=base64.b64encode(same["body"].encode()).decode(), isBase64Encoded=True)
+    assert store.request_key(route, encoded) == key
+    assert store.request_key("POST /ec2/poweroff", same) != key
+    assert store.request_key(route, event({"instance_ids": ["i-1"]}, "k")) != key
+    assert store.request_key(route, event({"instance_ids": ["i-1"]}, "k", "bob")) != key
+
+    store.hash_bodies = True
+    assert store.request_key(route, event({"instance_ids": ["i-1"]})) is not None
+
+
+def test_sqlite_backend_is_shared_between_containers(tmp_path):
+    path = str(tmp_path / "idempotency.sqlite3")
+    first = idempotency.IdempotencyStore(60, 8, idempotency.SQLiteBackend(path, 60))
+    second = idempotency.IdempotencyStore(60, 8, idempotency.SQLiteBackend(path, 60))
+
+    first.put("key", {"message": "OK"})
+
+    assert second.get("key") == {"message": "OK"}
+    assert second.get("missing") is None
+
+
+def test_sqlite_reservations_are_shared_between_containers(tmp_path):
+    path = str(tmp_path / "idempotency.sqlite3")
+    first = idempotency.IdempotencyStore(60, 8, idempotency.SQLiteBackend(path, 60))
+    second = idempotency.IdempotencyStore(60, 8, idempotency.SQLiteBackend(path, 60))
+
+    assert first.reserve("key")
+    assert not second.reserve("key")
+    assert second.get("key") == idempotency.IN_PROGRESS
+
+    first.release("key")
+    assert second.reserve("key")
+
+
+def test_overlapping_duplicates_wait_for_the_first_response():
+    store = idempotency.IdempotencyStore(ttl=60, maxsize=8)
+    release = threading.Event()
+    calls = []
+
+    def handle(event, context):
+        calls.append(event)
+        release.wait(5)
+        return {"message": "OK", "targets": ["i-1"]}
+
+    handler = store.idempotent("POST /ec2/poweron")(handle)
+    with ThreadPoolExecutor(3) as executor:
+        futures = [executor.submit(handler, event({}, "k"), None) for _ in range(3)]
+        release.set()
+        responses = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert responses == [{"message": "OK", "targets": ["i-1"]}] * 3
+
+
+def test_duplicates_past_the_wait_get_a_conflict():
+    store = idempotency.IdempotencyStore(ttl=60, maxsize=8, wait=0)
+    handler = store.idempotent("POST /ec2/poweron")(lambda event, context: {"message": "OK"})
+    key = store.request_key("POST /ec2/poweron", event({}, "k"))
+    assert store.reserve(key)
+
+    with pytest.raises(Conflict):
+        handler(event({}, "k"), None)
+
+    # Released by a failed first request, the retry is handled
+    store.release(key)
+    assert handler(event({}, "k"), None) == {"message": "OK"}
+
+
+def test_failed_responses_are_not_stored():
+    store = idempotency.IdempotencyStore(ttl=60, maxsize=8)
+    responses = iter([{"message": "failed", "region_errors": {"us-east-1": {}}}, {"message": "OK"}])
+    handler = store.idempotent("POST /ec2/poweroff")(lambda event, context: next(responses))
+
+    assert handler(event({}, "k"), None)["message"] == "failed"
+    assert handler(event({}, "k"), None)["message"] == "OK"
+    assert handler(event({}, "k"), None)["message"] == "OK"
+
+
+def test_retried_poweron_is_answered_without_ec2_calls():
+    api.state_cache.clear()
+    api.idempotency_store.clear()
+    retry = event({"instance_ids": ["i-1"]}, "retry-1")
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {"InstanceId": "i-1", "State": {"Name": "stopped"}, "SecurityGroups": []}
+                        ]
+                    }
+                ]
+            },
+        )
+        stubber.add_response("start_instances", {}, {"InstanceIds": ["i-1"]})
+
+        first = api.power_on_event(retry)
+        # The stubber has no response left, any EC2 call would fail
+        second = api.power_on_event(retry)
+
+    assert first["targets"] == ["i-1"]
+    assert second == first
+    api.idempotency_store.clear()
+
+
+def test_idempotency_key_without_lambda_event():
+    api.state_cache.clear()
+    api.idempotency_store.clear()
+    client = api.app.test_client()
+    body = {"instance_ids": ["i-1"]}
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {"InstanceId": "i-1", "State": {"Name": "running"}, "SecurityGroups": []}
+                        ]
+                    }
+                ]
+            },
+        )
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+
+        # Like `serve.py`, the header is read from the request itself
+        first = client.post("/ec2/poweroff", json=body, headers={"Idempotency-Key": "local-1"})
+        second = client.post("/ec2/poweroff", json=body, headers={"Idempotency-Key": "local-1"})
+
+    assert first.status_code == second.status_code == 200
+    assert second.get_json() == first.get_json() == {"message": "OK", "targets": ["i-1"]}
+    api.idempotency_store.clear()
@@ -0,0 +1,44 @@
+import io
+import json
+import sys
+
+import init_profiler
+
+
+def test_imports_and_phases_are_reported_once(tmp_path, monkeypatch):
+    (tmp_path / "profiled_package").mkdir()
+    (tmp_path / "profiled_package" / "__init__.py").write_text("from . import child\n")
+    (tmp_path / "profiled_package" / "child.py").write_text("VALUE = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    profiler = init_profiler.InitProfiler()
+    profiler.install()
+    try:
+        with profiler.phase("import_app"):
+            import profiled_package  # noqa: F401
+    finally:
+        profiler.uninstall()
+        sys.modules.pop("profiled_package", None)
+        sys.modules.pop("profiled_package.child", None)
+
+    stream = io.StringIO()
+    profiler.report(stream)
+    profiler.report(stream)
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    summary = json.loads(lines[0])["init_profile"]
+    assert list(summary["phases_ms"]) == ["import_app"]
+    assert sorted(m[0] for m in summary["modules_ms"]) == [
+        "profiled_package",
+        "profiled_package.child",
+    ]
+    assert summary["packages_ms"][0][0] == "profiled_package"
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.delenv("WSGI_PROFILE_INIT", raising=False)
+
+    assert init_profiler.from_environ() is None
+    with init_profiler.phase(None, "noop"):
+        pass
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+from botocore.stub import Stubber
+
+from ec2_control import api, clients, jobs
+
+
+@pytest.fixture(autouse=True)
+def memory_job_store(monkeypatch):
+    monkeypatch.setattr(api, "job_store", jobs.MemoryJobStore())
+    api.state_cache.clear()
+
+
+def instance_status(instance_id, state):
+    return {
+        "InstanceId": instance_id,
+        "InstanceState": {"Code": 0, "Name": state},
+        "InstanceStatus": {"Status": "initializing"},
+        "SystemStatus": {"Status": "initializing"},
+    }
+
+
+def test_sqlite_store_round_trip(tmp_path):
+    store = jobs.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+    job = jobs.new_job({"us-east-1": ["i-1"]}, {"message": "OK"})
+
+    store.put(job)
+
+    assert store.get(job["job_id"]) == job
+    assert store.get("missing") is None
+
+
+def test_async_poweron_is_tracked_with_one_status_call_per_tick():
+    client = clients.get_client(api.region)
+    body = {"instance_ids": ["i-1", "i-2"], "async": True}
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": i,
+                                "State": {"Name": "stopped"},
+                                "SecurityGroups": [],
+                            }
+                            for i in ("i-1", "i-2")
+                        ]
+                    }
+                ]
+            },
+        )
+        stubber.add_response(
+            "start_instances",
+            {
+                "StartingInstances": [
+                    {"InstanceId": i, "CurrentState": {"Code": 0, "Name": "pending"}}
+                    for i in ("i-1", "i-2")
+                ]
+            },
+            {"InstanceIds": ["i-1", "i-2"]},
+        )
+        response = api.app.test_client().post(
+            "/ec2/poweron",
+            environ_overrides={"serverless.event": {"body": json.dumps(body)}},
+        ).get_json()
+
+        job_id = response["job_id"]
+        assert response["targets"] == ["i-1", "i-2"]
+        assert "started" not in response
+
+        # Polled again before the backoff delay: no EC2 call at all
+        job = api.job_store.get(job_id)
+        assert api.describe_job(job_id, now=job["created_at"])["status"] == jobs.PENDING
+
+        stubber.add_response(
+            "describe_instance_status",
+            {
+                "InstanceStatuses": [
+                    instance_status("i-1", "running"),
+                    instance_status("i-2", "pending"),
+                ]
+            },
+            {"InstanceIds": ["i-1", "i-2"], "IncludeAllInstances": True},
+        )
+        progress = api.describe_job(job_id, now=job["next_check_at"])
+        assert progress["status"] == jobs.PENDING
+        assert progress["instances"]["i-2"]["State"] == "pending"
+
+        stubber.add_response(
+            "describe_instance_status",
+            {
+                "InstanceStatuses": [
+                    instance_status("i-1", "running"),
+                    instance_status("i-2", "running"),
+                ]
+            },
+        )
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": i,
+                                "State": {"Name": "running"},
+                                "PublicIpAddress": ip,
+                                "SecurityGroups": [],
+                            }
+                            for i, ip in (("i-1", "1.1.1.1"), ("i-2", "2.2.2.2"))
+                        ]
+                    }
+                ]
+            },
+        )
+        job = api.job_store.get(job_id)
+        done = api.describe_job(job_id, now=job["next_check_at"])
+        stubber.assert_no_pending_responses()
+
+    assert done["status"] == jobs.DONE
+    assert done["instances"]["i-2"]["PublicIpAddress"] == "2.2.2.2"
+    assert done["next_check_in"] is None
+
+
+def test_unknown_job_is_not_found():
+    assert api.app.test_client().get("/ec2/jobs/missing").status_code == 404
@@ -0,0 +1,164 @@
+import json
+
+import pytest
+from botocore.stub import Stubber
+
+import metrics
+import serverless_wsgi
+from ec2_control import api, clients, concurrency
+
+
+@pytest.fixture(autouse=True)
+def emf_metrics(monkeypatch):
+    monkeypatch.setenv("EMF_METRICS", "true")
+    api.state_cache.clear()
+    yield
+    api.state_cache.clear()
+
+
+def emf_lines(capsys):
+    return [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith('{"_aws"')
+    ]
+
+
+POWEROFF_EVENT = {
+    "httpMethod": "POST",
+    "path": "/ec2/poweroff",
+    "headers": {"Host": "localhost"},
+    "isBase64Encoded": False,
+    "body": json.dumps({"instance_ids": ["i-1"]}),
+}
+
+
+def stub_poweroff(stubber, error=None):
+    stubber.add_response(
+        "describe_instances",
+        {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {"InstanceId": "i-1", "State": {"Name": "running"}, "SecurityGroups": []}
+                    ]
+                }
+            ]
+        },
+    )
+    if error:
+        stubber.add_client_error("stop_instances", error)
+    else:
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+
+
+def phase_names(server_timing):
+    return [entry.split(";dur=")[0] for entry in server_timing.split(", ")]
+
+
+def test_one_emf_line_per_invocation(capsys):
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stub_poweroff(stubber, "UnauthorizedOperation")
+        with metrics.invocation():
+            response = serverless_wsgi.handle_request(api.app, POWEROFF_EVENT, None)
+
+    [line] = emf_lines(capsys)
+    [directive] = line["_aws"]["CloudWatchMetrics"]
+    assert directive["Dimensions"] == [["Route"]]
+    assert line["Route"] == "POST /ec2/poweroff"
+    # Every declared metric has its values in the line
+    names = [metric["Name"] for metric in directive["Metrics"]]
+    assert all(name in line for name in names)
+    assert {
+        "WSGI.environ",
+        "WSGI.app",
+        "WSGI.response",
+        "RouteLatency",
+        "ec2.DescribeInstances",
+        "ec2.StopInstances",
+        "InvocationLatency",
+    } <= set(names)
+    assert line["AWSCallErrors"] == 1
+    assert line["WSGI.app"] >= line["RouteLatency"]
+    assert "Server-Timing" not in response["headers"]
+
+
+def test_worker_threads_record_into_the_invocation(capsys):
+    with metrics.invocation():
+        concurrency.map_concurrently(
+            lambda n: metrics.current().record("Work", n / 1000.0), [1, 2, 3], 3
+        )
+
+    [line] = emf_lines(capsys)
+    assert sorted(line["Work"]) == [1, 2, 3]
+    assert line["Route"] == metrics.NO_ROUTE
+
+
+def test_disabled_metrics_print_nothing(capsys, monkeypatch):
+    monkeypatch.delenv("EMF_METRICS")
+
+    with metrics.invocation() as recorded:
+        with metrics.phase("WSGI.app"):
+            metrics.record_route("GET /ec2/info", 0.1)
+
+    assert recorded is None
+    assert emf_lines(capsys) == []
+
+
+def test_server_timing_in_lambda(capsys, monkeypatch):
+    monkeypatch.delenv("EMF_METRICS")
+    monkeypatch.setenv("SERVER_TIMING", "true")
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stub_poweroff(stubber)
+        with metrics.invocation():
+            response = serverless_wsgi.handle_request(api.app, POWEROFF_EVENT, None)
+
+    # Listed as they end, the app's own header comes before the response phase
+    assert phase_names(response["headers"]["Server-Timing"]) == [
+        "WSGI.environ",
+        "App.parse",
+        "ec2.DescribeInstances",
+        "App.describe",
+        "ec2.StopInstances",
+        "App.power",
+        "WSGI.response",
+    ]
+    assert emf_lines(capsys) == []
+
+
+def test_server_timing_without_lambda(monkeypatch):
+    monkeypatch.delenv("EMF_METRICS")
+    monkeypatch.setenv("SERVER_TIMING", "true")
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stub_poweroff(stubber)
+        # Like `serve.py`, without any Lambda event
+        response = api.app.test_client().post(
+            "/ec2/poweroff", data=POWEROFF_EVENT["body"]
+        )
+
+    assert phase_names(response.headers["Server-Timing"]) == [
+        "App.parse",
+        "ec2.DescribeInstances",
+        "App.describe",
+        "ec2.StopInstances",
+        "App.power",
+    ]
+    assert metrics.current() is None
+
+
+def test_server_timing_of_native_routes(monkeypatch):
+    monkeypatch.delenv("EMF_METRICS")
+    monkeypatch.setenv("SERVER_TIMING", "true")
+    routes = serverless_wsgi.get_native_routes(api.app)
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stub_poweroff(stubber)
+        with metrics.invocation():
+            response = serverless_wsgi.handle_native_request(routes, POWEROFF_EVENT, None)
+
+    assert phase_names(response["headers"]["Server-Timing"])[-2:] == [
+        "RouteLatency",
+        "Native.serialize",
+    ]
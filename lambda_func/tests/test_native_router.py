@@ -0,0 +1,119 @@
+import base64
+import gzip
+import json
+
+import pytest
+
+import serverless_wsgi
+from ec2_control import api
+
+
+@pytest.fixture
+def cached_instance():
+    api.state_cache.put_many(
+        api.region,
+        {"i-1": {"State": "running", "PublicIpAddress": "1.2.3.4", "SecurityGroups": []}},
+    )
+    yield
+    api.state_cache.clear()
+
+
+def info_event(**kwargs):
+    event = {
+        "httpMethod": "GET",
+        "path": "/ec2/info",
+        "headers": {"Host": "localhost"},
+        "queryStringParameters": {"instance_id": "i-1"},
+        "isBase64Encoded": False,
+        "body": None,
+    }
+    event.update(kwargs)
+    return event
+
+
+def test_native_route_matches_wsgi_response(cached_instance):
+    routes = serverless_wsgi.get_native_routes(api.app)
+
+    native = serverless_wsgi.handle_native_request(routes, info_event(), None)
+    wsgi = serverless_wsgi.handle_request(api.app, info_event(), None)
+
+    assert native["statusCode"] == wsgi["statusCode"] == 200
+    assert native["headers"]["Content-Type"] == wsgi["headers"]["Content-Type"]
+    assert json.loads(native["body"]) == json.loads(wsgi["body"])
+    assert json.loads(native["body"])["targets"]["i-1"]["PublicIpAddress"] == "1.2.3.4"
+
+
+def test_unknown_routes_fall_back_to_wsgi():
+    routes = serverless_wsgi.get_native_routes(api.app)
+
+    assert serverless_wsgi.handle_native_request(routes, info_event(path="/x"), None) is None
+    assert (
+        serverless_wsgi.handle_native_request(
+            routes, info_event(httpMethod="POST"), None
+        )
+        is None
+    )
+    assert serverless_wsgi.handle_native_request(routes, {"source": "aws.events"}, None) is None
+
+
+@pytest.mark.parametrize("body", ["not json", None])
+def test_route_errors_match_wsgi_response(body):
+    routes = serverless_wsgi.get_native_routes(api.app)
+    event = info_event(httpMethod="POST", path="/ec2/poweroff", body=body)
+
+    native = serverless_wsgi.handle_native_request(routes, event, None)
+    wsgi = serverless_wsgi.handle_request(api.app, event, None)
+
+    assert native["statusCode"] == wsgi["statusCode"] == 500
+    assert native["headers"]["Content-Type"] == wsgi["headers"]["Content-Type"]
+    assert native["body"] == wsgi["body"]
+
+
+def test_native_responses_are_compressed(cached_instance, monkeypatch):
+    monkeypatch.setenv("RESPONSE_COMPRESSION", "true")
+    monkeypatch.setenv("RESPONSE_COMPRESSION_MIN_SIZE", "10")
+    routes = serverless_wsgi.get_native_routes(api.app)
+    event = info_event(headers={"Host": "localhost", "Accept-Encoding": "gzip"})
+
+    native = serverless_wsgi.handle_native_request(routes, event, None)
+    wsgi = serverless_wsgi.handle_request(api.app, event, None)
+
+    assert native["isBase64Encoded"] is wsgi["isBase64Encoded"] is True
+    assert native["headers"]["Content-Encoding"] == "gzip"
+    assert native["headers"]["Vary"] == "Accept-Encoding"
+    data = gzip.decompress(base64.b64decode(native["body"]))
+    assert native["headers"]["Content-Length"] == str(len(base64.b64decode(native["body"])))
+    assert json.loads(data) == json.loads(gzip.decompress(base64.b64decode(wsgi["body"])))
+
+
+def test_requests_in_progress_get_the_same_conflict(monkeypatch):
+    monkeypatch.setattr(api.idempotency_store, "wait", 0)
+    routes = serverless_wsgi.get_native_routes(api.app)
+    event = info_event(
+        httpMethod="POST",
+        path="/ec2/poweroff",
+        headers={"Host": "localhost", "Idempotency-Key": "k"},
+        queryStringParameters=None,
+        body=json.dumps({"instance_ids": ["i-1"]}),
+    )
+    key = api.idempotency_store.request_key("POST /ec2/poweroff", event)
+    assert api.idempotency_store.reserve(key)
+
+    native = serverless_wsgi.handle_native_request(routes, event, None)
+    wsgi = serverless_wsgi.handle_request(api.app, event, None)
+
+    api.idempotency_store.release(key)
+    assert native["statusCode"] == wsgi["statusCode"] == 409
+    assert native["body"] == wsgi["body"]
+
+
+def test_native_routes_strip_the_base_path(cached_instance, monkeypatch):
+    monkeypatch.setenv("API_GATEWAY_BASE_PATH", "admin")
+    routes = serverless_wsgi.get_native_routes(api.app)
+
+    native = serverless_wsgi.handle_native_request(
+        routes, info_event(path="/admin/ec2/info"), None
+    )
+
+    assert native["statusCode"] == 200
+    assert "i-1" in json.loads(native["body"])["targets"]
@@ -0,0 +1,73 @@
+import pytest
+
+from ec2_control import query
+
+
+class FakeEc2:
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.calls = []
+
+    def describe_instances(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.pages.pop(0)
+
+
+def page(*instance_ids, next_token=None):
+    ret = {
+        "Reservations": [
+            {"Instances": [{"InstanceId": i, "SecurityGroups": []} for i in instance_ids]}
+        ]
+    }
+    if next_token:
+        ret["NextToken"] = next_token
+    return ret
+
+
+def test_filters_are_pushed_server_side():
+    ec2 = FakeEc2([page("i-1")])
+
+    instances = list(query.iter_instances(ec2, ["i-1", "i-1"], states=["stopped"]))
+
+    assert [i["InstanceId"] for i in instances] == ["i-1"]
+    assert ec2.calls == [
+        {
+            "Filters": [
+                {"Name": "instance-id", "Values": ["i-1"]},
+                {"Name": "instance-state-name", "Values": ["stopped"]},
+            ]
+        }
+    ]
+
+
+def test_ids_are_chunked_and_pages_followed():
+    ids = ["i-%d" % n for n in range(query.MAX_FILTER_VALUES + 1)]
+    ec2 = FakeEc2([page("i-0", next_token="t"), page("i-1"), page("i-200")])
+
+    instances = list(query.iter_instances(ec2, ids))
+
+    assert [i["InstanceId"] for i in instances] == ["i-0", "i-1", "i-200"]
+    assert len(ec2.calls[0]["Filters"][0]["Values"]) == query.MAX_FILTER_VALUES
+    assert ec2.calls[1]["NextToken"] == "t"
+    assert ec2.calls[2]["Filters"][0]["Values"] == ["i-200"]
+
+
+def test_empty_id_list_makes_no_call():
+    ec2 = FakeEc2([])
+
+    assert list(query.iter_describe_pages(ec2, [])) == []
+    assert ec2.calls == []
+
+
+def test_tag_selectors_are_normalized():
+    selector = query.parse_tag_selector("team=data, env=staging,env=qa")
+
+    assert selector == query.parse_tag_selector(
+        {"env": ["staging", "qa"], "team": "data"}
+    )
+    assert query.build_tag_filters(selector) == [
+        {"Name": "tag:env", "Values": ["qa", "staging"]},
+        {"Name": "tag:team", "Values": ["data"]},
+    ]
+    with pytest.raises(ValueError):
+        query.parse_tag_selector("env")
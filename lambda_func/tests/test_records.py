@@ -0,0 +1,50 @@
+import sys
+
+from ec2_control import api, records
+
+
+def describe_page(*instance_ids):
+    return {
+        "Reservations": [
+            {
+                "Instances": [
+                    {
+                        "InstanceId": "".join(instance_id),
+                        "State": {"Name": "running"},
+                        "SecurityGroups": [{"GroupId": "sg-1"}],
+                    }
+                    for instance_id in instance_ids
+                ]
+            }
+        ]
+    }
+
+
+def test_records_share_their_layout_and_intern_ids():
+    # Join the IDs at runtime so they are not interned constants already
+    parsed = api.parser_describe_response(describe_page(("i-", "1"), ("i-", "2")))
+
+    first, second = parsed["i-1"], parsed["i-2"]
+    assert not hasattr(first, "__dict__")
+    assert first._layout is second._layout
+    assert all(instance_id is sys.intern(instance_id) for instance_id in parsed)
+    assert first == {
+        "State": "running",
+        "PublicIpAddress": None,
+        "SecurityGroups": ("sg-1",),
+    }
+
+
+def test_records_are_converted_for_json_only_when_sent():
+    parsed = api.parser_describe_response(describe_page(("i-", "1")))
+    stopped = parsed["i-1"].replace(State="stopped")
+
+    assert parsed["i-1"]["State"] == "running"
+    assert records.to_json({"i-1": stopped}) == {
+        "i-1": {
+            "State": "stopped",
+            "PublicIpAddress": None,
+            "SecurityGroups": ("sg-1",),
+        }
+    }
+    assert api.project(parsed, ("State",))["i-1"].to_dict() == {"State": "running"}
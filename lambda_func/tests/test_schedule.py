@@ -0,0 +1,146 @@
+import datetime
+import json
+
+import pytest
+from botocore.stub import Stubber
+
+import serverless_wsgi
+from ec2_control import api, clients, jobs, schedule
+
+SCHEDULES = [
+    {
+        "name": "office-hours",
+        "instance_ids": ["i-1", "i-2"],
+        "start": "0 9 * * 1-5",
+        "stop": "30 18 * * 1-5",
+        "utc_offset": "+08:00",
+    },
+    {"name": "nightly-stop", "instance_ids": ["i-3"], "stop": "0 */6 * * *"},
+]
+
+
+def at(value):
+    return schedule.parse_timestamp(value)
+
+
+@pytest.fixture(autouse=True)
+def schedules(monkeypatch):
+    monkeypatch.setenv("POWER_SCHEDULES", json.dumps(SCHEDULES))
+    monkeypatch.setattr(api, "schedule_index", None)
+    monkeypatch.setattr(api, "job_store", jobs.MemoryJobStore())
+    api.state_cache.clear()
+    yield
+    api.state_cache.clear()
+
+
+def test_cron_next_after():
+    cron = schedule.CronExpression("*/20 9-10 1,15 * 0")
+    moment = datetime.datetime(2022, 5, 2, 10, 40, tzinfo=datetime.timezone.utc)
+
+    # May 2nd is a Monday, the day of month (15) or Sunday (8) both match
+    assert cron.next_after(moment) == moment.replace(day=8, hour=9, minute=0)
+    assert schedule.parse_cron_field("5/20", "minute", 0, 59) == (5, 25, 45)
+    with pytest.raises(ValueError):
+        schedule.CronExpression("0 24 * * *")
+
+
+def test_index_pops_only_due_transitions_at_synthetic_times():
+    index = schedule.ScheduleIndex(
+        schedule.from_environ(), at("2022-05-02T00:30:00Z")
+    )
+
+    due = index.pop_due(at("2022-05-02T01:00:00Z"))
+    assert [(s.name, action) for _, s, action in due] == [("office-hours", "start")]
+    assert index.pop_due(at("2022-05-02T01:05:00Z")) == []
+    assert index.next_at() == at("2022-05-02T06:00:00Z")
+
+    # Transitions missed for longer than the window are skipped
+    due = index.pop_due(at("2022-05-03T12:05:00Z"), window=600)
+    assert [(s.name, action) for _, s, action in due] == [("nightly-stop", "stop")]
+
+
+def test_eventbridge_event_applies_one_start_and_one_stop(monkeypatch):
+    monkeypatch.setenv(
+        "POWER_SCHEDULES",
+        json.dumps(
+            [
+                dict(SCHEDULES[0], stop=None),
+                {"name": "nightly-stop", "instance_ids": ["i-3"], "stop": "0 1 * * *"},
+            ]
+        ),
+    )
+    event = {
+        "source": "aws.events",
+        "detail-type": "Scheduled Event",
+        "time": "2022-05-02T01:00:00Z",
+    }
+    instances = (("i-1", "stopped"), ("i-2", "stopped"), ("i-3", "running"))
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {"InstanceId": i, "State": {"Name": s}, "SecurityGroups": []}
+                            for i, s in instances
+                        ]
+                    }
+                ]
+            },
+        )
+        stubber.add_response("start_instances", {}, {"InstanceIds": ["i-1", "i-2"]})
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-3"]})
+        response = serverless_wsgi.handle_request(api.app, event, None)
+        stubber.assert_no_pending_responses()
+
+    assert response["transitions"] == [
+        {"schedule": "office-hours", "action": "start", "at": "2022-05-02T01:00:00Z"},
+        {"schedule": "nightly-stop", "action": "stop", "at": "2022-05-02T01:00:00Z"},
+    ]
+    assert response["started"] == ["i-1", "i-2"]
+    assert response["stopped"] == ["i-3"]
+
+    # The next event of the rule finds nothing due
+    event["time"] = "2022-05-02T01:05:00Z"
+    assert serverless_wsgi.handle_request(api.app, event, None)["transitions"] == []
+
+
+def test_new_containers_skip_transitions_applied_by_others(monkeypatch):
+    event = {
+        "source": "aws.events",
+        "detail-type": "Scheduled Event",
+        "time": "2022-05-02T12:00:00Z",
+    }
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_instances",
+            {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {"InstanceId": "i-3", "State": {"Name": "running"}, "SecurityGroups": []}
+                        ]
+                    }
+                ]
+            },
+        )
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-3"]})
+        assert api.schedule_event(event)["stopped"] == ["i-3"]
+
+        # Another container, with the same job store, within the window
+        monkeypatch.setattr(api, "schedule_index", None)
+        event["time"] = "2022-05-02T12:05:00Z"
+        assert api.schedule_event(event)["transitions"] == []
+        stubber.assert_no_pending_responses()
+
+
+def test_schedule_state_is_not_a_job():
+    api.save_schedule_evaluated_at(at("2022-05-02T12:00:00Z"))
+
+    response = api.app.test_client().get("/ec2/jobs/schedule%23evaluated_at")
+
+    assert response.status_code == 404
+    assert api.load_schedule_evaluated_at() == at("2022-05-02T12:00:00Z")
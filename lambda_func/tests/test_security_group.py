@@ -0,0 +1,124 @@
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from ec2_control import api, clients, security_group
+
+
+def ssh(cidr):
+    return {
+        "IpProtocol": "tcp",
+        "FromPort": 22,
+        "ToPort": 22,
+        "IpRanges": [{"CidrIp": cidr, "Description": "myip"}],
+    }
+
+
+def test_diff_only_touches_changed_rules():
+    current = [ssh("1.1.1.1/32"), ssh("2.2.2.2/32")]
+    desired = [ssh("2.2.2.2/32"), ssh("3.3.3.3/32")]
+
+    to_authorize, to_revoke = security_group.diff_ip_permissions(current, desired)
+
+    assert to_authorize == [ssh("3.3.3.3/32")]
+    assert to_revoke == [ssh("1.1.1.1/32")]
+
+
+def test_collect_group_ids_is_unique():
+    instances = {
+        "i-1": {"SecurityGroups": ["sg-1", "sg-2"]},
+        "i-2": {"SecurityGroups": ["sg-2"]},
+    }
+
+    assert security_group.collect_group_ids(instances) == ["sg-1", "sg-2"]
+
+
+def test_reconcile_skips_groups_already_in_desired_state():
+    desired = api.get_ip_permissions("2.2.2.2")
+    stale = [
+        dict(permission, IpRanges=[{"CidrIp": "1.1.1.1/32"}])
+        if permission["FromPort"] == 22 else permission
+        for permission in desired
+    ]
+
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response(
+            "describe_security_groups",
+            {
+                "SecurityGroups": [
+                    {"GroupId": "sg-1", "IpPermissions": desired},
+                    {"GroupId": "sg-2", "IpPermissions": stale},
+                ]
+            },
+            {"GroupIds": ["sg-1", "sg-2"]},
+        )
+        stubber.add_response(
+            "authorize_security_group_ingress",
+            {},
+            {
+                "GroupId": "sg-2",
+                "IpPermissions": [
+                    {
+                        "IpProtocol": "tcp",
+                        "FromPort": 22,
+                        "ToPort": 22,
+                        "IpRanges": [{"CidrIp": "2.2.2.2/32", "Description": "myip"}],
+                    }
+                ],
+            },
+        )
+        stubber.add_response(
+            "revoke_security_group_ingress",
+            {},
+            {
+                "GroupId": "sg-2",
+                "IpPermissions": [
+                    {
+                        "IpProtocol": "tcp",
+                        "FromPort": 22,
+                        "ToPort": 22,
+                        "IpRanges": [{"CidrIp": "1.1.1.1/32"}],
+                    }
+                ],
+            },
+        )
+
+        results, errors = security_group.reconcile(
+            clients.get_client(api.region), ["sg-1", "sg-2"], desired
+        )
+        stubber.assert_no_pending_responses()
+
+    assert results == {"sg-1": security_group.UNCHANGED, "sg-2": security_group.UPDATED}
+    assert errors == {}
+
+
+class FailingEc2:
+    def describe_security_groups(self, **kwargs):
+        return {
+            "SecurityGroups": [
+                {"GroupId": group_id, "IpPermissions": []}
+                for group_id in kwargs["GroupIds"]
+            ]
+        }
+
+    def authorize_security_group_ingress(self, GroupId, IpPermissions):
+        if GroupId == "sg-2":
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "RulesPerSecurityGroupLimitExceeded",
+                        "Message": "full",
+                    }
+                },
+                "AuthorizeSecurityGroupIngress",
+            )
+
+
+def test_reconcile_reports_failures_per_group():
+    results, errors = security_group.reconcile(
+        FailingEc2(), ["sg-1", "sg-2", "sg-3"], [ssh("1.1.1.1/32")], max_workers=3
+    )
+
+    assert results == {"sg-1": security_group.UPDATED, "sg-3": security_group.UPDATED}
+    assert errors == {
+        "sg-2": {"code": "RulesPerSecurityGroupLimitExceeded", "message": "full"}
+    }
@@ -0,0 +1,133 @@
+import base64
+import gzip
+import json
+
+from werkzeug.datastructures import Headers
+from werkzeug.wrappers import Response
+
+import serverless_wsgi
+
+
+def test_iter_casings_keeps_all_casings_order():
+    for name in ("Set-Cookie", "x-1a", "123", ""):
+        assert list(serverless_wsgi.iter_casings(name)) == list(
+            serverless_wsgi.all_casings(name)
+        )
+
+
+def test_header_casings_are_generated_on_demand():
+    assert serverless_wsgi.header_casings("X-Ab", 2) == ["x-ab", "X-ab"]
+    assert len(serverless_wsgi.header_casings("X-Ab", 100)) == 8
+
+
+def test_split_headers_spreads_repeated_headers_over_casings():
+    headers = Headers(
+        [("Set-Cookie", "a=1"), ("Set-Cookie", "b=2"), ("Content-Type", "text/plain")]
+    )
+
+    assert serverless_wsgi.split_headers(headers) == {
+        "set-cookie": "a=1",
+        "Set-cookie": "b=2",
+        "Content-Type": "text/plain",
+    }
+
+
+def test_group_headers_collects_values_per_name():
+    headers = Headers([("Set-Cookie", "a=1"), ("set-cookie", "b=2")])
+
+    assert serverless_wsgi.group_headers(headers) == {"Set-Cookie": ["a=1", "b=2"]}
+
+
+def test_negotiate_content_encoding():
+    assert serverless_wsgi.negotiate_content_encoding("gzip, deflate, br") == "gzip"
+    assert serverless_wsgi.negotiate_content_encoding("deflate;q=0.5, gzip;q=0") == "deflate"
+    assert serverless_wsgi.negotiate_content_encoding("*") == "gzip"
+    assert serverless_wsgi.negotiate_content_encoding("identity") is None
+    assert serverless_wsgi.negotiate_content_encoding("") is None
+
+
+def test_generate_response_compresses_large_bodies(monkeypatch):
+    monkeypatch.setenv("RESPONSE_COMPRESSION", "true")
+    monkeypatch.setenv("RESPONSE_COMPRESSION_MIN_SIZE", "100")
+    event = {"headers": {"accept-encoding": "gzip"}}
+
+    small = serverless_wsgi.generate_response(
+        Response('{"a": 1}', mimetype="application/json"), event
+    )
+    assert small["body"] == '{"a": 1}'
+    assert small["isBase64Encoded"] is False
+
+    body = json.dumps({"targets": ["i-%d" % n for n in range(100)]})
+    large = serverless_wsgi.generate_response(
+        Response(body, mimetype="application/json"), event
+    )
+    assert large["isBase64Encoded"] is True
+    assert large["headers"]["Content-Encoding"] == "gzip"
+    assert large["headers"]["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(base64.b64decode(large["body"])).decode("utf-8") == body
+
+
+def test_generate_response_is_uncompressed_by_default(monkeypatch):
+    monkeypatch.delenv("RESPONSE_COMPRESSION", raising=False)
+    body = "x" * 10000
+
+    response = serverless_wsgi.generate_response(
+        Response(body), {"headers": {"Accept-Encoding": "gzip"}}
+    )
+
+    assert response["body"] == body
+    assert "Content-Encoding" not in response["headers"]
+
+
+def test_environ_v1_from_event():
+    event = {
+        "httpMethod": "GET",
+        "path": "/ec2/info/café",
+        "multiValueHeaders": {
+            "Host": ["abcdefghij.execute-api.us-east-1.amazonaws.com"],
+            "X-Forwarded-For": ["1.1.1.1", "2.2.2.2"],
+            "Content-Type": ["application/json"],
+        },
+        "multiValueQueryStringParameters": {"instance_id": ["i-1"]},
+        "requestContext": {
+            "stage": "prod",
+            "identity": {"sourceIp": "1.1.1.1"},
+            "authorizer": {"principalId": "user"},
+        },
+        "isBase64Encoded": False,
+        "body": None,
+    }
+
+    environ = serverless_wsgi.get_environ_v1(event, None)
+
+    assert environ["PATH_INFO"] == "/ec2/info/cafÃ©"
+    assert environ["SCRIPT_NAME"] == "/prod"
+    assert environ["QUERY_STRING"] == "instance_id=i-1"
+    assert environ["REMOTE_ADDR"] == "1.1.1.1"
+    assert environ["REMOTE_USER"] == "user"
+    assert environ["REQUEST_METHOD"] == "GET"
+    assert environ["CONTENT_TYPE"] == "application/json"
+    assert environ["CONTENT_LENGTH"] == "0"
+    assert environ["HTTP_X_FORWARDED_FOR"] == "2.2.2.2"
+    assert "HTTP_CONTENT_TYPE" not in environ
+    assert environ["SERVER_PROTOCOL"] == "HTTP/1.1"
+    assert environ["serverless.event"] is event
+
+
+def test_environ_v2_joins_cookies():
+    event = {
+        "version": "2.0",
+        "rawPath": "/ec2/info",
+        "rawQueryString": "instance_id=i-1",
+        "cookies": ["a=1", "b=2"],
+        "headers": {"host": "localhost", "cookie": "ignored"},
+        "requestContext": {"http": {"method": "GET", "sourceIp": "1.1.1.1"}},
+        "isBase64Encoded": False,
+    }
+
+    environ = serverless_wsgi.get_environ_v2(event, None)
+
+    assert environ["HTTP_COOKIE"] == "a=1; b=2"
+    assert environ["SERVER_NAME"] == "localhost"
+    assert environ["REQUEST_METHOD"] == "GET"
+    assert environ["QUERY_STRING"] == "instance_id=i-1"
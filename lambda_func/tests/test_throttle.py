@@ -0,0 +1,119 @@
+import json
+
+import pytest
+from botocore.stub import Stubber
+
+from ec2_control import api, clients, throttle
+
+
+@pytest.fixture(autouse=True)
+def fresh_buckets(monkeypatch):
+    monkeypatch.setattr(throttle, "_buckets", {})
+    monkeypatch.setattr(throttle, "BASE_DELAY", 0)
+    api.state_cache.clear()
+    yield
+    api.state_cache.clear()
+
+
+class FakeContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def poweroff(context=None):
+    event = {"body": json.dumps({"instance_ids": ["i-1"]})}
+    return api.power_off_event(event, context)
+
+
+def describe_running():
+    return {
+        "Reservations": [
+            {
+                "Instances": [
+                    {
+                        "InstanceId": "i-1",
+                        "State": {"Name": "running"},
+                        "SecurityGroups": [],
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def test_bucket_halves_its_rate_on_throttles_and_recovers():
+    now = [0.0]
+    sleeps = []
+    bucket = throttle.TokenBucket(
+        max_rate=4, capacity=1, timer=lambda: now[0], sleep=sleeps.append
+    )
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.25)
+    now[0] += 0.25
+
+    bucket.throttled()
+    assert bucket.rate == 2
+    assert bucket.acquire() == pytest.approx(0.5)
+
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 4
+
+    with pytest.raises(throttle.DeadlineExceeded):
+        bucket.acquire(deadline=now[0])
+
+
+def test_throttled_calls_are_retried_and_reported():
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_response("describe_instances", describe_running())
+        stubber.add_client_error("stop_instances", "RequestLimitExceeded")
+        stubber.add_client_error("stop_instances", "RequestLimitExceeded")
+        stubber.add_response("stop_instances", {}, {"InstanceIds": ["i-1"]})
+
+        response = poweroff()
+
+    assert response["message"] == "OK"
+    assert response["targets"] == ["i-1"]
+    [delayed] = response["ec2_calls"]["delayed"]
+    assert delayed["operation"] == "StopInstances"
+    assert delayed["attempts"] == 3
+    assert throttle.get_bucket(api.region).rate < throttle.MAX_RATE
+
+
+def test_transient_errors_only_retry_read_only_calls():
+    with Stubber(clients.get_client(api.region)) as stubber:
+        stubber.add_client_error("describe_instances", "InternalError")
+        stubber.add_response("describe_instances", describe_running())
+        # May have stopped the instance already, not sent again
+        stubber.add_client_error("stop_instances", "InternalError")
+
+        response = poweroff()
+
+    assert response["targets"] == []
+    assert response["region_errors"][api.region]["code"] == "InternalError"
+    [delayed] = response["ec2_calls"]["delayed"]
+    assert delayed["operation"] == "DescribeInstances"
+    [failed] = response["ec2_calls"]["failed"]
+    assert failed["operation"] == "StopInstances"
+    assert failed["attempts"] == 1
+
+
+def test_calls_failing_past_the_deadline_are_reported():
+    with Stubber(clients.get_client(api.region)):
+        response = poweroff(FakeContext(remaining_ms=500))
+
+    assert response["targets"] == []
+    assert response["region_errors"][api.region]["code"] == "DeadlineExceeded"
+    [failed] = response["ec2_calls"]["failed"]
+    assert failed["operation"] == "DescribeInstances"
+    assert failed["error"]["code"] == "DeadlineExceeded"
+
+
+def test_missing_targets_are_reported_instead_of_ok():
+    response = api.power_off_event({"body": json.dumps({})})
+
+    assert response == {"message": "instance_ids or tags is required", "targets": []}
@@ -13,6 +13,13 @@ import os
 import sys
 import traceback
 
+import flags
+import init_profiler
+
+# Opt-in import and init phase profiling, see `WSGI_PROFILE_INIT`. It has to be
+# installed before any of the heavy imports below.
+profiler = init_profiler.from_environ()
+
 # Call decompression helper from `serverless-python-requirements` if
 # available. See: https://github.com/UnitedIncome/serverless-python-requirements#dealing-with-lambdas-size-limitations
 try:
@@ -20,6 +27,7 @@ try:
 except ImportError:
     pass
 
+import metrics
 import serverless_wsgi
 
 
@@ -54,6 +62,27 @@ def append_text_mime_types(config):
         serverless_wsgi.TEXT_MIME_TYPES.extend(config["text_mime_types"])
 
 
+def load_native_routes(app):
+    """Native routes of the app, when enabled by `WSGI_NATIVE_ROUTER`"""
+    if not flags.is_set("WSGI_NATIVE_ROUTER"):
+        return {}
+    return serverless_wsgi.get_native_routes(app)
+
+
+def handle_event(event, context):
+    """Serves native routes directly, everything else through the WSGI app"""
+    # One EMF metrics line per invocation, see `EMF_METRICS`
+    with metrics.invocation():
+        if native_routes:
+            response = serverless_wsgi.handle_native_request(
+                native_routes, event, context
+            )
+            if response is not None:
+                return response
+
+        return serverless_wsgi.handle_request(wsgi_app, event, context)
+
+
 def handler(event, context):
     """Lambda event handler, invokes the WSGI wrapper and handles command invocation"""
     if "_serverless-wsgi" in event:
@@ -102,8 +131,14 @@ def handler(event, context):
             sys.stderr = native_stderr
 
         return [0, output_buffer.getvalue()]
+    elif profiler is not None and not profiler.reported:
+        # Lazily created clients and late imports are part of the first request
+        with profiler.phase("first_request"):
+            response = handle_event(event, context)
+        profiler.report()
+        return response
     else:
-        return serverless_wsgi.handle_request(wsgi_app, event, context)
+        return handle_event(event, context)
 
 
 def _create_app():
@@ -111,6 +146,10 @@ def _create_app():
 
 
 # Read configuration and import the WSGI application
-config = load_config()
-wsgi_app = import_app(config)
-append_text_mime_types(config)
+with init_profiler.phase(profiler, "load_config"):
+    config = load_config()
+with init_profiler.phase(profiler, "import_app"):
+    wsgi_app = import_app(config)
+with init_profiler.phase(profiler, "append_text_mime_types"):
+    append_text_mime_types(config)
+native_routes = load_native_routes(wsgi_app)